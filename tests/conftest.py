@@ -0,0 +1,5 @@
+# the training scripts import their modules flat (models_mae, util.*) from x_maes/
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'x_maes'))
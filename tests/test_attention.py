@@ -0,0 +1,44 @@
+# Custom attention modules: scaled_dot_product_attention path against the
+# explicit softmax(q @ k.T) @ v path, same weights and inputs.
+import pytest
+import torch
+
+from util.reference import attention_modules, attention_call
+from util.attention import _HAS_SDPA, set_fused_attn
+
+pytestmark = pytest.mark.skipif(not _HAS_SDPA, reason='needs scaled_dot_product_attention with scale= (torch>=2.1)')
+
+NAMES = ('CAE Attention', 'CAE CrossAttention', 'Attention_AGAT')
+
+
+def _run(name, module, x, fused):
+    set_fused_attn(module, fused)
+    module.zero_grad(set_to_none=True)
+    xg = x.clone().requires_grad_()
+    out = attention_call(name, module, xg)
+    out.square().sum().backward()
+    weight = module.qkv.weight if hasattr(module, 'qkv') else module.q.weight
+    return out.detach(), xg.grad, weight.grad
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_fused_matches_explicit(name):
+    torch.manual_seed(0)
+    module = attention_modules(64, 4)[name]
+    x = torch.randn(2, 17, 64)
+    explicit = _run(name, module, x, False)
+    fused = _run(name, module, x, True)
+    for a, b in zip(fused, explicit):
+        torch.testing.assert_close(a, b, atol=1e-4, rtol=1e-4)
+
+
+def test_agat_keeps_same_tokens():
+    torch.manual_seed(0)
+    module = attention_modules(64, 4)['Attention_AGAT']
+    x = torch.randn(2, 17, 64)
+    kept = []
+    for fused in (False, True):
+        set_fused_attn(module, fused)
+        with torch.no_grad():
+            kept.append(module(x)[3])
+    assert torch.equal(kept[0], kept[1])
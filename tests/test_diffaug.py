@@ -0,0 +1,52 @@
+# Fused DiffAugment ops (util/diffaug.py) against the sequential / meshgrid
+# references of util/reference.py: same seed, same output and gradient.
+import pytest
+import torch
+
+from util.reference import color_sequential, translation_meshgrid, cutout_meshgrid
+from util import diffaug
+
+
+def _all_reference(x):
+    return cutout_meshgrid(translation_meshgrid(color_sequential(x)))
+
+
+def _all_fused(x):
+    return diffaug.DiffAugment(x, policy='color,translation,cutout')
+
+
+PAIRS = [
+    ('color', color_sequential, diffaug.rand_color),
+    ('translation', translation_meshgrid, diffaug.rand_translation),
+    ('cutout', cutout_meshgrid, diffaug.rand_cutout),
+    ('all', _all_reference, _all_fused),
+]
+
+
+def _same_seed(fn, x, seed):
+    torch.manual_seed(seed)
+    return fn(x)
+
+
+@pytest.mark.parametrize('name,reference,fused', PAIRS, ids=[p[0] for p in PAIRS])
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_reference(name, reference, fused, seed):
+    x = torch.randn(4, 3, 32, 32)
+    torch.testing.assert_close(_same_seed(fused, x, seed), _same_seed(reference, x, seed), atol=1e-5, rtol=1e-5)
+
+
+def test_gradient_matches_reference():
+    x = torch.randn(4, 3, 32, 32)
+    grads = []
+    for fn in (_all_reference, _all_fused):
+        xg = x.clone().requires_grad_()
+        _same_seed(fn, xg, 0).square().sum().backward()
+        grads.append(xg.grad)
+    torch.testing.assert_close(grads[1], grads[0], atol=1e-5, rtol=1e-5)
+
+
+def test_channels_last_policy():
+    x = torch.randn(2, 3, 16, 16)
+    out = _same_seed(lambda t: diffaug.DiffAugment(t.permute(0, 2, 3, 1), 'color,translation', False), x, 0)
+    expected = _same_seed(lambda t: diffaug.DiffAugment(t, 'color,translation'), x, 0)
+    torch.testing.assert_close(out.permute(0, 3, 1, 2), expected)
@@ -0,0 +1,60 @@
+# main_linprobe end to end on a toy ImageFolder (CPU): features are
+# extracted once, reused when the settings match and extracted again when
+# they do not.
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import main_linprobe
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    rng = np.random.RandomState(0)
+    for split in ('train', 'val'):
+        for cls in ('a', 'b'):
+            os.makedirs(tmp_path / 'data' / split / cls)
+            for i in range(2):
+                Image.fromarray(rng.randint(0, 256, (40, 40, 3), dtype=np.uint8)).save(
+                    tmp_path / 'data' / split / cls / ('%d.png' % i))
+    return tmp_path
+
+
+def _run(root, *extra, data='data'):
+    args = main_linprobe.get_args_parser().parse_args([
+        '--variant', 'models_mae', '--model', 'mae_vit_base_patch16', '--input_size', '32',
+        '--data_path', str(root / data), '--output_dir', str(root / 'out'), '--log_dir', '',
+        '--device', 'cpu', '--num_workers', '0', '--no_pin_mem', '--epochs', '2', '--warmup_epochs', '1',
+        '--batch_size', '4', '--extract_batch_size', '2'] + list(extra))
+    os.makedirs(args.output_dir, exist_ok=True)
+    main_linprobe.main(args)
+    return os.path.getmtime(root / 'out' / 'features' / 'train' / 'features.f16')
+
+
+def test_end_to_end_and_cache(image_folder):
+    first = _run(image_folder)
+    assert os.path.exists(image_folder / 'out' / 'linear_head.pth')
+    with open(image_folder / 'out' / 'log.txt') as f:
+        assert len(f.readlines()) == 2
+
+    assert _run(image_folder) == first  # same settings: reused
+    assert _run(image_folder, '--pool', 'mean') != first  # other pooling: extracted again
+
+
+def test_other_data_path_is_extracted_again(image_folder):
+    first = _run(image_folder)
+    shutil.copytree(image_folder / 'data', image_folder / 'data2')
+    assert _run(image_folder, data='data2') != first
+
+
+def test_stale_store_is_detected(image_folder):
+    _run(image_folder)
+    root = str(image_folder / 'out' / 'features' / 'train')
+    argv = ['--variant', 'models_mae', '--model', 'mae_vit_base_patch16', '--data_path', str(image_folder / 'data' / 'train')]
+    args = main_linprobe.get_args_parser().parse_args(argv + ['--input_size', '32'])
+    assert main_linprobe.stored_with(root, main_linprobe.store_meta(args))
+    args = main_linprobe.get_args_parser().parse_args(argv + ['--input_size', '48'])
+    assert not main_linprobe.stored_with(root, main_linprobe.store_meta(args))
@@ -0,0 +1,58 @@
+# Packed variable-length encoder (models_mae.forward_encoder_varlen) against
+# the padded encoder: same masks and latents at a uniform ratio, and the
+# per-sample padded reference of util/reference.py at mixed ratios.
+from functools import partial
+
+import pytest
+import torch
+import torch.nn as nn
+
+import models_mae
+from util.reference import varlen_reference
+
+pytestmark = pytest.mark.skipif(not hasattr(torch.nested, 'nested_tensor_from_jagged'),
+                                reason='needs jagged nested tensors')
+
+
+def _model():
+    torch.manual_seed(0)
+    model = models_mae.MaskedAutoencoderViT(
+        img_size=32, patch_size=8, embed_dim=64, depth=2, num_heads=4,
+        decoder_embed_dim=32, decoder_depth=1, decoder_num_heads=4,
+        mlp_ratio=4, norm_layer=partial(nn.LayerNorm, eps=1e-6))
+    return model.eval()
+
+
+@torch.no_grad()
+def test_uniform_ratio_matches_padded():
+    model = _model()
+    imgs = torch.randn(4, 3, 32, 32)
+    torch.manual_seed(1)
+    padded, mask, _ = model.forward_encoder(imgs, 0.75)
+    torch.manual_seed(1)
+    packed, mask_varlen, _, _ = model.forward_encoder_varlen(imgs, torch.full((4,), 0.75))
+    assert torch.equal(mask, mask_varlen)
+    torch.testing.assert_close(packed, padded.flatten(0, 1), atol=1e-5, rtol=1e-5)
+
+    torch.manual_seed(1)
+    loss = model(imgs, 0.75)
+    torch.manual_seed(1)
+    torch.testing.assert_close(model(imgs, torch.full((4,), 0.75)), loss, atol=1e-5, rtol=1e-5)
+
+
+@torch.no_grad()
+def test_per_sample_ratio_matches_reference():
+    model = _model()
+    imgs = torch.randn(4, 3, 32, 32)
+    ratios = torch.tensor([0.5, 0.6, 0.75, 0.9])
+    packed, mask, ids_restore, offsets = model.forward_encoder_varlen(imgs, ratios)
+    len_keep = offsets.diff() - 1
+    assert (len_keep + mask.sum(1).long() == mask.shape[1]).all()
+    assert (len_keep[:-1] > len_keep[1:]).all()  # increasing ratios keep fewer tokens
+    torch.testing.assert_close(packed, varlen_reference(model, imgs, ids_restore, offsets), atol=1e-5, rtol=1e-5)
+
+
+def test_per_sample_ratio_backward():
+    model = _model().train()
+    model(torch.randn(4, 3, 32, 32), torch.tensor([0.5, 0.6, 0.75, 0.9])).backward()
+    assert all(p.grad is not None for p in model.blocks.parameters())
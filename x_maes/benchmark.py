@@ -0,0 +1,675 @@
+# --------------------------------------------------------
+# Throughput / memory micro-benchmarks and parity checks.
+#
+# Usage: python benchmark.py <bench> [--device cpu] [--batch_size 8] ...
+# --------------------------------------------------------
+import argparse
+import time
+import weakref
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_map
+
+
+class _StorageTracker(TorchDispatchMode):
+    """Tracks the peak of live tensor storages allocated while it is active (any device)."""
+    def __init__(self):
+        super().__init__()
+        self.live = set()
+        self.current = 0
+        self.peak = 0
+
+    def _free(self, key, nbytes):
+        self.live.discard(key)
+        self.current -= nbytes
+
+    def _track(self, t):
+        if isinstance(t, torch.Tensor) and not t.is_nested:  # nested: wrapper, its values are tracked
+            storage = t.untyped_storage()
+            key = storage.data_ptr()
+            if key not in self.live and storage.nbytes() > 0:
+                self.live.add(key)
+                self.current += storage.nbytes()
+                self.peak = max(self.peak, self.current)
+                weakref.finalize(storage, self._free, key, storage.nbytes())
+        return t
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        tree_map(self._track, out)
+        return out
+
+
+def peak_memory(fn, device='cpu'):
+    """Peak bytes allocated by fn() on top of what is already live."""
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    with _StorageTracker() as tracker:
+        fn()
+    return tracker.peak
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(fn, device='cpu', warmup=2, iters=10):
+    """Average seconds per call of fn()."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.time() - start) / iters
+
+
+# --------------------------------------------------------
+# DCR: one batched encoder pass for both views
+# --------------------------------------------------------
+def _dcr_model(args):
+    import models_mae_DCR
+    model = models_mae_DCR.__dict__[args.model]()
+    # heads added by main_finetune.py --type dcr
+    model.dcr = nn.Sequential(nn.Conv2d(model.embed_dim, model.embed_dim, kernel_size=1, padding=0),
+                              nn.LeakyReLU(),
+                              nn.Conv2d(model.embed_dim, model.embed_dim, kernel_size=1, padding=0),)
+    model.mask_token_dcr = nn.Parameter(torch.zeros(1, 1, model.embed_dim))
+    return model.to(args.device)
+
+
+def _dcr_two_pass(model, imgs, mask_ratio=0.75):
+    # reference: one encoder call per view
+    img1, img2, mask1, mask2 = model.crop_img(imgs)
+    latent1, mask_encoder1, ids_restore1 = model.forward_encoder(img1, mask_ratio)
+    pred = model.forward_decoder(latent1, ids_restore1)
+    latent2, _, ids_restore2 = model.forward_encoder(img2, mask_ratio)
+    loss_DCR = model.forward_DCR_loss(torch.cat([latent1, latent2]), mask1, mask2,
+                                      torch.cat([ids_restore1, ids_restore2]))
+    return model.forward_loss(imgs, pred, mask_encoder1) + loss_DCR
+
+
+def bench_dcr(args):
+    model = _dcr_model(args)
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+
+    def step(fn):
+        def run():
+            model.zero_grad(set_to_none=True)
+            fn(imgs).backward()
+        return run
+
+    for name, fn in [('two encoder passes', lambda x: _dcr_two_pass(model, x)),
+                     ('batched encoder pass', model)]:
+        t = benchmark(step(fn), args.device, args.warmup, args.iters)
+        print('%-22s %8.1f ms/it  %8.1f img/s' % (name, t * 1000, args.batch_size / t))
+
+
+# --------------------------------------------------------
+# Gumbel quantizer: sparse lookup vs dense one-hot contraction
+# --------------------------------------------------------
+def _gumbel_dense(quantizer, z):
+    # reference: the dense one-hot formulation
+    hard = quantizer.straight_through if quantizer.training else True
+    logits = quantizer.proj(z)
+    soft_one_hot = F.gumbel_softmax(logits, tau=quantizer.temperature, dim=2, hard=hard)
+    z_q = torch.einsum("b h n, n d -> b h d", soft_one_hot, quantizer.embed.weight)
+    qy = F.softmax(logits, dim=2)
+    diff = quantizer.kl_weight * torch.sum(qy * torch.log(qy * quantizer.codebook_size + 1e-10), dim=2).mean()
+    return z_q, diff, soft_one_hot.argmax(dim=2)
+
+
+def bench_codebook(args):
+    from models_mae_CodeBook import GumbelQuantizer
+    z = torch.randn(args.batch_size, 197, 768, device=args.device)
+    print('%-6s %-22s %10s %12s' % ('K', 'path', 'ms/it', 'peak MB'))
+    for K in [1024, 2048, 4096, 8192, 16384]:
+        quantizer = GumbelQuantizer(K, 768, 768, straight_through=True).to(args.device)
+        chunked = GumbelQuantizer(K, 768, 768, straight_through=True, chunk_size=1024).to(args.device)
+        chunked.load_state_dict(quantizer.state_dict())
+        paths = []
+        for mode in ['eval', 'train']:
+            for name, q, fn in [('dense', quantizer, lambda q=quantizer: _gumbel_dense(q, z)),
+                                ('sparse', quantizer, lambda q=quantizer: q(z)),
+                                ('sparse+chunk', chunked, lambda q=chunked: q(z))]:
+                if mode == 'eval':
+                    run = lambda fn=fn: torch.no_grad()(fn)()
+                else:
+                    run = lambda fn=fn: fn()[0].sum().backward()
+                paths.append(('%s/%s' % (mode, name), q, mode, run))
+        for name, q, mode, run in paths:
+            q.train(mode == 'train')
+            t = benchmark(run, args.device, args.warmup, args.iters)
+            mem = peak_memory(run, args.device)
+            print('%-6d %-22s %10.1f %12.1f' % (K, name, t * 1000, mem / 2**20))
+
+
+# --------------------------------------------------------
+# DiffAugment: fused color / gather translation / box cutout
+# --------------------------------------------------------
+def _same_seed(fn_a, fn_b, x, seed):
+    torch.manual_seed(seed)
+    a = fn_a(x)
+    torch.manual_seed(seed)
+    b = fn_b(x)
+    return (a - b).abs().max().item()
+
+
+def bench_diffaug(args):
+    from util import diffaug
+    from util.reference import color_sequential, translation_meshgrid, cutout_meshgrid
+    x = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    pairs = [
+        ('color', color_sequential, diffaug.rand_color),
+        ('translation', translation_meshgrid, diffaug.rand_translation),
+        ('cutout', cutout_meshgrid, diffaug.rand_cutout),
+        ('all', lambda x: cutout_meshgrid(translation_meshgrid(color_sequential(x))),
+         lambda x: diffaug.DiffAugment(x, policy='color,translation,cutout')),
+    ]
+
+    print('%-12s %12s %12s %8s %12s %12s %10s' % (
+        'op', 'ref ms/it', 'new ms/it', 'speedup', 'ref peak MB', 'new peak MB', 'max |diff|'))
+    for name, ref, new in pairs:
+        diff = max(_same_seed(ref, new, x, args.seed + i) for i in range(5))
+        t_ref = benchmark(lambda: ref(x), args.device, args.warmup, args.iters)
+        t_new = benchmark(lambda: new(x), args.device, args.warmup, args.iters)
+        m_ref = peak_memory(lambda: ref(x), args.device)
+        m_new = peak_memory(lambda: new(x), args.device)
+        print('%-12s %12.2f %12.2f %7.2fx %12.1f %12.1f %10.2e' % (
+            name, t_ref * 1000, t_new * 1000, t_ref / t_new, m_ref / 2**20, m_new / 2**20, diff))
+
+    # distribution check with independent draws: per-sample statistics over many batches
+    def stats(fn, seed):
+        torch.manual_seed(seed)
+        out = torch.cat([fn(x) for _ in range(20)])
+        zeros = (out == 0).float().mean().item()
+        return out.mean().item(), out.std().item(), zeros
+    ref_stats = stats(pairs[-1][1], args.seed)
+    new_stats = stats(pairs[-1][2], args.seed + 1000)
+    print('independent draws  mean %.4f / %.4f  std %.4f / %.4f  zero fraction %.4f / %.4f' % (
+        ref_stats[0], new_stats[0], ref_stats[1], new_stats[1], ref_stats[2], new_stats[2]))
+
+    # gradients flow through the augmented image as before
+    xg = x.clone().requires_grad_()
+    torch.manual_seed(args.seed)
+    pairs[-1][1](xg).square().sum().backward()
+    g_ref, xg.grad = xg.grad, None
+    torch.manual_seed(args.seed)
+    pairs[-1][2](xg).square().sum().backward()
+    print('grad max |diff| %.2e' % (g_ref - xg.grad).abs().max().item())
+
+
+# --------------------------------------------------------
+# Custom attention modules: SDPA vs explicit softmax(q @ k.T) @ v
+# --------------------------------------------------------
+ATTENTION_CONFIGS = {
+    # name: (dim, heads, patch size)
+    'base': (768, 12, 16),
+    'large': (1024, 16, 16),
+    'huge': (1280, 16, 14),
+}
+
+
+def bench_attention(args):
+    from util.attention import set_fused_attn
+    from util.reference import attention_modules, attention_call
+
+    # parity: same weights and inputs, forward outputs and input / parameter gradients
+    dim, heads, _ = ATTENTION_CONFIGS['base']
+    x = torch.randn(2, 197, dim, device=args.device)
+    for name, module in attention_modules(dim, heads).items():
+        module.to(args.device)
+        results = []
+        for fused in [False, True]:
+            set_fused_attn(module, fused)
+            module.zero_grad(set_to_none=True)
+            xg = x.clone().requires_grad_()
+            out = attention_call(name, module, xg)
+            out.square().sum().backward()
+            results.append((out.detach(), xg.grad, module.qkv.weight.grad if hasattr(module, 'qkv') else module.q.weight.grad))
+        diffs = ['%.2e' % (a - b).abs().max().item() for a, b in zip(*results)]
+        print('parity %-20s out %s  grad x %s  grad w %s' % (name, *diffs))
+
+    print('%-6s %-5s %-20s %10s %10s %8s %12s %12s' % (
+        'model', 'size', 'module', 'explicit', 'sdpa', 'speedup', 'explicit MB', 'sdpa MB'))
+    for model, (dim, heads, patch) in ATTENTION_CONFIGS.items():
+        for size in [224, 448]:
+            x = torch.randn(args.batch_size, (size // patch) ** 2 + 1, dim, device=args.device)
+            for name, module in attention_modules(dim, heads).items():
+                module.to(args.device)
+
+                def run():
+                    module.zero_grad(set_to_none=True)
+                    attention_call(name, module, x.requires_grad_()).sum().backward()
+
+                times, mems = [], []
+                for fused in [False, True]:
+                    set_fused_attn(module, fused)
+                    times.append(benchmark(run, args.device, args.warmup, args.iters))
+                    mems.append(peak_memory(run, args.device))
+                print('%-6s %-5d %-20s %8.1fms %8.1fms %7.2fx %12.1f %12.1f' % (
+                    model, size, name, times[0] * 1000, times[1] * 1000, times[0] / times[1],
+                    mems[0] / 2**20, mems[1] / 2**20))
+
+
+# --------------------------------------------------------
+# Activation checkpointing: memory / speed per configuration
+# --------------------------------------------------------
+CHECKPOINT_CONFIGS = [
+    # (name, every, part)
+    ('none', 0, 'block'),
+    ('block every 1', 1, 'block'),
+    ('block every 2', 2, 'block'),
+    ('block every 4', 4, 'block'),
+    ('attn every 1', 1, 'attn'),
+    ('mlp every 1', 1, 'mlp'),
+]
+
+
+def _cae_args():
+    import argparse
+    return argparse.Namespace(decoder_depth=4, decoder_num_classes=8192, decoder_embed_dim=None,
+                              regressor_depth=4, decoder_num_heads=None, decoder_layer_scale_init_value=0.1,
+                              fix_init_weight=False, base_momentum=0.0, num_mask_patches=None,
+                              teacher_dtype=None)
+
+
+def _train_step(args):
+    """(model, step(batch_size)) for a models_mae_* or CAE model name."""
+    if args.model.startswith('cae_'):
+        import models_mae_CAE
+        cae_args = _cae_args()
+        embed_dim, heads = {'small': (384, 12), 'base': (768, 12), 'large': (1024, 16)}[args.model.split('_')[1]]
+        cae_args.decoder_embed_dim, cae_args.decoder_num_heads = embed_dim, heads
+        num_patches = (args.input_size // 16) ** 2
+        cae_args.num_mask_patches = num_patches // 2
+        model = models_mae_CAE.__dict__[args.model](args=cae_args, init_values=0.1, img_size=args.input_size)
+
+        def step(n):
+            imgs = torch.randn(n, 3, args.input_size, args.input_size, device=args.device)
+            mask = torch.rand(n, num_patches, device=args.device).argsort(dim=1) < cae_args.num_mask_patches
+            logits, latent_pred, latent_target = model(imgs, mask)
+            return logits.float().pow(2).mean() + F.mse_loss(latent_pred, latent_target)
+    else:
+        import models_mae
+        model = models_mae.__dict__[args.model](img_size=args.input_size)
+
+        def step(n):
+            return model(torch.randn(n, 3, args.input_size, args.input_size, device=args.device))
+    return model.to(args.device), step
+
+
+def bench_checkpoint(args):
+    from util.act_checkpoint import apply_activation_checkpointing
+    print('%-14s %8s %10s %10s %12s %12s %12s %10s' % (
+        'config', 'modules', 'ms/it', 'img/s', 'peak MB', 'forward MB', 'act MB / img', 'max batch'))
+    for name, every, part in CHECKPOINT_CONFIGS:
+        torch.manual_seed(args.seed)
+        model, step = _train_step(args)
+        model.train()
+        wrapped = apply_activation_checkpointing(model, every=every, part=part)
+
+        def run(n=args.batch_size):
+            model.zero_grad(set_to_none=True)
+            step(n).backward()
+
+        t = benchmark(run, args.device, args.warmup, args.iters)
+        peak = peak_memory(run, args.device)
+        # activations kept for backward grow linearly with the batch (weight gradients do not):
+        # fit the per-image cost from two forward passes and extrapolate the largest batch
+        fwd = peak_memory(lambda: step(args.batch_size), args.device)
+        fwd2 = peak_memory(lambda: step(2 * args.batch_size), args.device)
+        per_img = max(fwd2 - fwd, 1) / args.batch_size
+        fixed = max(peak - per_img * args.batch_size, 0)
+        max_batch = int((args.memory_budget * 2**20 - fixed) // per_img)
+        print('%-14s %8d %10.1f %10.1f %12.1f %12.1f %12.1f %10d' % (
+            name, len(wrapped), t * 1000, args.batch_size / t, peak / 2**20, fwd / 2**20,
+            per_img / 2**20, max_batch))
+
+
+# --------------------------------------------------------
+# Masked-mean loss: decode / build targets for the masked tokens only
+# --------------------------------------------------------
+MASKED_MEAN_VARIANTS = ('models_mae', 'models_mae_NN', 'models_mae_CodeBook', 'models_mae_DCR',
+                        'models_mae_MoCo', 'models_mae_RDA')
+
+
+def _masked_mean_model(module_name, args):
+    import importlib
+    if module_name == 'models_mae_DCR':
+        return _dcr_model(args)
+    model = importlib.import_module(module_name).__dict__[args.model](img_size=args.input_size)
+    if module_name == 'models_mae_CodeBook':
+        from models_mae_CodeBook import GumbelQuantizer
+        model.code_book = GumbelQuantizer(1024, 768, model.pos_embed.shape[-1])
+    return model.to(args.device)
+
+
+def _set_decode_masked_only(model, enabled):
+    for m in model.modules():
+        if hasattr(m, 'decode_masked_only'):
+            m.decode_masked_only = enabled
+
+
+def bench_decode_masked(args):
+    print('%-20s %-12s %10s %10s %12s %12s' % ('variant', 'decode', 'ms/it', 'img/s', 'peak MB', 'loss diff'))
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    for module_name in MASKED_MEAN_VARIANTS:
+        torch.manual_seed(args.seed)
+        model = _masked_mean_model(module_name, args)
+
+        def run():
+            model.zero_grad(set_to_none=True)
+            torch.manual_seed(args.seed)  # same masks in both modes
+            loss = model(imgs)
+            loss = loss[0] if isinstance(loss, tuple) else loss
+            loss.backward()
+            return loss.detach()
+
+        losses = {}
+        for name, enabled in [('all tokens', False), ('masked only', True)]:
+            _set_decode_masked_only(model, enabled)
+            losses[name] = run()
+            t = benchmark(run, args.device, args.warmup, args.iters)
+            mem = peak_memory(run, args.device)
+            print('%-20s %-12s %10.1f %10.1f %12.1f %12.2e' % (
+                module_name, name, t * 1000, args.batch_size / t, mem / 2**20,
+                (losses[name] - losses['all tokens']).abs().item()))
+
+
+# --------------------------------------------------------
+# Reconstruction targets: einsum patchify + two-pass norm vs unfold view + var_mean
+# --------------------------------------------------------
+def _targets_reference(imgs, p, ids=None):
+    # reference: patchify all L patches, then mean / var in separate passes
+    N, h = imgs.shape[0], imgs.shape[2] // p
+    x = torch.einsum('nchpwq->nhwpqc', imgs.reshape(N, 3, h, p, h, p)).reshape(N, h * h, p * p * 3)
+    mean = x.mean(dim=-1, keepdim=True)
+    var = x.var(dim=-1, keepdim=True)
+    x = (x - mean) / (var + 1.e-6)**.5
+    if ids is not None:
+        x = torch.gather(x, 1, ids.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+    return x
+
+
+def bench_targets(args):
+    from util.masking import masked_ids
+    from util.targets import patch_targets
+    p = 16
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    L = (args.input_size // p) ** 2
+    mask = torch.rand(args.batch_size, L, device=args.device).argsort(dim=1) >= L // 4
+    ids = masked_ids(mask, L - L // 4)
+    print('%-28s %10s %12s %12s' % ('targets (norm_pix)', 'ms/it', 'peak MB', 'max diff'))
+    for name, ref, fn in [
+            ('all patches / reference', None, lambda: _targets_reference(imgs, p)),
+            ('all patches / view', lambda: _targets_reference(imgs, p), lambda: patch_targets(imgs, p, norm_pix=True)),
+            ('masked 75% / reference', None, lambda: _targets_reference(imgs, p, ids)),
+            ('masked 75% / view', lambda: _targets_reference(imgs, p, ids),
+             lambda: patch_targets(imgs, p, ids, norm_pix=True))]:
+        diff = (fn() - ref()).abs().max().item() if ref is not None else 0.
+        t = benchmark(fn, args.device, args.warmup, args.iters)
+        mem = peak_memory(fn, args.device)
+        print('%-28s %10.2f %12.1f %12.2e' % (name, t * 1000, mem / 2**20, diff))
+
+
+# --------------------------------------------------------
+# MAE decoder: self-attention over 1 + L tokens vs masked queries cross-attending
+# --------------------------------------------------------
+DECODER_CONFIGS = [
+    ('self', dict()),
+    ('self / masked head', dict(decode_masked_only=True)),
+    ('cross', dict(decoder_type='cross')),
+    ('cross + query self-attn', dict(decoder_type='cross', decoder_query_self_attn=True)),
+    ('self / decode 50%', dict(decode_ratio=0.5)),
+    ('self / decode 25%', dict(decode_ratio=0.25)),
+    ('cross / decode 50%', dict(decoder_type='cross', decode_ratio=0.5)),
+]
+
+
+def bench_decoder(args):
+    import models_mae
+    from torch.utils.flop_counter import FlopCounterMode
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    print('%-26s %10s %14s %10s %10s %12s' % (
+        'decoder', 'params M', 'dec GFLOP/img', 'ms/it', 'img/s', 'peak MB'))
+    for name, kwargs in DECODER_CONFIGS:
+        torch.manual_seed(args.seed)
+        model = models_mae.__dict__[args.model](img_size=args.input_size, **kwargs).to(args.device)
+        decoder = [m for n, m in model.named_children() if n.startswith('decoder') or n == 'cross_decoder']
+        params = sum(p.numel() for m in decoder for p in m.parameters()) / 1e6
+
+        latent, mask, ids_restore = model.forward_encoder(imgs, 0.75)
+        with FlopCounterMode(display=False) as counter:
+            model.forward_decoder(latent, ids_restore)
+        gflops = counter.get_total_flops() / args.batch_size / 1e9
+
+        def run():
+            model.zero_grad(set_to_none=True)
+            model(imgs).backward()
+
+        t = benchmark(run, args.device, args.warmup, args.iters)
+        mem = peak_memory(run, args.device)
+        print('%-26s %10.1f %14.2f %10.1f %10.1f %12.1f' % (
+            name, params, gflops, t * 1000, args.batch_size / t, mem / 2**20))
+
+
+# --------------------------------------------------------
+# Progressive resolution: train step cost per input size of one model
+# --------------------------------------------------------
+RESOLUTIONS = (128, 160, 192, 224)
+
+
+def bench_patch_input(args):
+    import models_mae
+    from util.targets import normalize_uint8_patches, patch_view
+    torch.manual_seed(args.seed)
+    model = models_mae.__dict__[args.model](img_size=args.input_size).to(args.device)
+    p = model.patch_embed.patch_size[0]
+    mean = torch.tensor([0.485, 0.456, 0.406], device=args.device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device=args.device).view(1, 3, 1, 1)
+    pixels = torch.randint(0, 256, (args.batch_size, 3, args.input_size, args.input_size),
+                           dtype=torch.uint8, device=args.device)
+    imgs = (pixels.float() / 255 - mean) / std  # ToTensor + Normalize
+    patches = patch_view(pixels, p).reshape(args.batch_size, -1, p * p * 3)  # PatchifyTransform
+
+    with torch.no_grad():
+        torch.manual_seed(args.seed)
+        loss = model(imgs)
+        torch.manual_seed(args.seed)
+        print('|loss diff| image vs patch input: %.2e' % (loss - model(normalize_uint8_patches(patches))).abs().item())
+    print('loader bytes / sample: image %d, patches %d' % (imgs[0].nbytes, patches[0].nbytes))
+
+    print('%-14s %10s %10s %12s' % ('train step', 'ms/it', 'img/s', 'peak MB'))
+    for name, fn in (('image', lambda: model(imgs)),
+                     ('patch input', lambda: model(normalize_uint8_patches(patches)))):
+        def run():
+            model.zero_grad(set_to_none=True)
+            fn().backward()
+
+        t = benchmark(run, args.device, args.warmup, args.iters)
+        print('%-14s %10.1f %10.1f %12.1f' % (name, t * 1000, args.batch_size / t, peak_memory(run, args.device) / 2**20))
+
+
+def bench_resolution(args):
+    import models_mae
+    torch.manual_seed(args.seed)
+    model = models_mae.__dict__[args.model](img_size=args.input_size).to(args.device)
+    print('model built at %dpx' % args.input_size)
+    print('%-8s %8s %10s %10s %12s %10s' % ('size', 'tokens', 'ms/it', 'img/s', 'peak MB', 'vs base'))
+    rows = {}
+    for size in sorted(set(RESOLUTIONS + (args.input_size,))):
+        imgs = torch.randn(args.batch_size, 3, size, size, device=args.device)
+
+        def run():
+            model.zero_grad(set_to_none=True)
+            model(imgs).backward()
+
+        rows[size] = (benchmark(run, args.device, args.warmup, args.iters), peak_memory(run, args.device))
+    for size, (t, mem) in rows.items():
+        print('%-8d %8d %10.1f %10.1f %12.1f %9.2fx' % (
+            size, (size // model.patch_embed.patch_size[0]) ** 2, t * 1000, args.batch_size / t, mem / 2**20,
+            rows[args.input_size][0] / t))
+
+
+VARLEN_RATIOS = (0.5, 0.6, 0.75, 0.9)
+
+
+def bench_varlen(args):
+    import models_mae
+    from util.reference import varlen_reference
+    torch.manual_seed(args.seed)
+    model = models_mae.__dict__[args.model](img_size=args.input_size).to(args.device)
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    uniform = torch.full((args.batch_size,), 0.75, device=args.device)
+    ratios = torch.tensor(VARLEN_RATIOS, device=args.device).repeat(args.batch_size)[:args.batch_size]
+
+    model.eval()
+    with torch.no_grad():
+        torch.manual_seed(args.seed)
+        padded, mask, _ = model.forward_encoder(imgs, 0.75)
+        torch.manual_seed(args.seed)
+        packed, mask_varlen, _, _ = model.forward_encoder_varlen(imgs, uniform)
+        print('uniform 0.75: max |latent diff| %.2e, masks equal: %s' % (
+            (padded.flatten(0, 1) - packed).abs().max().item(), bool((mask == mask_varlen).all())))
+        torch.manual_seed(args.seed)
+        loss = model(imgs, 0.75)
+        torch.manual_seed(args.seed)
+        print('uniform 0.75: |loss diff| %.2e' % (loss - model(imgs, uniform)).abs().item())
+
+        packed, mask, ids_restore, offsets = model.forward_encoder_varlen(imgs, ratios)
+        reference = varlen_reference(model, imgs, ids_restore, offsets)
+        print('per-sample %s: max |latent diff| vs per-sample padded %.2e, masked per sample %s' % (
+            VARLEN_RATIOS, (reference - packed).abs().max().item(), mask.sum(1).long().tolist()[:len(VARLEN_RATIOS)]))
+
+    # the padded alternative keeps as many tokens as the least-masked sample
+    model.train()
+    print('%-28s %10s %10s %12s' % ('train step', 'ms/it', 'img/s', 'peak MB'))
+    for name, mask_ratio in (('padded (ratio %.2f)' % min(VARLEN_RATIOS), min(VARLEN_RATIOS)),
+                             ('packed (per-sample)', ratios)):
+        def run():
+            model.zero_grad(set_to_none=True)
+            model(imgs, mask_ratio).backward()
+
+        t = benchmark(run, args.device, args.warmup, args.iters)
+        print('%-28s %10.1f %10.1f %12.1f' % (name, t * 1000, args.batch_size / t, peak_memory(run, args.device) / 2**20))
+
+
+# --------------------------------------------------------
+# Export: eager vs TorchScript / ONNX Runtime encoder latency on CPU
+# --------------------------------------------------------
+def bench_export(args):
+    import os
+    import tempfile
+    from util.export import ExportEncoder, export_onnx, export_torchscript
+    from util.features import build_model, encoder_tokens, pool_tokens
+    variant = 'models_mae_CAE' if args.model.startswith('cae_') else args.variant
+    torch.manual_seed(args.seed)
+    model = build_model(variant, args.model, img_size=args.input_size).eval()
+    module = ExportEncoder(model, 'cls').eval()
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+
+    runs = [('eager (encoder_tokens)', lambda: pool_tokens(encoder_tokens(model, imgs), 'cls')),
+            ('eager (ExportEncoder)', lambda: module(imgs))]
+    scripted = export_torchscript(module, imgs[:2])  # traced at another batch size than benchmarked
+    runs.append(('torchscript', lambda: scripted(imgs)))
+    try:
+        import onnxruntime
+        path = os.path.join(tempfile.mkdtemp(), 'encoder.onnx')
+        export_onnx(module, imgs[:2], path)
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        feed = {'imgs': imgs.numpy()}
+        runs.append(('onnxruntime', lambda: torch.from_numpy(session.run(None, feed)[0])))
+    except ImportError:
+        print('onnxruntime not installed: skipping the ONNX row')
+
+    with torch.no_grad():
+        reference = runs[0][1]()
+        print('%s / %s, batch %d, %d threads' % (variant, args.model, args.batch_size, torch.get_num_threads()))
+        print('%-24s %12s %10s %10s %10s' % ('encoder', 'max |diff|', 'ms/it', 'img/s', 'speedup'))
+        base = None
+        for name, fn in runs:
+            diff = (fn() - reference).abs().max().item()
+            t = benchmark(fn, 'cpu', args.warmup, args.iters)
+            base = base or t
+            print('%-24s %12.2e %10.1f %10.1f %9.2fx' % (name, diff, t * 1000, args.batch_size / t, base / t))
+
+
+QUANTIZE_MODELS = {
+    'models_mae_CAE': ('cae_small_patch16_224_8k_vocab', 'cae_base_patch16_224_8k_vocab',
+                       'cae_large_patch16_224_8k_vocab'),
+    'default': ('mae_vit_base_patch16_dec512d8b', 'mae_vit_large_patch16_dec512d8b',
+                'mae_vit_huge_patch14_dec512d8b'),
+}
+
+
+def bench_quantize(args):
+    from util.export import ExportEncoder, model_size_mb, quantize_dynamic_int8
+    from util.features import build_model
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    print('%s, batch %d, %d threads' % (args.variant, args.batch_size, torch.get_num_threads()))
+    print('%-34s %6s %10s %10s %10s %10s %12s' % ('encoder', 'dtype', 'size MB', 'ms/it', 'img/s', 'speedup', 'min cosine'))
+    for name in QUANTIZE_MODELS.get(args.variant, QUANTIZE_MODELS['default']):
+        torch.manual_seed(args.seed)
+        model = build_model(args.variant, name, img_size=args.input_size).eval()
+        fp32 = ExportEncoder(model, 'cls').eval()
+        int8 = quantize_dynamic_int8(fp32)
+        with torch.no_grad():
+            reference = fp32(imgs)
+            base = None
+            for dtype, module in (('fp32', fp32), ('int8', int8)):
+                cosine = F.cosine_similarity(module(imgs), reference, dim=1).min().item()
+                t = benchmark(lambda: module(imgs), 'cpu', args.warmup, args.iters)
+                base = base or t
+                print('%-34s %6s %10.1f %10.1f %10.1f %9.2fx %12.4f' % (
+                    name, dtype, model_size_mb(module), t * 1000, args.batch_size / t, base / t, cosine))
+
+
+BENCHMARKS = {
+    'attention': bench_attention,
+    'checkpoint': bench_checkpoint,
+    'codebook': bench_codebook,
+    'dcr': bench_dcr,
+    'export': bench_export,
+    'decode_masked': bench_decode_masked,
+    'decoder': bench_decoder,
+    'diffaug': bench_diffaug,
+    'patch_input': bench_patch_input,
+    'quantize': bench_quantize,
+    'resolution': bench_resolution,
+    'targets': bench_targets,
+    'varlen': bench_varlen,
+}
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('x-maes benchmarks', add_help=False)
+    parser.add_argument('bench', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--model', default='mae_vit_base_patch16', type=str)
+    parser.add_argument('--variant', default='models_mae', type=str,
+                        help='model module of --model for export (cae_* models use models_mae_CAE) and quantize')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--memory_budget', default=16384, type=int,
+                        help='MB available for activations / gradients, used to suggest the largest batch')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    torch.manual_seed(args.seed)
+    BENCHMARKS[args.bench](args)
@@ -10,22 +10,28 @@
 # --------------------------------------------------------
 import math
 import sys
+import time
+from functools import partial
 from typing import Iterable
 
 import torch
 
 import util.misc as misc
 import util.lr_sched as lr_sched
+from util.diffaug import DiffAugment
+from util.teacher_server import TeacherPrefetcher
+from util.targets import normalize_uint8_patches
 
 
 def train_one_epoch(model: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler,
                     log_writer=None,
-                    args=None):
+                    args=None, teacher_server=None):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    metric_logger.add_meter('time_model', misc.SmoothedValue(fmt='{avg:.4f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 20
 
@@ -36,16 +42,52 @@ def train_one_epoch(model: torch.nn.Module,
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    # codebook monitoring (models with a GumbelQuantizer `code_book`)
+    code_book = getattr(getattr(model, 'module', model), 'code_book', None)
+    if not hasattr(code_book, 'codebook_stats'):
+        code_book = None
+    codebook_log_freq = args.codebook_log_freq
+
+    # batched DiffAugment on `device` before the model ('worker' runs it in the data loader instead)
+    augment = None
+    if args.diffaug_stage == 'device' and args.diffaug_policy:
+        augment = partial(DiffAugment, policy=args.diffaug_policy)
+
+    model_kwargs = {}
+    if teacher_server is not None:
+        # the teacher runs out of process one batch ahead and needs the augmented views,
+        # so augmentation happens in the prefetcher (and is counted as data time)
+        data_loader = TeacherPrefetcher(data_loader, teacher_server, device, augment=augment)
+        augment = None
+    if augment is not None:
+        metric_logger.add_meter('time_aug', misc.SmoothedValue(fmt='{avg:.4f}'))
+
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        samples = batch[0]
+        if isinstance(samples, (list, tuple)):
+            # (images, pixel targets built by util/targets.PatchTargetTransform)
+            samples, target = samples
+            model_kwargs['target'] = target.to(device, non_blocking=True)
+        if teacher_server is not None:
+            model_kwargs['teacher_target'] = batch[2].to(device, non_blocking=True)
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
             lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
 
         samples = samples.to(device, non_blocking=True)
+        if samples.dtype == torch.uint8:
+            # pre-patchified input (util/targets.PatchifyTransform)
+            samples = normalize_uint8_patches(samples)
 
-        with torch.cuda.amp.autocast():
-            loss = model(samples, mask_ratio=args.mask_ratio)
+        if augment is not None:
+            start = time.time()
+            samples = augment(samples)
+            metric_logger.update(time_aug=time.time() - start)
+
+        start = time.time()
+        with misc.autocast(device, args.precision):
+            loss = model(samples, mask_ratio=args.mask_ratio, **model_kwargs)
 
         loss_value = loss.item()
 
@@ -59,13 +101,22 @@ def train_one_epoch(model: torch.nn.Module,
         if (data_iter_step + 1) % accum_iter == 0:
             optimizer.zero_grad()
 
-        torch.cuda.synchronize()
+        misc.synchronize(device)
+        metric_logger.update(time_model=time.time() - start)
 
         metric_logger.update(loss=loss_value)
 
         lr = optimizer.param_groups[0]["lr"]
         metric_logger.update(lr=lr)
 
+        if code_book is not None and codebook_log_freq > 0 and (data_iter_step + 1) % codebook_log_freq == 0:
+            code_book.sync_usage()
+            stats = code_book.codebook_stats()
+            metric_logger.update(cb_perplexity=stats['perplexity'], cb_dead=stats['dead_codes'])
+            if args.codebook_restart:
+                metric_logger.update(cb_restarted=code_book.restart_dead_codes())
+            code_book.reset_usage()
+
         loss_value_reduce = misc.all_reduce_mean(loss_value)
         if log_writer is not None and (data_iter_step + 1) % accum_iter == 0:
             """ We use epoch_1000x as the x-axis in tensorboard.
@@ -74,6 +125,9 @@ def train_one_epoch(model: torch.nn.Module,
             epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
             log_writer.add_scalar('train_loss', loss_value_reduce, epoch_1000x)
             log_writer.add_scalar('lr', lr, epoch_1000x)
+            if 'cb_perplexity' in metric_logger.meters:
+                log_writer.add_scalar('codebook_perplexity', metric_logger.cb_perplexity.value, epoch_1000x)
+                log_writer.add_scalar('codebook_dead', metric_logger.cb_dead.value, epoch_1000x)
 
 
     # gather the stats from all processes
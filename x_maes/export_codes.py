@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# Export the discrete codes of a trained codebook model
+# (encoder + GumbelQuantizer) for a whole dataset.
+#
+# python export_codes.py --resume checkpoint.pth --data_path <images> --output_dir <codes>
+# --------------------------------------------------------
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+
+import util.misc as misc
+from util.code_store import CodeStoreWriter
+
+import models_mae_CodeBook as models_mae
+from models_mae_CodeBook import GumbelQuantizer
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE codebook export', add_help=False)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--model', default='mae_vit_base_patch16', type=str, metavar='MODEL',
+                        help='Name of model to export')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size')
+    parser.add_argument('--codebook_size', default=1024, type=int)
+    parser.add_argument('--codebook_dim', default=768, type=int)
+    parser.add_argument('--resume', default='',
+                        help='checkpoint with the trained codebook model')
+    parser.add_argument('--data_path', default='/datasets01/imagenet_full_size/061417/', type=str,
+                        help='dataset path (ImageFolder layout)')
+    parser.add_argument('--output_dir', default='./output_codes',
+                        help='where to write codes.u16 / index.json / codebook.pth')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision (default: fp16 on cuda, fp32 otherwise)')
+    parser.add_argument('--device', default='cuda',
+                        help='device to use for the export')
+    parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--pin_mem', action='store_true')
+    parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
+    parser.set_defaults(pin_mem=True)
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    args.precision = misc.resolve_precision(args.precision, device)
+
+    transform = transforms.Compose([
+        transforms.Resize(int(args.input_size * 256 / 224), interpolation=3),
+        transforms.CenterCrop(args.input_size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=0.5, std=0.5)])
+    dataset = datasets.ImageFolder(args.data_path, transform=transform)
+    print(dataset)
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset, sampler=torch.utils.data.SequentialSampler(dataset),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=False,
+    )
+
+    model = models_mae.__dict__[args.model]()
+    model.code_book = GumbelQuantizer(args.codebook_size, args.codebook_dim, model.pos_embed.shape[-1])
+    misc.load_model(args=args, model_without_ddp=model)
+    model.to(device)
+    model.eval()
+
+    writer = CodeStoreWriter(args.output_dir, len(dataset), model.patch_embed.num_patches, args.codebook_size)
+    print("Writing %d x %d uint16 codes (%d bytes per image) to %s" % (
+        len(dataset), model.patch_embed.num_patches, model.patch_embed.num_patches * 2, args.output_dir))
+
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    start_time = time.time()
+    with torch.inference_mode():
+        for samples, _ in metric_logger.log_every(data_loader, 20, 'Export:'):
+            samples = samples.to(device, non_blocking=True)
+            with misc.autocast(device, args.precision):
+                codes = model.forward_codes(samples)
+            writer.write(codes)
+
+    writer.close(samples=[(str(Path(p).relative_to(args.data_path)), t) for p, t in dataset.samples],
+                 classes=dataset.classes, embed_weight=model.code_book.embed.weight)
+    total_time = time.time() - start_time
+    print('Exported %d images in %.1fs (%.1f img/s)' % (len(dataset), total_time, len(dataset) / total_time))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,75 @@
+# --------------------------------------------------------
+# Export the encoder of a pretrained model (any variant) for serving:
+# TorchScript (traced + frozen) and / or ONNX, dynamic batch axis,
+# fixed input size (util/export.py).
+#
+# python export_encoder.py --variant models_mae_CAE --model cae_base_patch16_224_8k_vocab \
+#     --resume checkpoint.pth --output_dir <export> --pool cls
+# --------------------------------------------------------
+import argparse
+import json
+import os
+
+import torch
+
+from util.features import VARIANTS, POOLS, load_encoder
+from util.export import ExportEncoder, export_torchscript, export_onnx
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE encoder export', add_help=False)
+    parser.add_argument('--variant', default='models_mae_CodeBook', choices=VARIANTS,
+                        help='model module of the checkpoint')
+    parser.add_argument('--model', default='mae_vit_base_patch16_dec512d8b', type=str, metavar='MODEL',
+                        help='Name of model in --variant')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size (fixed in the exported graphs)')
+    parser.add_argument('--pool', default='cls', choices=POOLS,
+                        help='cls token, mean of the patch tokens, or all tokens [T, D] per image')
+    parser.add_argument('--resume', default='',
+                        help='pretraining checkpoint')
+    parser.add_argument('--formats', default='torchscript,onnx', type=str,
+                        help='comma separated: torchscript (encoder.pt), onnx (encoder.onnx, needs the onnx package)')
+    parser.add_argument('--opset', default=17, type=int,
+                        help='ONNX opset version')
+    parser.add_argument('--output_dir', default='./output_export',
+                        help='where to write the exported encoders and export.json')
+    return parser
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    model = load_encoder(args)
+    module = ExportEncoder(model, args.pool).eval()
+
+    example = torch.randn(2, 3, args.input_size, args.input_size)
+    check = torch.randn(3, 3, args.input_size, args.input_size)  # another batch size than traced
+    with torch.no_grad():
+        expected = module(check)
+    outputs = {}
+    for fmt in args.formats.split(','):
+        if fmt == 'torchscript':
+            path = os.path.join(args.output_dir, 'encoder.pt')
+            scripted = export_torchscript(module, example, path)
+            with torch.no_grad():
+                print('TorchScript: %s, max |diff| vs eager at batch 3: %.2e' % (
+                    path, (scripted(check) - expected).abs().max().item()))
+        elif fmt == 'onnx':
+            path = os.path.join(args.output_dir, 'encoder.onnx')
+            export_onnx(module, example, path, opset_version=args.opset)
+            print('ONNX: %s (opset %d)' % (path, args.opset))
+        else:
+            raise ValueError('unknown export format %s' % fmt)
+        outputs[fmt] = os.path.basename(path)
+
+    with open(os.path.join(args.output_dir, 'export.json'), 'w') as f:
+        json.dump({'variant': args.variant, 'model': args.model, 'checkpoint': args.resume, 'pool': args.pool,
+                   'input_shape': ['batch', 3, args.input_size, args.input_size],
+                   'output_shape': ['batch'] + list(expected.shape[1:]),
+                   'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225], 'files': outputs}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
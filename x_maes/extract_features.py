@@ -0,0 +1,115 @@
+# --------------------------------------------------------
+# Extract encoder features of a pretrained model (any variant) for a whole
+# dataset into a memory-mapped fp16 feature store (util/features.py).
+#
+# python extract_features.py --variant models_mae_NN --model mae_vit_base_patch16_dec512d8b \
+#     --resume checkpoint.pth --data_path <images> --output_dir <features> --pool cls
+# --------------------------------------------------------
+import argparse
+import resource
+import time
+from pathlib import Path
+
+import torch
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+
+import util.misc as misc
+from util.features import VARIANTS, POOLS, load_encoder, store_meta, encoder_tokens, pool_tokens, \
+    DevicePrefetcher, FeatureStoreWriter
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE feature extraction', add_help=False)
+    parser.add_argument('--batch_size', default=512, type=int)
+    parser.add_argument('--variant', default='models_mae_CodeBook', choices=VARIANTS,
+                        help='model module of the checkpoint')
+    parser.add_argument('--model', default='mae_vit_base_patch16_dec512d8b', type=str, metavar='MODEL',
+                        help='Name of model in --variant')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size')
+    parser.add_argument('--pool', default='cls', choices=POOLS,
+                        help='cls token, mean of the patch tokens, or all tokens [T, D] per image')
+    parser.add_argument('--resume', default='',
+                        help='pretraining checkpoint')
+    parser.add_argument('--data_path', default='/datasets01/imagenet_full_size/061417/', type=str,
+                        help='dataset path (ImageFolder layout)')
+    parser.add_argument('--output_dir', default='./output_features',
+                        help='where to write features.f16 / index.json')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision (default: fp16 on cuda, fp32 otherwise)')
+    parser.add_argument('--device', default='cuda',
+                        help='device to use for the extraction')
+    parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--pin_mem', action='store_true')
+    parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
+    parser.set_defaults(pin_mem=True)
+    return parser
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # peak RSS, KB on Linux
+
+
+def extract(model, args):
+    """Features of every image of args.data_path into args.output_dir; returns (img/s, peak memory MB)."""
+    device = torch.device(args.device)
+    transform = transforms.Compose([
+        transforms.Resize(int(args.input_size * 256 / 224), interpolation=3),
+        transforms.CenterCrop(args.input_size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+    dataset = datasets.ImageFolder(args.data_path, transform=transform)
+    print(dataset)
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset, sampler=torch.utils.data.SequentialSampler(dataset),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=False,
+        persistent_workers=args.num_workers > 0,
+    )
+
+    model.eval()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    writer = FeatureStoreWriter(args.output_dir, len(dataset))
+
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    metric_logger.add_meter('time_model', misc.SmoothedValue(fmt='{avg:.4f}'))
+    model_time = 0.
+    start_time = time.time()
+    with torch.inference_mode():
+        for samples, _ in metric_logger.log_every(DevicePrefetcher(data_loader, device), 20, 'Extract:'):
+            start = time.time()
+            with misc.autocast(device, args.precision):
+                features = pool_tokens(encoder_tokens(model, samples), args.pool)
+            misc.synchronize(device)
+            model_time += time.time() - start
+            metric_logger.update(time_model=time.time() - start)
+            writer.write(features)
+
+    writer.close(samples=[(str(Path(p).relative_to(args.data_path)), t) for p, t in dataset.samples],
+                 classes=dataset.classes, **store_meta(args))
+    total_time = time.time() - start_time
+    peak = peak_memory_mb(device)
+    print('Extracted %s features of %d images to %s' % (tuple(writer.features.shape[1:]), len(dataset),
+                                                         args.output_dir))
+    print('%.1fs: %.1f img/s end to end, %.1f img/s in the encoder, peak memory %.0f MB' % (
+        total_time, len(dataset) / total_time, len(dataset) / model_time, peak))
+    return len(dataset) / total_time, peak
+
+
+def main(args):
+    args.precision = misc.resolve_precision(args.precision, torch.device(args.device))
+    extract(load_encoder(args).to(args.device), args)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -28,7 +28,13 @@ from timm.models.vision_transformer import PatchEmbed, Block, Mlp
 import timm.optim.optim_factory as optim_factory
 
 import util.misc as misc
+from util.act_checkpoint import apply_activation_checkpointing
+from util.attention import set_fused_attn
+from util.compile import compile_model, compile_times, setup_compile_cache, save_compile_cache
+from util.diffaug import DiffAugmentTransform
+from util.targets import PatchTargetTransform
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
+from util.frozen import frozen_memory_report
 
 import models_mae_CodeBook as models_mae  # TODO: base model
 
@@ -58,6 +64,24 @@ def get_args_parser():
     parser.add_argument('--norm_pix_loss', action='store_true',
                         help='Use (per-patch) normalized pixels as targets for computing loss')
     parser.set_defaults(norm_pix_loss=False)
+    parser.add_argument('--decode_masked_only', action='store_true',
+                        help='Run decoder_norm / decoder_pred / the loss on the masked tokens only')
+    parser.add_argument('--decode_ratio', default=1., type=float,
+                        help='Fraction of the masked patches decoded and reconstructed (random subset per sample)')
+    parser.add_argument('--precompute_targets', action='store_true',
+                        help='Build the (norm_pix) pixel targets in the data loader workers')
+    parser.add_argument('--explicit_attn', action='store_true',
+                        help='Force softmax(q @ k.T) @ v instead of scaled_dot_product_attention in the custom attention modules')
+    parser.add_argument('--compile', action='store_true',
+                        help='torch.compile forward_encoder / forward_decoder / forward_loss (static shapes)')
+    parser.add_argument('--compile_mode', default=None, type=str,
+                        help='torch.compile mode (default, reduce-overhead, max-autotune)')
+    parser.add_argument('--compile_cache_dir', default='', type=str,
+                        help='persistent compile cache (default: <output_dir>/compile_cache)')
+    parser.add_argument('--ckpt_every', default=0, type=int,
+                        help='activation checkpointing of every k-th encoder / decoder / regressor block (0: off)')
+    parser.add_argument('--ckpt_part', default='block', choices=['block', 'attn', 'mlp'],
+                        help='checkpoint the whole block or only its attention / MLP sub-layer')
 
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05,
@@ -81,6 +105,8 @@ def get_args_parser():
                         help='path where to save, empty for no saving')
     parser.add_argument('--log_dir', default='./output_dir',
                         help='path where to tensorboard log')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision; fp16 uses loss scaling (default: fp16 on cuda, fp32 otherwise)')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=0, type=int)
@@ -98,6 +124,20 @@ def get_args_parser():
                         help='type of finetuning')
     parser.add_argument('--resume_add', default='',
                         help='resume from checkpoint')
+
+    # codebook monitoring
+    parser.add_argument('--codebook_log_freq', default=100, type=int,
+                        help='iterations between codebook perplexity / dead-code reports (0 to disable)')
+    parser.add_argument('--codebook_restart', action='store_true',
+                        help='re-initialize dead codes from recent encoder outputs at every report')
+    parser.add_argument('--codebook_reservoir', default=4096, type=int,
+                        help='number of recent encoder outputs kept for restarting dead codes')
+
+    # DiffAugment (training only)
+    parser.add_argument('--diffaug_policy', default='color,translation,cutout', type=str,
+                        help='comma separated DiffAugment ops (color, translation, cutout); empty to disable')
+    parser.add_argument('--diffaug_stage', default='device', choices=['device', 'worker'],
+                        help='run DiffAugment batched on the training device or per image in DataLoader workers')
     return parser
 
 
@@ -110,6 +150,7 @@ def main(args):
     print("{}".format(args).replace(', ', ',\n'))
 
     device = torch.device(args.device)
+    args.precision = misc.resolve_precision(args.precision, device)
 
     # fix the seed for reproducibility
     seed = args.seed + misc.get_rank()
@@ -125,6 +166,8 @@ def main(args):
         transforms.RandomHorizontalFlip(),
         transforms.ToTensor(),
         transforms.Normalize(mean=0.5, std=0.5)])
+    if args.diffaug_stage == 'worker' and args.diffaug_policy:
+        transform_train.transforms.append(DiffAugmentTransform(args.diffaug_policy))
     dataset_train = datasets.ImageFolder(
         args.data_path, transform=transform_train)
     print(dataset_train)
@@ -146,7 +189,19 @@ def main(args):
     )
 
     # define the model
-    model = models_mae.__dict__[args.model](norm_pix_loss=args.norm_pix_loss)
+    model = models_mae.__dict__[args.model](norm_pix_loss=args.norm_pix_loss,
+                                            decode_masked_only=args.decode_masked_only,
+                                            decode_ratio=args.decode_ratio)
+    if args.precompute_targets:
+        # the targets must see the final images: no DiffAugment on device after the loader
+        assert args.diffaug_stage == 'worker' or not args.diffaug_policy, \
+            '--precompute_targets needs --diffaug_stage worker'
+        transform_train.transforms.append(PatchTargetTransform(model.patch_embed.patch_size[0], args.norm_pix_loss))
+    if args.explicit_attn:
+        set_fused_attn(model, False)
+    if args.ckpt_every > 0:
+        wrapped = apply_activation_checkpointing(model, every=args.ckpt_every, part=args.ckpt_part)
+        print("Activation checkpointing (%s, every %d): %d modules" % (args.ckpt_part, args.ckpt_every, len(wrapped)))
 
     # model.to(device)
 
@@ -196,16 +251,24 @@ def main(args):
                                                  nn.Conv2d(16, 3, kernel_size=1, padding=0),)
     elif args.type == 'codebook':
         from models_mae_CodeBook import GumbelQuantizer
-        model_without_ddp.code_book = GumbelQuantizer(1024,768,768)
+        model_without_ddp.code_book = GumbelQuantizer(1024,768,768,
+                                                      reservoir_size=args.codebook_reservoir if args.codebook_restart else 0)
 
     model_without_ddp.to(device)
+    frozen_memory_report(model_without_ddp)
+
+    compile_cache_dir = args.compile_cache_dir or (os.path.join(args.output_dir, 'compile_cache') if args.output_dir else '')
+    if args.compile:
+        if compile_cache_dir:
+            setup_compile_cache(compile_cache_dir)
+        print("Compiling: %s" % ', '.join(compile_model(model_without_ddp, mode=args.compile_mode)))
 
     # following timm: set wd as 0 for bias and norm layers
     param_groups = optim_factory.add_weight_decay(
         model_without_ddp, args.weight_decay)
     optimizer = torch.optim.AdamW(param_groups, lr=args.lr, betas=(0.9, 0.95))
     print(optimizer)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=args.precision == 'fp16', device=device)
 
     print(f"Start training for {args.epochs} epochs")
     start_time = time.time()
@@ -221,6 +284,13 @@ def main(args):
                 args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
                 loss_scaler=loss_scaler, epoch=epoch)
 
+        if args.compile and epoch == args.start_epoch:
+            times = compile_times(model_without_ddp)
+            print("Compile time (first calls): %.1fs total, %s" % (
+                sum(times.values()), ', '.join('%s %.1fs' % kv for kv in times.items())))
+            if compile_cache_dir and misc.is_main_process():
+                save_compile_cache(compile_cache_dir)
+
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      'epoch': epoch, }
 
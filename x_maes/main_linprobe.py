@@ -0,0 +1,230 @@
+# --------------------------------------------------------
+# Linear probing on cached features
+#
+# The frozen encoder runs once per split (extract_features.py) into
+# <feature_dir>/{train,val}; the linear head (BatchNorm without affine +
+# Linear, as in the MAE linear probe) is then trained with LARS and the
+# half-cycle cosine lr_sched on the cached features, held on device and
+# batched by random permutation. There is no data augmentation: every
+# epoch sees the same center-cropped features.
+#
+# python main_linprobe.py --variant models_mae_CodeBook --model mae_vit_base_patch16_dec512d8b \
+#     --resume checkpoint.pth --data_path <imagenet> --output_dir <probe>
+# --------------------------------------------------------
+import argparse
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.tensorboard import SummaryWriter
+
+from timm.models.layers import trunc_normal_
+from timm.utils import accuracy
+
+import util.misc as misc
+import util.lr_sched as lr_sched
+from util.lars import LARS
+from util.features import VARIANTS, FeatureDataset, load_encoder, store_meta
+
+import extract_features
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE linear probing on cached features', add_help=False)
+    parser.add_argument('--batch_size', default=16384, type=int,
+                        help='batch size of the linear head (features are on device)')
+    parser.add_argument('--epochs', default=90, type=int)
+
+    # Model parameters
+    parser.add_argument('--variant', default='models_mae_CodeBook', choices=VARIANTS,
+                        help='model module of the checkpoint')
+    parser.add_argument('--model', default='mae_vit_base_patch16_dec512d8b', type=str, metavar='MODEL',
+                        help='Name of model in --variant')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size')
+    parser.add_argument('--pool', default='cls', choices=['cls', 'mean'],
+                        help='cls token or mean of the patch tokens')
+    parser.add_argument('--resume', default='',
+                        help='pretraining checkpoint')
+
+    # Optimizer parameters
+    parser.add_argument('--weight_decay', type=float, default=0,
+                        help='weight decay (default: 0 for linear probe following MoCo v1)')
+    parser.add_argument('--lr', type=float, default=None, metavar='LR',
+                        help='learning rate (absolute lr)')
+    parser.add_argument('--blr', type=float, default=0.1, metavar='LR',
+                        help='base learning rate: absolute_lr = base_lr * total_batch_size / 256')
+    parser.add_argument('--min_lr', type=float, default=0., metavar='LR',
+                        help='lower lr bound for cyclic schedulers that hit 0')
+    parser.add_argument('--warmup_epochs', type=int, default=10, metavar='N',
+                        help='epochs to warmup LR')
+
+    # Dataset parameters
+    parser.add_argument('--data_path', default='/datasets01/imagenet_full_size/061417/', type=str,
+                        help='dataset path with train / val (ImageFolder layout)')
+    parser.add_argument('--feature_dir', default='',
+                        help='feature store root, extracted there unless present (default: <output_dir>/features)')
+    parser.add_argument('--extract_batch_size', default=512, type=int,
+                        help='batch size of the encoder during extraction')
+    parser.add_argument('--output_dir', default='./output_dir',
+                        help='path where to save, empty for no saving')
+    parser.add_argument('--log_dir', default='./output_dir',
+                        help='path where to tensorboard log')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision of the encoder (default: fp16 on cuda, fp32 otherwise)')
+    parser.add_argument('--device', default='cuda',
+                        help='device to use for training / testing')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--pin_mem', action='store_true')
+    parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
+    parser.set_defaults(pin_mem=True)
+    return parser
+
+
+def stored_with(root, meta):
+    """Whether <root> holds a feature store extracted with exactly `meta` (see util.features.store_meta)."""
+    path = os.path.join(root, 'index.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        index = json.load(f)
+    stale = [k for k, v in meta.items() if index.get(k) != v]
+    if stale:
+        print('Feature store %s was extracted with other %s: extracting again' % (root, ', '.join(stale)))
+    return not stale
+
+
+def cached_features(args):
+    """Extract the train / val features unless already in args.feature_dir; returns the two stores."""
+    encoder = None
+    stores = []
+    for split in ('train', 'val'):
+        root = os.path.join(args.feature_dir, split)
+        extract_args = argparse.Namespace(**vars(args))
+        extract_args.data_path = os.path.join(args.data_path, split)
+        extract_args.output_dir = root
+        extract_args.batch_size = args.extract_batch_size
+        if not stored_with(root, store_meta(extract_args)):
+            if encoder is None:
+                encoder = load_encoder(args).to(args.device)
+            extract_features.extract(encoder, extract_args)
+        stores.append(FeatureDataset(root))
+    return stores
+
+
+def to_device(store, device):
+    features = torch.from_numpy(np.ascontiguousarray(store.open())).to(device)  # fp16
+    labels = torch.tensor([t for _, t in store.samples], device=device)
+    return features, labels
+
+
+def train_one_epoch(head, criterion, features, labels, optimizer, epoch, args):
+    head.train(True)
+    num_samples = features.shape[0]
+    iters = max(1, num_samples // args.batch_size)  # drop the last partial batch
+    perm = torch.randperm(num_samples, device=features.device)
+    total_loss = torch.zeros((), device=features.device)
+    for it in range(iters):
+        # we use a per iteration (instead of per epoch) lr scheduler
+        lr_sched.adjust_learning_rate(optimizer, it / iters + epoch, args)
+        idx = perm[it * args.batch_size:(it + 1) * args.batch_size]
+        loss = criterion(head(features[idx].float()), labels[idx])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.detach()
+    return {'loss': total_loss.item() / iters, 'lr': optimizer.param_groups[0]['lr']}
+
+
+@torch.no_grad()
+def evaluate(head, criterion, features, labels, chunk_size=65536):
+    head.eval()
+    output = torch.cat([head(x.float()) for x in features.split(chunk_size)])
+    acc1, acc5 = accuracy(output, labels, topk=(1, min(5, output.shape[1])))
+    return {'loss': criterion(output, labels).item(), 'acc1': acc1.item(), 'acc5': acc5.item()}
+
+
+def main(args):
+    device = torch.device(args.device)
+    args.precision = misc.resolve_precision(args.precision, device)
+    args.feature_dir = args.feature_dir or os.path.join(args.output_dir, 'features')
+    print("{}".format(args).replace(', ', ',\n'))
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    start_time = time.time()
+    train_store, val_store = cached_features(args)
+    train_features, train_labels = to_device(train_store, device)
+    val_features, val_labels = to_device(val_store, device)
+    extract_time = time.time() - start_time
+    print('Features: train %s, val %s (%.1fs to extract / load)' % (
+        tuple(train_features.shape), tuple(val_features.shape), extract_time))
+
+    embed_dim, num_classes = train_features.shape[1], len(train_store.classes)
+    # the MAE linear probe head: BatchNorm without affine, then the linear classifier
+    head = nn.Sequential(nn.BatchNorm1d(embed_dim, affine=False, eps=1e-6), nn.Linear(embed_dim, num_classes))
+    trunc_normal_(head[1].weight, std=0.01)
+    nn.init.constant_(head[1].bias, 0)
+    head.to(device)
+
+    if args.lr is None:  # only base_lr is specified
+        args.lr = args.blr * args.batch_size / 256
+    print("base lr: %.2e" % (args.lr * 256 / args.batch_size))
+    print("actual lr: %.2e" % args.lr)
+
+    optimizer = LARS(head.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    print(optimizer)
+    criterion = nn.CrossEntropyLoss()
+
+    log_writer = None
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+        log_writer = SummaryWriter(log_dir=args.log_dir)
+
+    print(f"Start training for {args.epochs} epochs")
+    probe_start = time.time()
+    max_accuracy = 0.0
+    for epoch in range(args.epochs):
+        train_stats = train_one_epoch(head, criterion, train_features, train_labels, optimizer, epoch, args)
+        test_stats = evaluate(head, criterion, val_features, val_labels)
+        max_accuracy = max(max_accuracy, test_stats['acc1'])
+        print('Epoch %d: loss %.4f, val acc1 %.2f%% acc5 %.2f%% (max acc1 %.2f%%)' % (
+            epoch, train_stats['loss'], test_stats['acc1'], test_stats['acc5'], max_accuracy))
+
+        if log_writer is not None:
+            log_writer.add_scalar('perf/test_acc1', test_stats['acc1'], epoch)
+            log_writer.add_scalar('perf/test_acc5', test_stats['acc5'], epoch)
+            log_writer.add_scalar('perf/test_loss', test_stats['loss'], epoch)
+            log_writer.add_scalar('lr', train_stats['lr'], epoch)
+
+        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                     **{f'test_{k}': v for k, v in test_stats.items()},
+                     'epoch': epoch}
+        if args.output_dir:
+            if log_writer is not None:
+                log_writer.flush()
+            with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(log_stats) + "\n")
+
+    if args.output_dir:
+        torch.save({'model': head.state_dict(), 'args': args, 'epoch': args.epochs},
+                   os.path.join(args.output_dir, 'linear_head.pth'))
+
+    probe_time = time.time() - probe_start
+    total_time_str = str(datetime.timedelta(seconds=int(time.time() - start_time)))
+    print('Probe: %d epochs in %.1fs after %.1fs of feature extraction; total time %s, max acc1 %.2f%%' % (
+        args.epochs, probe_time, extract_time, total_time_str, max_accuracy))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    main(args)
@@ -28,9 +28,23 @@ assert timm.__version__ == "0.3.2"  # version check
 import timm.optim.optim_factory as optim_factory
 
 import util.misc as misc
+from util.act_checkpoint import apply_activation_checkpointing
+from util.attention import set_fused_attn
+from util.compile import compile_model, compile_times, setup_compile_cache, save_compile_cache
+from util.diffaug import DiffAugmentTransform
+from util.targets import PatchTargetTransform, PatchifyTransform
+from util.res_sched import parse_res_schedule, input_size_at, set_input_size
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
+from util.frozen import frozen_memory_report, ignore_frozen_in_ddp
+from util.teacher_server import TeacherServer
+from util.knn import KNNMonitor
 
-import models_mae_CodeBook as models_mae
+from util.features import encoder
+
+import models_mae_CodeBook
+import models_mae_MoCo
+
+VARIANTS = {'models_mae_CodeBook': models_mae_CodeBook, 'models_mae_MoCo': models_mae_MoCo}
 
 from engine_pretrain import train_one_epoch
 
@@ -44,11 +58,16 @@ def get_args_parser():
                         help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
 
     # Model parameters
+    parser.add_argument('--variant', default='models_mae_CodeBook', choices=sorted(VARIANTS),
+                        help='model module (models_mae_MoCo has the frozen teacher used by --teacher_server)')
     parser.add_argument('--model', default='mae_vit_large_patch16', type=str, metavar='MODEL',
-                        help='Name of model to train')
+                        help='Name of model in --variant to train')
 
     parser.add_argument('--input_size', default=224, type=int,
                         help='images input size')
+    parser.add_argument('--res_schedule', default='', type=str,
+                        help='progressive resolution, start_epoch:size pairs, e.g. 0:128,20:160,40:224 '
+                             '(the model is built at --input_size)')
 
     parser.add_argument('--mask_ratio', default=0.75, type=float,
                         help='Masking ratio (percentage of removed patches).')
@@ -56,6 +75,27 @@ def get_args_parser():
     parser.add_argument('--norm_pix_loss', action='store_true',
                         help='Use (per-patch) normalized pixels as targets for computing loss')
     parser.set_defaults(norm_pix_loss=False)
+    parser.add_argument('--decode_masked_only', action='store_true',
+                        help='Run decoder_norm / decoder_pred / the loss on the masked tokens only')
+    parser.add_argument('--decode_ratio', default=1., type=float,
+                        help='Fraction of the masked patches decoded and reconstructed (random subset per sample)')
+    parser.add_argument('--precompute_targets', action='store_true',
+                        help='Build the (norm_pix) pixel targets in the data loader workers')
+    parser.add_argument('--patch_input', action='store_true',
+                        help='Load uint8 patches instead of images: the model embeds the visible patches only '
+                             'and the patches are also the targets')
+    parser.add_argument('--explicit_attn', action='store_true',
+                        help='Force softmax(q @ k.T) @ v instead of scaled_dot_product_attention in the custom attention modules')
+    parser.add_argument('--compile', action='store_true',
+                        help='torch.compile forward_encoder / forward_decoder / forward_loss (static shapes)')
+    parser.add_argument('--compile_mode', default=None, type=str,
+                        help='torch.compile mode (default, reduce-overhead, max-autotune)')
+    parser.add_argument('--compile_cache_dir', default='', type=str,
+                        help='persistent compile cache (default: <output_dir>/compile_cache)')
+    parser.add_argument('--ckpt_every', default=0, type=int,
+                        help='activation checkpointing of every k-th encoder / decoder / regressor block (0: off)')
+    parser.add_argument('--ckpt_part', default='block', choices=['block', 'attn', 'mlp'],
+                        help='checkpoint the whole block or only its attention / MLP sub-layer')
 
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05,
@@ -79,6 +119,8 @@ def get_args_parser():
                         help='path where to save, empty for no saving')
     parser.add_argument('--log_dir', default='./output_dir',
                         help='path where to tensorboard log')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision; fp16 uses loss scaling (default: fp16 on cuda, fp32 otherwise)')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=0, type=int)
@@ -101,6 +143,42 @@ def get_args_parser():
     parser.add_argument('--dist_url', default='env://',
                         help='url used to set up distributed training')
 
+    # frozen teacher (models with a `MoCo` tower), optionally out of process
+    parser.add_argument('--teacher_dtype', default='bf16', choices=['fp32', 'fp16', 'bf16'],
+                        help='storage / compute precision of the frozen teacher')
+    parser.add_argument('--teacher_server', action='store_true',
+                        help='Run the frozen teacher in a separate process, one batch ahead of the student')
+    parser.add_argument('--teacher_device', default='cpu',
+                        help='device used by the teacher server process')
+    parser.add_argument('--teacher_threads', default=0, type=int,
+                        help='CPU threads reserved for the teacher server (0: torch default)')
+
+    # codebook monitoring
+    parser.add_argument('--codebook_log_freq', default=100, type=int,
+                        help='iterations between codebook perplexity / dead-code reports (0 to disable)')
+    parser.add_argument('--codebook_restart', action='store_true',
+                        help='re-initialize dead codes from recent encoder outputs at every report')
+    parser.add_argument('--codebook_reservoir', default=4096, type=int,
+                        help='number of recent encoder outputs kept for restarting dead codes')
+
+    # online kNN monitor (main process, <knn_data_path>/train as bank, /val as queries)
+    parser.add_argument('--knn_every', default=0, type=int,
+                        help='kNN accuracy of the CLS features every K epochs (0: off)')
+    parser.add_argument('--knn_data_path', default='', type=str,
+                        help='labeled ImageFolder dataset with train / val (default: --data_path)')
+    parser.add_argument('--knn_train_samples', default=10000, type=int,
+                        help='images in the kNN bank (random subset of train, fixed)')
+    parser.add_argument('--knn_val_samples', default=2000, type=int,
+                        help='kNN queries (random subset of val, fixed)')
+    parser.add_argument('--knn_k', default=20, type=int)
+    parser.add_argument('--knn_temperature', default=0.07, type=float)
+
+    # DiffAugment (training only)
+    parser.add_argument('--diffaug_policy', default='color,translation,cutout', type=str,
+                        help='comma separated DiffAugment ops (color, translation, cutout); empty to disable')
+    parser.add_argument('--diffaug_stage', default='device', choices=['device', 'worker'],
+                        help='run DiffAugment batched on the training device or per image in DataLoader workers')
+
     return parser
 
 
@@ -111,6 +189,7 @@ def main(args):
     print("{}".format(args).replace(', ', ',\n'))
 
     device = torch.device(args.device)
+    args.precision = misc.resolve_precision(args.precision, device)
 
     # fix the seed for reproducibility
     seed = args.seed + misc.get_rank()
@@ -125,6 +204,8 @@ def main(args):
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+    if args.diffaug_stage == 'worker' and args.diffaug_policy:
+        transform_train.transforms.append(DiffAugmentTransform(args.diffaug_policy))
     dataset_train = datasets.ImageFolder(os.path.join(args.data_path, 'train'), transform=transform_train)
     print(dataset_train)
 
@@ -153,12 +234,45 @@ def main(args):
     )
     
     # define the model
-    model = models_mae.__dict__[args.model](norm_pix_loss=args.norm_pix_loss)
+    model_kwargs = {'teacher_dtype': args.teacher_dtype} if args.variant == 'models_mae_MoCo' else {}
+    model = VARIANTS[args.variant].__dict__[args.model](img_size=args.input_size,
+                                                        norm_pix_loss=args.norm_pix_loss,
+                                                        decode_masked_only=args.decode_masked_only,
+                                                        decode_ratio=args.decode_ratio, **model_kwargs)
+    assert not args.teacher_server or hasattr(model, 'MoCo'), \
+        '--teacher_server needs a model with a frozen MoCo teacher (--variant models_mae_MoCo)'
+    patch_size = encoder(model).patch_embed.patch_size[0]
+    if args.precompute_targets:
+        # the targets must see the final images: no DiffAugment on device after the loader
+        assert args.diffaug_stage == 'worker' or not args.diffaug_policy, \
+            '--precompute_targets needs --diffaug_stage worker'
+        transform_train.transforms.append(PatchTargetTransform(patch_size, args.norm_pix_loss))
+    if args.patch_input:
+        # uint8 patches instead of ToTensor + Normalize; normalized on device by the engine
+        assert not args.diffaug_policy and not args.precompute_targets and not hasattr(model, 'MoCo'), \
+            '--patch_input needs --diffaug_policy "" and no --precompute_targets / MoCo teacher'
+        transform_train.transforms[2:] = [PatchifyTransform(patch_size)]
+    res_schedule = parse_res_schedule(args.res_schedule or '0:%d' % args.input_size, patch_size)
+    # MoCo: fixed-size patch / position embeddings in the student and a 224px teacher (also behind --teacher_server)
+    assert not hasattr(model, 'MoCo') or all(size == args.input_size for _, size in res_schedule), \
+        '--res_schedule needs a model without a MoCo teacher: models_mae_MoCo runs at --input_size only'
+    if args.explicit_attn:
+        set_fused_attn(model, False)
+    if args.ckpt_every > 0:
+        wrapped = apply_activation_checkpointing(model, every=args.ckpt_every, part=args.ckpt_part)
+        print("Activation checkpointing (%s, every %d): %d modules" % (args.ckpt_part, args.ckpt_every, len(wrapped)))
 
     model.to(device)
 
     model_without_ddp = model
     print("Model = %s" % str(model_without_ddp))
+    frozen_memory_report(model_without_ddp)
+
+    compile_cache_dir = args.compile_cache_dir or (os.path.join(args.output_dir, 'compile_cache') if args.output_dir else '')
+    if args.compile:
+        if compile_cache_dir:
+            setup_compile_cache(compile_cache_dir)
+        print("Compiling: %s" % ', '.join(compile_model(model_without_ddp, mode=args.compile_mode)))
 
     eff_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
     
@@ -172,6 +286,7 @@ def main(args):
     print("effective batch size: %d" % eff_batch_size)
 
     if args.distributed:
+        ignore_frozen_in_ddp(model)
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
         model_without_ddp = model.module
     
@@ -179,28 +294,70 @@ def main(args):
     param_groups = optim_factory.add_weight_decay(model_without_ddp, args.weight_decay)
     optimizer = torch.optim.AdamW(param_groups, lr=args.lr, betas=(0.9, 0.95))
     print(optimizer)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=args.precision == 'fp16', device=device)
 
     misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
 
+    teacher_server = None
+    if args.teacher_server:
+        if device.type == 'cpu' and args.teacher_threads > 0:
+            # leave the teacher's cores to the teacher
+            torch.set_num_threads(max(1, torch.get_num_threads() - args.teacher_threads))
+        teacher_server = TeacherServer(
+            model_without_ddp.MoCo, args.batch_size, img_shape=(3, args.input_size, args.input_size),
+            feat_dim=model_without_ddp.MoCo.module.embed_dim,
+            device=args.teacher_device, num_threads=args.teacher_threads)
+
+    knn_monitor = None
+    if args.knn_every > 0 and misc.is_main_process():
+        knn_monitor = KNNMonitor(args.knn_data_path or args.data_path, args.input_size, device,
+                                 num_train=args.knn_train_samples, num_val=args.knn_val_samples,
+                                 k=args.knn_k, temperature=args.knn_temperature, batch_size=args.batch_size,
+                                 num_workers=args.num_workers, precision=args.precision, seed=args.seed)
+
     print(f"Start training for {args.epochs} epochs")
     start_time = time.time()
+    input_size = None
+    stage_times = {}  # input size -> epoch times
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             data_loader_train.sampler.set_epoch(epoch)
+        if input_size_at(res_schedule, epoch) != input_size:
+            input_size = input_size_at(res_schedule, epoch)
+            set_input_size(transform_train, input_size)
+            print("Epoch %d: input size %d" % (epoch, input_size))
+        epoch_start = time.time()
         train_stats = train_one_epoch(
             model, data_loader_train,
             optimizer, device, epoch, loss_scaler,
             log_writer=log_writer,
-            args=args
+            args=args, teacher_server=teacher_server
         )
+        epoch_time = time.time() - epoch_start
+        stage_times.setdefault(input_size, []).append(epoch_time)
         if args.output_dir and (epoch % 20 == 0 or epoch + 1 == args.epochs):
             misc.save_model(
                 args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
                 loss_scaler=loss_scaler, epoch=epoch)
 
+        if args.compile and epoch == args.start_epoch:
+            times = compile_times(model_without_ddp)
+            print("Compile time (first calls): %.1fs total, %s" % (
+                sum(times.values()), ', '.join('%s %.1fs' % kv for kv in times.items())))
+            if compile_cache_dir and misc.is_main_process():
+                save_compile_cache(compile_cache_dir)
+
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                        'epoch': epoch,}
+                        'epoch': epoch, 'input_size': input_size, 'epoch_time': epoch_time,}
+
+        if knn_monitor is not None and ((epoch + 1) % args.knn_every == 0 or epoch + 1 == args.epochs):
+            knn_stats = knn_monitor.evaluate(model_without_ddp)
+            print("kNN (k=%d): top-1 %.2f%%, top-5 %.2f%% (%.1fs)" % (
+                args.knn_k, knn_stats['top1'], knn_stats['top5'], knn_stats['time']))
+            log_stats.update({f'knn_{k}': v for k, v in knn_stats.items()})
+            if log_writer is not None:
+                for k, v in knn_stats.items():
+                    log_writer.add_scalar('knn/%s' % k, v, epoch)
 
         if args.output_dir and misc.is_main_process():
             if log_writer is not None:
@@ -208,9 +365,15 @@ def main(args):
             with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
+    if teacher_server is not None:
+        teacher_server.close()
+
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
+    for size, times in stage_times.items():
+        print('Input size %d: %d epochs, %.1fs / epoch, %s total' % (
+            size, len(times), sum(times) / len(times), datetime.timedelta(seconds=int(sum(times)))))
 
 
 if __name__ == '__main__':
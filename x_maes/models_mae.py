@@ -13,11 +13,15 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, Block, Mlp
 
-from util.pos_embed import get_2d_sincos_pos_embed
-from util.diffaug import DiffAugment
+from util.pos_embed import get_2d_sincos_pos_embed, pos_embed_for
+from util.masking import masked_ids, decode_subset, partial_decoder_input
+from util.targets import patch_targets
+from models_common import CrossAttentionDecoder
+from util.varlen import cu_seqlens, token_index, varlen_block
 
 class MaskedAutoencoderViT(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
@@ -25,7 +29,9 @@ class MaskedAutoencoderViT(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3,
                  embed_dim=1024, depth=24, num_heads=16,
                  decoder_embed_dim=512, decoder_depth=8, decoder_num_heads=16,
-                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False):
+                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
+                 decode_masked_only=False, decoder_type='self', decoder_query_self_attn=False,
+                 decode_ratio=1.):
         super().__init__()
 
         # --------------------------------------------------------------------------
@@ -50,15 +56,27 @@ class MaskedAutoencoderViT(nn.Module):
 
         self.decoder_pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, decoder_embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
-        self.decoder_blocks = nn.ModuleList([
-            Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True,  norm_layer=norm_layer)
-            for i in range(decoder_depth)])
+        assert decoder_type in ('self', 'cross'), 'decoder_type must be self or cross'
+        self.cross_decoder = None
+        if decoder_type == 'cross':
+            # masked-token queries cross-attend to the visible tokens (CAE regressor blocks)
+            self.decoder_blocks = nn.ModuleList()
+            self.cross_decoder = CrossAttentionDecoder(decoder_embed_dim, decoder_depth, decoder_num_heads, mlp_ratio,
+                                                       norm_layer=norm_layer, query_self_attn=decoder_query_self_attn)
+        else:
+            self.decoder_blocks = nn.ModuleList([
+                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True,  norm_layer=norm_layer)
+                for i in range(decoder_depth)])
 
         self.decoder_norm = norm_layer(decoder_embed_dim)
         self.decoder_pred = nn.Linear(decoder_embed_dim, patch_size**2 * in_chans, bias=True) # decoder to patch
         # --------------------------------------------------------------------------
 
         self.norm_pix_loss = norm_pix_loss
+        # fraction of the masked patches reconstructed per sample (random subset, see forward)
+        self.decode_ratio = decode_ratio
+        # the cross-attention decoder / partial reconstruction only ever predict masked patches
+        self.decode_masked_only = decode_masked_only or decoder_type == 'cross' or decode_ratio < 1
         
 
         self.initialize_weights()
@@ -121,6 +139,21 @@ class MaskedAutoencoderViT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], 3, h * p, h * p))
         return imgs
 
+    def embed_patches(self, imgs):
+        """
+        imgs: [N, 3, H, W], any patch-aligned size (timm's PatchEmbed asserts its img_size),
+              or pre-patchified [N, M, p*p*3] (see util/targets.PatchifyTransform)
+        x: [N, H*W/p**2 or M, D]
+        """
+        if imgs.dim() == 3:
+            # the stride-p conv is a linear layer on flattened (p, p, 3) patches
+            proj = self.patch_embed.proj
+            x = F.linear(imgs, proj.weight.permute(0, 2, 3, 1).flatten(1), proj.bias)
+        else:
+            x = self.patch_embed.proj(imgs).flatten(2).transpose(1, 2)
+        norm = getattr(self.patch_embed, 'norm', None)  # timm 0.3.2's PatchEmbed has none
+        return x if norm is None else norm(x)
+
     def random_masking(self, x, mask_ratio):
         """
         Perform per-sample random masking by per-sample shuffling.
@@ -149,14 +182,22 @@ class MaskedAutoencoderViT(nn.Module):
         return x_masked, mask, ids_restore
 
     def forward_encoder(self, x, mask_ratio):
-        # embed patches
-        x = self.patch_embed(x)
-
-        # add pos embed w/o cls token
-        x = x + self.pos_embed[:, 1:, :]
-
-        # masking: length -> length * mask_ratio
-        x, mask, ids_restore = self.random_masking(x, mask_ratio)
+        if x.dim() == 3:
+            # pre-patchified input: mask first, then embed the visible patches only
+            x, mask, ids_restore = self.random_masking(x, mask_ratio)
+            ids_keep = torch.argsort(ids_restore, dim=1)[:, :x.shape[1]]
+            x = self.embed_patches(x)
+            pos_embed = pos_embed_for(self.pos_embed, mask.shape[1])[:, 1:, :].expand(x.shape[0], -1, -1)
+            x = x + torch.gather(pos_embed, 1, ids_keep.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+        else:
+            # embed patches
+            x = self.embed_patches(x)
+
+            # add pos embed w/o cls token (interpolated sin-cos for other input sizes)
+            x = x + pos_embed_for(self.pos_embed, x.shape[1])[:, 1:, :]
+
+            # masking: length -> length * mask_ratio
+            x, mask, ids_restore = self.random_masking(x, mask_ratio)
 
         # append cls token
         cls_token = self.cls_token + self.pos_embed[:, :1, :]
@@ -170,18 +211,76 @@ class MaskedAutoencoderViT(nn.Module):
 
         return x, mask, ids_restore
 
-    def forward_decoder(self, x, ids_restore):
+    def random_masking_varlen(self, x, mask_ratio):
+        """
+        random_masking with a per-sample mask_ratio [N]: the kept tokens of
+        all samples are packed into one sequence, sample after sample.
+        x: [N, L, D], sequence
+        """
+        N, L, D = x.shape  # batch, length, dim
+        len_keep = (L * (1 - mask_ratio.double())).long()
+
+        noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
+        ids_shuffle = torch.argsort(noise, dim=1)
+        ids_restore = torch.argsort(ids_shuffle, dim=1)
+
+        # keep the first len_keep[i] of sample i
+        batch, pos = token_index(len_keep, L)
+        x_masked = x[batch, ids_shuffle[batch, pos]]  # [sum(len_keep), D]
+
+        # generate the binary mask: 0 is keep, 1 is remove
+        mask = (torch.arange(L, device=x.device) >= len_keep.unsqueeze(1)).float()
+        mask = torch.gather(mask, dim=1, index=ids_restore)
+
+        return x_masked, mask, ids_restore, len_keep
+
+    def forward_encoder_varlen(self, x, mask_ratio):
+        """
+        Packed (variable-length) encoder: sample i keeps L * (1 - mask_ratio[i])
+        tokens and attends to its own tokens only, without padding.
+        returns: latent [T, D], mask, ids_restore and the offsets [N + 1] of
+        the samples in latent (each one is its cls token then its kept tokens)
+        """
+        # embed patches
+        x = self.embed_patches(x)
+
+        # add pos embed w/o cls token (interpolated sin-cos for other input sizes)
+        x = x + pos_embed_for(self.pos_embed, x.shape[1])[:, 1:, :]
+
+        # masking: length -> length * mask_ratio[i]
+        x, mask, ids_restore, len_keep = self.random_masking_varlen(x, mask_ratio)
+
+        # pack: cls token, then the kept tokens, for every sample
+        offsets = cu_seqlens(len_keep + 1)
+        batch, pos = token_index(len_keep, ids_restore.shape[1])
+        cls_tokens = (self.cls_token + self.pos_embed[:, :1, :])[0].expand(len(len_keep), -1)
+        rows = torch.cat([offsets[:-1], offsets[batch] + 1 + pos])
+        x = x.new_zeros(int(offsets[-1]), x.shape[1]).index_copy(0, rows, torch.cat([cls_tokens, x]))
+
+        # apply Transformer blocks
+        for blk in self.blocks:
+            x = varlen_block(blk, x, offsets)
+        x = self.norm(x)
+
+        return x, mask, ids_restore, offsets
+
+    def forward_decoder_varlen(self, x, ids_restore, offsets):
+        """forward_decoder for the packed output of forward_encoder_varlen; the
+        decoder sequences all have 1 + L tokens again."""
+        assert self.cross_decoder is None and not self.decode_masked_only, \
+            'the packed path decodes every patch with the self-attention decoder'
         # embed tokens
         x = self.decoder_embed(x)
+        N, L = ids_restore.shape
 
-        # append mask tokens to sequence
-        mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
-        x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
+        # unpack: kept tokens back to their patch positions, mask tokens everywhere else
+        batch, pos = token_index(offsets.diff() - 1, L)
+        ids_shuffle = torch.argsort(ids_restore, dim=1)
+        x_ = self.mask_token.repeat(N, L, 1).index_put((batch, ids_shuffle[batch, pos]), x[offsets[batch] + 1 + pos])
+        x = torch.cat([x[offsets[:-1]].unsqueeze(1), x_], dim=1)  # append cls token
 
         # add pos embed
-        x = x + self.decoder_pos_embed
+        x = x + pos_embed_for(self.decoder_pos_embed, L)
 
         # apply Transformer blocks
         for blk in self.decoder_blocks:
@@ -196,30 +295,85 @@ class MaskedAutoencoderViT(nn.Module):
 
         return x
 
-    def forward_loss(self, imgs, pred, mask):
+    def forward_decoder(self, x, ids_restore):
+        # embed tokens
+        x = self.decoder_embed(x)
+        len_keep = x.shape[1] - 1
+        decoder_pos_embed = pos_embed_for(self.decoder_pos_embed, ids_restore.shape[1])
+
+        if self.cross_decoder is not None:
+            # masked tokens only, in masked_ids order
+            x = self.cross_decoder(x, self.mask_token, decoder_pos_embed, ids_restore, self.decode_ratio)
+            return self.decoder_pred(self.decoder_norm(x))
+
+        if self.decode_ratio < 1:
+            # partial reconstruction: the kept tokens and decode_ratio of the mask tokens,
+            # ids_restore now indexes the decoder tokens
+            x, ids_restore = partial_decoder_input(x, self.mask_token, decoder_pos_embed,
+                                                   ids_restore, self.decode_ratio)
+        else:
+            # append mask tokens to sequence
+            mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
+            x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+            x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
+            x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
+
+            # add pos embed
+            x = x + decoder_pos_embed
+
+        # apply Transformer blocks
+        for blk in self.decoder_blocks:
+            x = blk(x)
+        # remove cls token; with decode_masked_only keep the masked tokens only,
+        # the visible ones never reach decoder_norm / decoder_pred / the loss
+        x = x[:, 1:, :]
+        if self.decode_masked_only:
+            ids_masked = masked_ids(ids_restore >= len_keep, x.shape[1] - len_keep)
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+        x = self.decoder_norm(x)
+
+        # predictor projection
+        x = self.decoder_pred(x)
+
+        return x
+
+    def forward_loss(self, imgs, pred, mask, target=None):
         """
-        imgs: [N, 3, H, W]
-        pred: [N, L, p*p*3]
+        imgs: [N, 3, H, W], or the pre-patchified input [N, L, p*p*3] (its own target)
+        pred: [N, L, p*p*3], or [N, L_masked, p*p*3] with decode_masked_only
+              (with decode_ratio < 1, mask only marks the decoded subset)
         mask: [N, L], 0 is keep, 1 is remove, 
+        target: [N, L, p*p*3], optional targets precomputed in the data loader
         """
-        target = self.patchify(imgs)
-        if self.norm_pix_loss:
-            mean = target.mean(dim=-1, keepdim=True)
-            var = target.var(dim=-1, keepdim=True)
-            target = (target - mean) / (var + 1.e-6)**.5
+        # with decode_masked_only: targets of the masked patches only, in the order of masked_ids
+        ids = masked_ids(mask, pred.shape[1]) if self.decode_masked_only else None
+        target = patch_targets(imgs, self.patch_embed.patch_size[0], ids,
+                               norm_pix=self.norm_pix_loss, precomputed=target)
 
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+        if self.decode_masked_only:
+            return loss.mean()  # every predicted patch is a removed one
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
         return loss
 
-    def forward(self, imgs, mask_ratio=0.75):
-        imgs = DiffAugment(imgs, policy='color,translation,cutout') 
+    def forward(self, imgs, mask_ratio=0.75, target=None):
+        """
+        mask_ratio: float, or a tensor [N] of per-sample ratios (packed encoder)
+        """
+        if torch.is_tensor(mask_ratio):
+            latent, mask, ids_restore, offsets = self.forward_encoder_varlen(imgs, mask_ratio)
+            pred = self.forward_decoder_varlen(latent, ids_restore, offsets)  # [N, L, p*p*3]
+            return self.forward_loss(imgs, pred, mask, target)
 
         latent, mask, ids_restore = self.forward_encoder(imgs, mask_ratio)
+        loss_mask = mask
+        if self.decode_ratio < 1:
+            # reconstruct a random fixed-size subset of the masked patches only
+            ids_restore, loss_mask = decode_subset(ids_restore, latent.shape[1] - 1, self.decode_ratio)
         pred = self.forward_decoder(latent, ids_restore)  # [N, L, p*p*3]
-        loss = self.forward_loss(imgs, pred, mask)
+        loss = self.forward_loss(imgs, pred, loss_mask, target)
         return loss
 
 
@@ -251,3 +405,8 @@ def mae_vit_huge_patch14_dec512d8b(**kwargs):
 mae_vit_base_patch16 = mae_vit_base_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_large_patch16 = mae_vit_large_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_huge_patch14 = mae_vit_huge_patch14_dec512d8b  # decoder: 512 dim, 8 blocks
+
+# lightweight decoder: only the masked-token queries attend, to the visible tokens
+mae_vit_base_patch16_cross = partial(mae_vit_base_patch16_dec512d8b, decoder_type='cross')
+mae_vit_large_patch16_cross = partial(mae_vit_large_patch16_dec512d8b, decoder_type='cross')
+mae_vit_huge_patch14_cross = partial(mae_vit_huge_patch14_dec512d8b, decoder_type='cross')
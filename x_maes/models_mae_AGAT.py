@@ -13,9 +13,11 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, DropPath, Mlp, Block
 
+from util.attention import use_fused_attn
 from util.pos_embed import get_2d_sincos_pos_embed
 
 
@@ -31,6 +33,7 @@ class Attention_AGAT(nn.Module):
         self.attn_drop = attn_drop
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        self.fused_attn = use_fused_attn()
 
     def forward(self, x):
         B, N, C = x.shape
@@ -39,20 +42,36 @@ class Attention_AGAT(nn.Module):
         # make torchscript happy (cannot use tensor as tuple)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-
-        own_attn = torch.sum(torch.sum(attn, dim=1), dim=-2)  # b p
+        if self.fused_attn:
+            # the probabilities only rank the tokens (argsort, no gradient): compute them
+            # without building a graph, then attend from the kept queries with SDPA
+            with torch.no_grad():
+                attn = ((q @ k.transpose(-2, -1)) * self.scale).softmax(dim=-1)
+                own_attn = torch.sum(torch.sum(attn, dim=1), dim=-2)  # b p
+            del attn
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+
+            own_attn = torch.sum(torch.sum(attn, dim=1), dim=-2)  # b p
         kept_num = int(N * self.attn_drop) - 1
         # ascend: small is keep, large is remove
         ids_shuffle = torch.argsort(own_attn[:, 1:], dim=-1)
         ids_restore = torch.argsort(ids_shuffle, dim=1)
         rank_indices = ids_shuffle[:, :kept_num]
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
-        x_ = torch.gather(x[:, 1:, :], dim=1,
-                          index=rank_indices.unsqueeze(-1).repeat(1, 1, C))
-        x = torch.cat([x[:, 0:1, :], x_], dim=1)
+        if self.fused_attn:
+            # cls + kept tokens as queries
+            cls_index = torch.zeros(B, 1, dtype=rank_indices.dtype, device=rank_indices.device)
+            keep = torch.cat([cls_index, rank_indices + 1], dim=1)
+            q = torch.gather(q, dim=2, index=keep[:, None, :, None].expand(-1, self.num_heads, -1, q.shape[-1]))
+            x = F.scaled_dot_product_attention(q, k, v, scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, -1, C)
+        else:
+            x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+            x_ = torch.gather(x[:, 1:, :], dim=1,
+                              index=rank_indices.unsqueeze(-1).repeat(1, 1, C))
+            x = torch.cat([x[:, 0:1, :], x_], dim=1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, ids_restore, N - kept_num, rank_indices
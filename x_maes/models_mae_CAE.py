@@ -5,8 +5,10 @@ import torch.nn as nn
 from functools import partial
 from timm.models.registry import register_model
 from timm.models.layers import trunc_normal_ as __call_trunc_normal_
-import torch.nn.functional as F
-from timm.models.layers import drop_path, to_2tuple, trunc_normal_
+from timm.models.layers import to_2tuple, trunc_normal_
+
+from util.frozen import FrozenModule
+from models_common import Block, RegressorBlock
 
 def _cfg(url='', **kwargs):
     return {
@@ -18,38 +20,15 @@ def _cfg(url='', **kwargs):
     }
 
 
-class DropPath(nn.Module):
-    """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks).
-    """
-    def __init__(self, drop_prob=None):
-        super(DropPath, self).__init__()
-        self.drop_prob = drop_prob
-
-    def forward(self, x):
-        return drop_path(x, self.drop_prob, self.training)
-    
-    def extra_repr(self) -> str:
-        return 'p={}'.format(self.drop_prob)
-
+def select_tokens(x, bool_masked_pos, num_tokens):
+    """x[bool_masked_pos].reshape(B, num_tokens, -1) written as a gather.
 
-class Mlp(nn.Module):
-    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
-        super().__init__()
-        out_features = out_features or in_features
-        hidden_features = hidden_features or in_features
-        self.fc1 = nn.Linear(in_features, hidden_features)
-        self.act = act_layer()
-        self.fc2 = nn.Linear(hidden_features, out_features)
-        self.drop = nn.Dropout(drop)
-
-    def forward(self, x):
-        x = self.fc1(x)
-        x = self.act(x)
-        # x = self.drop(x)
-        # commit this for the orignal BERT implement 
-        x = self.fc2(x)
-        x = self.drop(x)
-        return x
+    Boolean indexing has a data-dependent output shape (a graph break under
+    torch.compile); every sample selects the same number of tokens, so the
+    shape is static once `num_tokens` is known. Token order is preserved.
+    """
+    ids = torch.argsort((~bool_masked_pos).int(), dim=1, stable=True)[:, :num_tokens]
+    return torch.gather(x, dim=1, index=ids.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
 
 
 class PatchEmbed(nn.Module):
@@ -79,187 +58,12 @@ class PatchEmbed(nn.Module):
 def trunc_normal_(tensor, mean=0., std=1.):
     __call_trunc_normal_(tensor, mean=mean, std=std, a=-std, b=std)
 
-class Attention(nn.Module):
-    def __init__(
-            self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
-            proj_drop=0., window_size=None, attn_head_dim=None):
-        super().__init__()
-        self.num_heads = num_heads
-        head_dim = dim // num_heads
-        if attn_head_dim is not None:
-            head_dim = attn_head_dim
-        all_head_dim = head_dim * self.num_heads
-        self.scale = qk_scale or head_dim ** -0.5
-
-        self.qkv = nn.Linear(dim, all_head_dim * 3, bias=False)
-        if qkv_bias:
-            self.q_bias = nn.Parameter(torch.zeros(all_head_dim))
-            self.v_bias = nn.Parameter(torch.zeros(all_head_dim))
-        else:
-            self.q_bias = None
-            self.v_bias = None
-        
-        self.attn_drop = nn.Dropout(attn_drop)
-        self.proj = nn.Linear(all_head_dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-
-    def forward(self, x, bool_masked_pos=None):
-
-        B, N, C = x.shape
-        qkv_bias = None
-        if self.q_bias is not None:
-            qkv_bias = torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
-
-        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
-        qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
-        q, k, v = qkv[0], qkv[1], qkv[2]
-        
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))    # (B, N_head, N, N)
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1) 
-        x = self.proj(x)
-        x = self.proj_drop(x)
-
-        return x
-
-'''
-Modified from Attention()
-'''
-class CrossAttention(nn.Module):
-    def __init__(
-            self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
-            proj_drop=0., window_size=None, attn_head_dim=None):
-        super().__init__()
-        self.num_heads = num_heads
-        head_dim = dim // num_heads
-        if attn_head_dim is not None:
-            head_dim = attn_head_dim
-        all_head_dim = head_dim * self.num_heads
-        self.scale = qk_scale or head_dim ** -0.5
-
-        self.q = nn.Linear(dim, all_head_dim, bias=False)
-        self.k = nn.Linear(dim, all_head_dim, bias=False)
-        self.v = nn.Linear(dim, all_head_dim, bias=False)
-
-        if qkv_bias:
-            self.q_bias = nn.Parameter(torch.zeros(all_head_dim))
-            self.v_bias = nn.Parameter(torch.zeros(all_head_dim))
-        else:
-            self.q_bias = None
-            self.k_bias = None
-            self.v_bias = None
-
-        self.attn_drop = nn.Dropout(attn_drop)
-        self.proj = nn.Linear(all_head_dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-
-    def forward(self, x, bool_masked_pos=None, k=None, v=None):
-        B, N, C = x.shape
-        N_k = k.shape[1]
-        N_v = v.shape[1]
-
-        q_bias, k_bias, v_bias = None, None, None
-        if self.q_bias is not None:
-            q_bias = self.q_bias
-            k_bias = torch.zeros_like(self.v_bias, requires_grad=False)
-            v_bias = self.v_bias
-
-        q = F.linear(input=x, weight=self.q.weight, bias=q_bias)
-        q = q.reshape(B, N, 1, self.num_heads, -1).permute(2, 0, 3, 1, 4).squeeze(0)    # (B, N_head, N_q, dim)
-
-        k = F.linear(input=k, weight=self.k.weight, bias=k_bias)
-        k = k.reshape(B, N_k, 1, self.num_heads, -1).permute(2, 0, 3, 1, 4).squeeze(0)
-
-        v = F.linear(input=v, weight=self.v.weight, bias=v_bias)   
-        v = v.reshape(B, N_v, 1, self.num_heads, -1).permute(2, 0, 3, 1, 4).squeeze(0)
-
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))      # (B, N_head, N_q, N_k)
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1) 
-        x = self.proj(x)
-        x = self.proj_drop(x)
-
-        return x
-
-
-class Block(nn.Module):
-
-    def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., init_values=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-                 window_size=None, attn_head_dim=None):
-        super().__init__()
-        self.norm1 = norm_layer(dim)
-        self.attn = Attention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
-            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim)
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
-        self.norm2 = norm_layer(dim)
-        mlp_hidden_dim = int(dim * mlp_ratio)
-        self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
-
-        if init_values > 0:
-            self.gamma_1 = nn.Parameter(init_values * torch.ones((dim)),requires_grad=True)
-            self.gamma_2 = nn.Parameter(init_values * torch.ones((dim)),requires_grad=True)
-        else:
-            self.gamma_1, self.gamma_2 = None, None
-
-    def forward(self, x, bool_masked_pos=None):
-        if self.gamma_1 is None:
-            x = x + self.drop_path(self.attn(self.norm1(x), bool_masked_pos))
-            x = x + self.drop_path(self.mlp(self.norm2(x)))
-        else:
-            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x), bool_masked_pos))
-            x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
-
-        return x
-
-
-class RegressorBlock(nn.Module):
-    def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., init_values=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-                 window_size=None, attn_head_dim=None):
-        super().__init__()
-        self.norm1_q = norm_layer(dim)
-        self.norm1_k = norm_layer(dim)
-        self.norm1_v = norm_layer(dim)
-        self.norm2_cross = norm_layer(dim)
-        self.cross_attn =  CrossAttention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
-            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim)
-
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
-        mlp_hidden_dim = int(dim * mlp_ratio)
-        
-        self.mlp_cross = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
-
-        if init_values > 0:
-            self.gamma_1_cross = nn.Parameter(init_values * torch.ones((dim)),requires_grad=True)
-            self.gamma_2_cross = nn.Parameter(init_values * torch.ones((dim)),requires_grad=True)
-        else:
-            self.gamma_1_cross = nn.Parameter(torch.ones((dim)),requires_grad=False)
-            self.gamma_2_cross = nn.Parameter(torch.ones((dim)),requires_grad=False)
-
-    def forward(self, x_q, x_kv, pos_q, pos_k, bool_masked_pos):
-        x = x_q + self.drop_path(self.gamma_1_cross * self.cross_attn(self.norm1_q(x_q + pos_q),
-         bool_masked_pos, k=self.norm1_k(x_kv + pos_k), v=self.norm1_v(x_kv)))
-        x = self.norm2_cross(x)
-        x = x + self.drop_path(self.gamma_2_cross * self.mlp_cross(x))
-
-        return x
-
-
 '''
 Encoder that extracts representations
 '''
 class VisionTransformerEncoder(nn.Module):
+    compile_targets = ('forward_features',)  # see util/compile.py
+
     def __init__(self, img_size=224, patch_size=16, in_chans=3, vocab_size=8192, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., norm_layer=None, init_values=None, attn_head_dim=None,
@@ -346,19 +150,21 @@ class VisionTransformerEncoder(nn.Module):
     def get_num_layers(self):
         return len(self.blocks)
 
-    def forward_features(self, x, bool_masked_pos):
+    def forward_features(self, x, bool_masked_pos, num_visible=None):
         x = self.patch_embed(x, bool_masked_pos=bool_masked_pos)
         batch_size, seq_len, dim = x.size()
+        if num_visible is None:
+            num_visible = int((~bool_masked_pos[0]).sum())
 
         cls_tokens = self.cls_token.expand(batch_size, -1, -1)
 
         # unmasked embeddings
-        x_unmasked = x[~bool_masked_pos].reshape(batch_size, -1, dim)
+        x_unmasked = select_tokens(x, ~bool_masked_pos, num_visible)
         x_unmasked = torch.cat((cls_tokens, x_unmasked), dim=1)
 
         if self.pos_embed is not None:
             pos_embed = self.pos_embed.expand(batch_size, self.num_patches+1, dim)
-            pos_embed_unmasked = pos_embed[:,1:][~bool_masked_pos].reshape(batch_size, -1, dim) 
+            pos_embed_unmasked = select_tokens(pos_embed[:,1:], ~bool_masked_pos, num_visible)
             pos_embed_unmasked = torch.cat((pos_embed[:,:1], pos_embed_unmasked),dim=1)
             x_unmasked = x_unmasked + pos_embed_unmasked
 
@@ -371,14 +177,16 @@ class VisionTransformerEncoder(nn.Module):
 
         return x_unmasked
 
-    def forward(self, x, bool_masked_pos, return_all_tokens=False):
-        x = self.forward_features(x, bool_masked_pos=bool_masked_pos)
+    def forward(self, x, bool_masked_pos, return_all_tokens=False, num_visible=None):
+        x = self.forward_features(x, bool_masked_pos=bool_masked_pos, num_visible=num_visible)
         return x
 
 '''
 Latent context regressor + decoder that solves the pretext task.
 '''
 class VisionTransformerNeck(nn.Module):
+    compile_targets = ('forward',)  # see util/compile.py
+
     def __init__(self, patch_size=16, num_classes=8192, embed_dim=768, depth=6, 
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., norm_layer=None, init_values=None, num_patches=196, init_std=0.02, args=None, patch_shape=(14,14)):
@@ -489,6 +297,8 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
         self.init_std = init_std
         self.args = args
         self.num_patches = self.encoder.patch_embed.num_patches
+        # fixed number of masked patches (static shapes); counted from the mask when not given
+        self.num_mask_patches = getattr(args, 'num_mask_patches', None)
 
         self.pretext_neck = VisionTransformerNeck(patch_size=patch_size, num_classes=args.decoder_num_classes, embed_dim=args.decoder_embed_dim, depth=args.regressor_depth,
             num_heads=args.decoder_num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
@@ -508,7 +318,17 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
         if not args.fix_init_weight:
             self.apply(self._init_weights)
         self._init_teacher()
-        
+        # sin-cos position embedding of the regressor / decoder, built once
+        self.register_buffer('pretext_pos_embed', self.encoder.build_2d_sincos_position_embedding(
+            args.decoder_embed_dim, use_cls_token=True).data, persistent=False)
+        # the teacher only produces targets: keep it out of autograd, in reduced precision unless it is an
+        # EMA of the encoder ((1 - m) * delta updates fall below bf16 / fp16 resolution and would be lost)
+        teacher_dtype = getattr(args, 'teacher_dtype', None) or ('fp32' if args.base_momentum > 0 else 'bf16')
+        if args.base_momentum > 0 and teacher_dtype != 'fp32':
+            raise ValueError('an EMA teacher (base_momentum %g) needs teacher_dtype fp32, got %s' % (
+                args.base_momentum, teacher_dtype))
+        self.teacher = FrozenModule(self.teacher, dtype=teacher_dtype)
+
         
     def _init_teacher(self):  
         # init the weights of teacher with those of backbone
@@ -517,12 +337,14 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
             param_teacher.data.copy_(param_encoder.data)
             param_teacher.requires_grad = False
 
+    @torch.no_grad()
     def momentum_update(self, base_momentum=0):
         """Momentum update of the teacher network."""
         for param_encoder, param_teacher in zip(self.encoder.parameters(),
                                                 self.teacher.parameters()):
-            param_teacher.data = param_teacher.data * base_momentum + \
-                param_encoder.data * (1. - base_momentum)
+            # accumulate in fp32, store in the teacher's dtype
+            param_teacher.copy_(param_teacher.float() * base_momentum +
+                                param_encoder.detach().float() * (1. - base_momentum))
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -546,7 +368,12 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
         Output shape:
             [bs, num_visible + 1, C]
         '''
-        x_unmasked = self.encoder(x, bool_masked_pos=bool_masked_pos)
+        num_masked_patches = self.num_mask_patches
+        if num_masked_patches is None:
+            num_masked_patches = int(bool_masked_pos[0].sum())
+        num_visible = self.num_patches - num_masked_patches
+
+        x_unmasked = self.encoder(x, bool_masked_pos=bool_masked_pos, num_visible=num_visible)
 
         # encoder to decoder projection
         if self.encoder_to_decoder is not None:
@@ -557,7 +384,7 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
         Alignment constraint
         '''
         with torch.no_grad():
-            latent_target = self.teacher(x, bool_masked_pos=(~bool_masked_pos))
+            latent_target = self.teacher(x, bool_masked_pos=(~bool_masked_pos), num_visible=num_masked_patches)
             latent_target = latent_target[:, 1:, :] # remove class token
             if self.encoder_to_decoder is not None:
                 latent_target = self.encoder_to_decoder_norm(self.encoder_to_decoder(latent_target.detach()))
@@ -571,16 +398,14 @@ class VisionTransformerForMaskedImageModeling(nn.Module):
         # remove class token
         x_unmasked = x_unmasked[:, 1:, :]
 
-        num_masked_patches = self.num_patches - (num_visible_plus1-1)
-        
         # generate position embeddings.
-        pos_embed = self.encoder.build_2d_sincos_position_embedding(dim, use_cls_token=True).expand(batch_size, self.num_patches+1, dim).cuda(x_unmasked.device)
+        pos_embed = self.pretext_pos_embed.expand(batch_size, self.num_patches+1, dim)
 
         # pos embed for masked patches
-        pos_embed_masked = pos_embed[:,1:][bool_masked_pos].reshape(batch_size, -1, dim) 
+        pos_embed_masked = select_tokens(pos_embed[:,1:], bool_masked_pos, num_masked_patches)
 
         # pos embed for unmasked patches
-        pos_embed_unmasked = pos_embed[:,1:][~bool_masked_pos].reshape(batch_size, -1, dim) 
+        pos_embed_unmasked = select_tokens(pos_embed[:,1:], ~bool_masked_pos, num_visible)
 
         # masked embedding '''
         x_masked = self.mask_token.expand(batch_size, num_masked_patches, -1)
@@ -9,54 +9,174 @@
 # DeiT: https://github.com/facebookresearch/deit
 # --------------------------------------------------------
 
+import math
 from functools import partial
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from timm.models.vision_transformer import PatchEmbed, Block, Mlp
 
-from util.pos_embed import get_2d_sincos_pos_embed
-from util.diffaug import DiffAugment
+from util.pos_embed import get_2d_sincos_pos_embed, pos_embed_for
+from util.masking import masked_ids, decode_subset, partial_decoder_input
+from util.targets import patch_targets
+from models_common import CrossAttentionDecoder
 import torch.nn.functional as F
+import torch.distributed as dist
 
 
 class GumbelQuantizer(nn.Module):
-    def __init__(self, codebook_size, emb_dim, num_hiddens, straight_through=False, kl_weight=5e-4, temp_init=1.0):
+    def __init__(self, codebook_size, emb_dim, num_hiddens, straight_through=False, kl_weight=5e-4, temp_init=1.0,
+                 chunk_size=0, reservoir_size=0):
         super().__init__()
         self.codebook_size = codebook_size  # number of embeddings
         self.emb_dim = emb_dim  # dimension of embedding
         self.straight_through = straight_through
         self.temperature = temp_init
         self.kl_weight = kl_weight
+        self.chunk_size = chunk_size  # tokens per chunk for large codebooks, 0: no chunking
         self.proj = nn.Linear(num_hiddens, codebook_size)  # projects last encoder layer to quantized logits
         self.embed = nn.Embedding(codebook_size, emb_dim)
 
-    def forward(self, z):
+        # code usage since the last reset (per rank, see sync_usage) and recent encoder outputs used to
+        # restart dead codes: plain tensors, moved to the device on first use, so that DDP neither
+        # broadcasts them from rank 0 on every forward nor checkpoints them
+        self.usage = torch.zeros(codebook_size)
+        self.reservoir_size = reservoir_size
+        self.reservoir = torch.zeros(reservoir_size, num_hiddens)
+        self._reservoir_ptr = 0
+        self._reservoir_fill = 0
+
+    def quantize(self, z):
+        """
+        z: [..., num_hiddens]
+        returns z_q [..., emb_dim], per-token kl [...], indices [...]
+        """
         hard = self.straight_through if self.training else True
 
         logits = self.proj(z)
 
-        soft_one_hot = F.gumbel_softmax(logits, tau=self.temperature, dim=2, hard=hard)
+        # kl divergence to the uniform prior, from the log-probabilities of the same logits
+        log_qy = F.log_softmax(logits, dim=-1)
+        kl = torch.sum(log_qy.exp() * (log_qy + math.log(self.codebook_size)), dim=-1)
+
+        if hard:
+            # sparse path: argmax + embedding lookup instead of a dense one-hot contraction
+            gumbels = -torch.empty_like(logits).exponential_().log()
+            y = (logits + gumbels) / self.temperature
+            min_encoding_indices = y.argmax(dim=-1)
+            z_q = self.embed(min_encoding_indices)
+            if torch.is_grad_enabled():
+                # straight-through: forward value of the lookup, gradient of the soft assignment
+                z_soft = y.softmax(dim=-1) @ self.embed.weight.detach()
+                z_q = z_q + (z_soft - z_soft.detach())
+        else:
+            soft_one_hot = F.gumbel_softmax(logits, tau=self.temperature, dim=-1, hard=False)
+            z_q = torch.einsum("... n, n d -> ... d", soft_one_hot, self.embed.weight)
+            min_encoding_indices = soft_one_hot.argmax(dim=-1)
+
+        return z_q, kl, min_encoding_indices
 
-        z_q = torch.einsum("b h n, n d -> b h d", soft_one_hot, self.embed.weight)
-
-        # + kl divergence to the prior loss
-        qy = F.softmax(logits, dim=2)
-        diff = self.kl_weight * torch.sum(qy * torch.log(qy * self.codebook_size + 1e-10), dim=2).mean()
-        min_encoding_indices = soft_one_hot.argmax(dim=2)
+    def forward(self, z):
+        if self.chunk_size <= 0 or z.shape[:-1].numel() <= self.chunk_size:
+            z_q, kl, min_encoding_indices = self.quantize(z)
+        else:
+            # bound the [tokens, codebook_size] logits to chunk_size rows at a time
+            outs = []
+            for chunk in z.reshape(-1, z.shape[-1]).split(self.chunk_size):
+                if torch.is_grad_enabled():
+                    outs.append(checkpoint(self.quantize, chunk, use_reentrant=False))
+                else:
+                    outs.append(self.quantize(chunk))
+            z_q, kl, min_encoding_indices = [torch.cat(o, dim=0) for o in zip(*outs)]
+            z_q = z_q.reshape(z.shape[:-1] + (self.emb_dim,))
+            min_encoding_indices = min_encoding_indices.reshape(z.shape[:-1])
+
+        diff = self.kl_weight * kl.mean()
+
+        if self.training:
+            self.track(z, min_encoding_indices)
 
         return z_q, diff, {
             "min_encoding_indices": min_encoding_indices
         }
 
+    @torch.no_grad()
+    def encode(self, z):
+        """Deterministic code indices (argmax of the logits, no Gumbel noise)."""
+        chunk_size = self.chunk_size if self.chunk_size > 0 else z.shape[:-1].numel()
+        idx = [self.proj(chunk).argmax(dim=-1) for chunk in z.reshape(-1, z.shape[-1]).split(chunk_size)]
+        return torch.cat(idx).reshape(z.shape[:-1])
+
+    @torch.no_grad()
+    def track(self, z, min_encoding_indices):
+        if self.usage.device != z.device:
+            self.usage = self.usage.to(z.device)
+            self.reservoir = self.reservoir.to(z.device)
+        idx = min_encoding_indices.reshape(-1)
+        self.usage.index_add_(0, idx, torch.ones_like(idx, dtype=self.usage.dtype))
+
+        if self.reservoir_size > 0:
+            z = z.reshape(-1, z.shape[-1])
+            n = min(max(1, self.reservoir_size // 4), z.shape[0])
+            rows = torch.arange(self._reservoir_ptr, self._reservoir_ptr + n, device=z.device) % self.reservoir_size
+            self.reservoir[rows] = z[torch.randint(z.shape[0], (n,), device=z.device)].float()
+            self._reservoir_ptr = (self._reservoir_ptr + n) % self.reservoir_size
+            self._reservoir_fill = min(self._reservoir_fill + n, self.reservoir_size)
+
+    @torch.no_grad()
+    def sync_usage(self):
+        """Sum the usage histogram over ranks (in place); call on every rank before stats / restarts."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.usage)
+
+    @torch.no_grad()
+    def codebook_stats(self):
+        """Perplexity and dead-code count of the usage histogram (device tensors)."""
+        p = self.usage / self.usage.sum().clamp(min=1)
+        perplexity = torch.exp(-torch.sum(p * torch.log(p + 1e-10)))
+        dead = (self.usage == 0).sum()
+        return {'perplexity': perplexity, 'dead_codes': dead}
+
+    def reset_usage(self):
+        self.usage.zero_()
+
+    @torch.no_grad()
+    def restart_dead_codes(self):
+        """Re-initialize unused codes from recent encoder outputs, returns the number restarted.
+
+        Needs the usage summed over ranks (sync_usage): every rank then restarts the same codes, with
+        the samples of rank 0, so the replicas stay identical.
+        """
+        dead = (self.usage == 0).nonzero().squeeze(1)
+        if len(dead) == 0 or self._reservoir_fill == 0 or len(dead) == self.codebook_size:
+            return 0  # the same on every rank: same synced usage, same number of tracked steps
+        alive = self.usage > 0
+        samples = self.reservoir[torch.randint(self._reservoir_fill, (len(dead),), device=dead.device)]
+        if dist.is_available() and dist.is_initialized():
+            dist.broadcast(samples, src=0)
+
+        # logits of a restarted code peak on inputs close to its sample
+        w = self.proj.weight
+        row_norm = w[alive].norm(dim=1).mean()
+        w[dead] = (samples * (row_norm / samples.norm(dim=1, keepdim=True).clamp(min=1e-6))).to(w.dtype)
+        self.proj.bias[dead] = self.proj.bias[alive].mean()
+        if self.emb_dim == samples.shape[1]:
+            self.embed.weight[dead] = samples.to(self.embed.weight.dtype)
+        else:
+            self.embed.weight[dead] = torch.randn_like(self.embed.weight[dead])
+        return len(dead)
+
 class MaskedAutoencoderViT(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
     """
     def __init__(self, img_size=224, patch_size=16, in_chans=3,
                  embed_dim=1024, depth=24, num_heads=16,
                  decoder_embed_dim=512, decoder_depth=8, decoder_num_heads=16,
-                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False):
+                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
+                 decode_masked_only=False, decoder_type='self', decoder_query_self_attn=False,
+                 decode_ratio=1.):
         super().__init__()
 
         # --------------------------------------------------------------------------
@@ -81,15 +201,27 @@ class MaskedAutoencoderViT(nn.Module):
 
         self.decoder_pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, decoder_embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
-        self.decoder_blocks = nn.ModuleList([
-            Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True,  norm_layer=norm_layer)
-            for i in range(decoder_depth)])
+        assert decoder_type in ('self', 'cross'), 'decoder_type must be self or cross'
+        self.cross_decoder = None
+        if decoder_type == 'cross':
+            # masked-token queries cross-attend to the visible tokens (CAE regressor blocks)
+            self.decoder_blocks = nn.ModuleList()
+            self.cross_decoder = CrossAttentionDecoder(decoder_embed_dim, decoder_depth, decoder_num_heads, mlp_ratio,
+                                                       norm_layer=norm_layer, query_self_attn=decoder_query_self_attn)
+        else:
+            self.decoder_blocks = nn.ModuleList([
+                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True,  norm_layer=norm_layer)
+                for i in range(decoder_depth)])
 
         self.decoder_norm = norm_layer(decoder_embed_dim)
         self.decoder_pred = nn.Linear(decoder_embed_dim, patch_size**2 * in_chans, bias=True) # decoder to patch
         # --------------------------------------------------------------------------
 
         self.norm_pix_loss = norm_pix_loss
+        # fraction of the masked patches reconstructed per sample (random subset, see forward)
+        self.decode_ratio = decode_ratio
+        # the cross-attention decoder / partial reconstruction only ever predict masked patches
+        self.decode_masked_only = decode_masked_only or decoder_type == 'cross' or decode_ratio < 1
         
         self.code_book = None
         # Code book 
@@ -155,6 +287,21 @@ class MaskedAutoencoderViT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], 3, h * p, h * p))
         return imgs
 
+    def embed_patches(self, imgs):
+        """
+        imgs: [N, 3, H, W], any patch-aligned size (timm's PatchEmbed asserts its img_size),
+              or pre-patchified [N, M, p*p*3] (see util/targets.PatchifyTransform)
+        x: [N, H*W/p**2 or M, D]
+        """
+        if imgs.dim() == 3:
+            # the stride-p conv is a linear layer on flattened (p, p, 3) patches
+            proj = self.patch_embed.proj
+            x = F.linear(imgs, proj.weight.permute(0, 2, 3, 1).flatten(1), proj.bias)
+        else:
+            x = self.patch_embed.proj(imgs).flatten(2).transpose(1, 2)
+        norm = getattr(self.patch_embed, 'norm', None)  # timm 0.3.2's PatchEmbed has none
+        return x if norm is None else norm(x)
+
     def random_masking(self, x, mask_ratio):
         """
         Perform per-sample random masking by per-sample shuffling.
@@ -183,14 +330,22 @@ class MaskedAutoencoderViT(nn.Module):
         return x_masked, mask, ids_restore
 
     def forward_encoder(self, x, mask_ratio):
-        # embed patches
-        x = self.patch_embed(x)
-
-        # add pos embed w/o cls token
-        x = x + self.pos_embed[:, 1:, :]
-
-        # masking: length -> length * mask_ratio
-        x, mask, ids_restore = self.random_masking(x, mask_ratio)
+        if x.dim() == 3:
+            # pre-patchified input: mask first, then embed the visible patches only
+            x, mask, ids_restore = self.random_masking(x, mask_ratio)
+            ids_keep = torch.argsort(ids_restore, dim=1)[:, :x.shape[1]]
+            x = self.embed_patches(x)
+            pos_embed = pos_embed_for(self.pos_embed, mask.shape[1])[:, 1:, :].expand(x.shape[0], -1, -1)
+            x = x + torch.gather(pos_embed, 1, ids_keep.unsqueeze(-1).expand(-1, -1, x.shape[2]))
+        else:
+            # embed patches
+            x = self.embed_patches(x)
+
+            # add pos embed w/o cls token (interpolated sin-cos for other input sizes)
+            x = x + pos_embed_for(self.pos_embed, x.shape[1])[:, 1:, :]
+
+            # masking: length -> length * mask_ratio
+            x, mask, ids_restore = self.random_masking(x, mask_ratio)
 
         # append cls token
         cls_token = self.cls_token + self.pos_embed[:, :1, :]
@@ -213,57 +368,95 @@ class MaskedAutoencoderViT(nn.Module):
 
         return x, mask, ids_restore, loss_code
 
+    @torch.no_grad()
+    def forward_codes(self, imgs):
+        """
+        imgs: [N, 3, H, W]
+        codes: [N, L], code indices of all patches (no masking, cls token dropped)
+        """
+        x = self.embed_patches(imgs)
+        x = x + pos_embed_for(self.pos_embed, x.shape[1])[:, 1:, :]
+
+        cls_token = self.cls_token + self.pos_embed[:, :1, :]
+        cls_tokens = cls_token.expand(x.shape[0], -1, -1)
+        x = torch.cat((cls_tokens, x), dim=1)
+
+        for blk in self.blocks:
+            x = blk(x)
+        return self.code_book.encode(x[:, 1:, :])
+
     def forward_decoder(self, x, ids_restore):
         # embed tokens
         x = self.decoder_embed(x)
-
-        # append mask tokens to sequence
-        mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
-        x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
-
-        # add pos embed
-        x = x + self.decoder_pos_embed
+        len_keep = x.shape[1] - 1
+        decoder_pos_embed = pos_embed_for(self.decoder_pos_embed, ids_restore.shape[1])
+
+        if self.cross_decoder is not None:
+            # masked tokens only, in masked_ids order
+            x = self.cross_decoder(x, self.mask_token, decoder_pos_embed, ids_restore, self.decode_ratio)
+            return self.decoder_pred(self.decoder_norm(x))
+
+        if self.decode_ratio < 1:
+            # partial reconstruction: the kept tokens and decode_ratio of the mask tokens,
+            # ids_restore now indexes the decoder tokens
+            x, ids_restore = partial_decoder_input(x, self.mask_token, decoder_pos_embed,
+                                                   ids_restore, self.decode_ratio)
+        else:
+            # append mask tokens to sequence
+            mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
+            x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+            x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
+            x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
+
+            # add pos embed
+            x = x + decoder_pos_embed
 
         # apply Transformer blocks
         for idx, blk in enumerate(self.decoder_blocks):
             x = blk(x)
                 
+        # remove cls token; with decode_masked_only keep the masked tokens only,
+        # the visible ones never reach decoder_norm / decoder_pred / the loss
+        x = x[:, 1:, :]
+        if self.decode_masked_only:
+            ids_masked = masked_ids(ids_restore >= len_keep, x.shape[1] - len_keep)
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
         x = self.decoder_norm(x)
 
         # predictor projection
         x = self.decoder_pred(x)
 
-        # remove cls token
-        x = x[:, 1:, :]
-
         return x
 
-    def forward_loss(self, imgs, pred, mask):
+    def forward_loss(self, imgs, pred, mask, target=None):
         """
-        imgs: [N, 3, H, W]
-        pred: [N, L, p*p*3]
+        imgs: [N, 3, H, W], or the pre-patchified input [N, L, p*p*3] (its own target)
+        pred: [N, L, p*p*3], or [N, L_masked, p*p*3] with decode_masked_only
+              (with decode_ratio < 1, mask only marks the decoded subset)
         mask: [N, L], 0 is keep, 1 is remove, 
+        target: [N, L, p*p*3], optional targets precomputed in the data loader
         """
-        target = self.patchify(imgs)
-        if self.norm_pix_loss:
-            mean = target.mean(dim=-1, keepdim=True)
-            var = target.var(dim=-1, keepdim=True)
-            target = (target - mean) / (var + 1.e-6)**.5
+        # with decode_masked_only: targets of the masked patches only, in the order of masked_ids
+        ids = masked_ids(mask, pred.shape[1]) if self.decode_masked_only else None
+        target = patch_targets(imgs, self.patch_embed.patch_size[0], ids,
+                               norm_pix=self.norm_pix_loss, precomputed=target)
 
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+        if self.decode_masked_only:
+            return loss.mean()  # every predicted patch is a removed one
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
         return loss
 
-    def forward(self, imgs, mask_ratio=0.75):
-        imgs = DiffAugment(imgs, policy='color,translation,cutout') 
-
+    def forward(self, imgs, mask_ratio=0.75, target=None):
         latent, mask, ids_restore, loss_codebook = self.forward_encoder(imgs, mask_ratio)
+        loss_mask = mask
+        if self.decode_ratio < 1:
+            # reconstruct a random fixed-size subset of the masked patches only
+            ids_restore, loss_mask = decode_subset(ids_restore, latent.shape[1] - 1, self.decode_ratio)
         pred = self.forward_decoder(latent, ids_restore)  # [N, L, p*p*3]
-        loss = self.forward_loss(imgs, pred, mask)
+        loss = self.forward_loss(imgs, pred, loss_mask, target)
         return loss + loss_codebook
 
 
@@ -295,3 +488,8 @@ def mae_vit_huge_patch14_dec512d8b(**kwargs):
 mae_vit_base_patch16 = mae_vit_base_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_large_patch16 = mae_vit_large_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_huge_patch14 = mae_vit_huge_patch14_dec512d8b  # decoder: 512 dim, 8 blocks
+
+# lightweight decoder: only the masked-token queries attend, to the visible tokens
+mae_vit_base_patch16_cross = partial(mae_vit_base_patch16_dec512d8b, decoder_type='cross')
+mae_vit_large_patch16_cross = partial(mae_vit_large_patch16_dec512d8b, decoder_type='cross')
+mae_vit_huge_patch14_cross = partial(mae_vit_huge_patch14_dec512d8b, decoder_type='cross')
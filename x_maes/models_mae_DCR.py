@@ -10,87 +10,87 @@
 # --------------------------------------------------------
 
 from functools import partial
-from time import pthread_getcpuclockid
-from regex import P
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, Block
 
 from util.pos_embed import get_2d_sincos_pos_embed
-
-from torchvision import transforms as TF
+from util.masking import masked_ids, decode_subset, partial_decoder_input
+from util.targets import patch_targets
+from models_common import CrossAttentionDecoder
 
 
 class CropImage(nn.Module):
+    """ Two random patch-aligned crops per sample of the (virtually) upsampled
+    and zero-padded image.
+
+    Upsampling, padding and cropping are folded into a single grid_sample call
+    for both views, so neither the upsampled nor the padded image is built.
+    Returns the crops and, per sample, the overlap box of each crop in patch
+    units as [N, 4] tensors (row_start, row_end, col_start, col_end).
+    """
     def __init__(self, crop_size=224, up_size=256, padding=32, patch_size=16):
         super().__init__()
         self.crop_size = crop_size
         self.up_size = up_size
         self.padding = padding
         self.patch_size = patch_size
-        self.upsample = nn.Upsample(size=up_size, mode='bilinear')
-        self.pad = TF.Pad(padding=self.padding, fill=0,
-                          padding_mode='constant')
+
+    def _grid_coords(self, offset, size):
+        """
+        offset: [N, 2] crop offsets (view 1, view 2) in the padded image
+        size: input height or width
+        returns normalized grid_sample coordinates [N, 2, crop_size]
+        """
+        u = offset.unsqueeze(-1) + torch.arange(self.crop_size, device=offset.device) - self.padding
+        # source pixel of the bilinear upsample (align_corners=False, edges clamped)
+        src = ((u + 0.5) * size / self.up_size - 0.5).clamp(0, size - 1)
+        grid = (2 * src + 1) / size - 1
+        # padding: far outside the input so that zeros padding gives exact zeros
+        return torch.where((u >= 0) & (u < self.up_size), grid, torch.full_like(grid, -2.))
 
     def forward(self, x):
-        img = self.upsample(x)
-        img = self.pad(img)
+        N, _, H, W = x.shape
+        h = self.crop_size // self.patch_size
 
         upbound = (self.up_size + self.padding -
                    self.crop_size) // self.patch_size
+        # per-sample offsets: [N, 2 views, (row, col)]
+        offset = torch.randint(0, upbound, (N, 2, 2), device=x.device) * self.patch_size
 
-        random1_lo = torch.randint(0, upbound, (2, 1)) * self.patch_size
-        random2_lo = torch.randint(0, upbound, (2, 1)) * self.patch_size
-        img1 = img[:, :, random1_lo[0]:random1_lo[0] + self.crop_size,
-                   random1_lo[1]:random1_lo[1] + self.crop_size].clone()
-        img2 = img[:, :, random2_lo[0]:random2_lo[0] + self.crop_size,
-                   random2_lo[1]:random2_lo[1] + self.crop_size].clone()
-
-        # same1_lo =
-        mask_all = torch.zeros(img.shape)
-        mask_all[:, :, random1_lo[0]:random1_lo[0] + self.crop_size,
-                 random1_lo[1]:random1_lo[1] + self.crop_size] += 1
-        mask_all[:, :, random2_lo[0]:random2_lo[0] + self.crop_size,
-                 random2_lo[1]:random2_lo[1] + self.crop_size] += 1
-        # mask1 = mask_all[:, :, random1_lo[0]:random1_lo[0] + self.crop_size,
-        #                  random1_lo[1]:random1_lo[1] + self.crop_size].clone()-1
-        # mask2 = mask_all[:, :, random2_lo[0]:random2_lo[0] + self.crop_size,
-        #                  random2_lo[1]:random2_lo[1] + self.crop_size].clone()-1
-        if random2_lo[0] > random1_lo[0]:
-            mask1 = [random2_lo[0] - random1_lo[0], self.crop_size]
-            mask2 = [0, self.crop_size - random2_lo[0] + random1_lo[0]]
-        else:
-            mask1 = [0, self.crop_size - random1_lo[0] + random2_lo[0]]
-            mask2 = [random1_lo[0] - random2_lo[0], self.crop_size]
-
-        if random2_lo[1] > random1_lo[1]:
-            mask1.append(random2_lo[1] - random1_lo[1])
-            mask1.append(self.crop_size)
-            mask2.append(0)
-            mask2.append(self.crop_size - random2_lo[1] + random1_lo[1])
-        else:
-            mask1.append(0)
-            mask1.append(self.crop_size - random1_lo[1] + random2_lo[1])
-            mask2.append(random1_lo[1] - random2_lo[1])
-            mask2.append(self.crop_size)
+        gy = self._grid_coords(offset[:, :, 0], H).to(x.dtype)
+        gx = self._grid_coords(offset[:, :, 1], W).to(x.dtype)
+        grid = torch.stack([gx.unsqueeze(2).expand(-1, -1, self.crop_size, -1),
+                            gy.unsqueeze(3).expand(-1, -1, -1, self.crop_size)], dim=-1)
+        # both views stacked along the height: [N, C, 2 * crop_size, crop_size]
+        img = F.grid_sample(x, grid.view(N, 2 * self.crop_size, self.crop_size, 2),
+                            mode='bilinear', padding_mode='zeros', align_corners=False)
+        img1, img2 = img[:, :, :self.crop_size], img[:, :, self.crop_size:]
 
-        for i in range(4):
-            mask1[i] = mask1[i] // self.patch_size
-            mask2[i] = mask2[i] // self.patch_size
+        # shift of view 2 w.r.t. view 1 in patches
+        d = (offset[:, 1] - offset[:, 0]) // self.patch_size
+        box1 = torch.stack([d[:, 0].clamp(min=0), h + d[:, 0].clamp(max=0),
+                            d[:, 1].clamp(min=0), h + d[:, 1].clamp(max=0)], dim=1)
+        box2 = torch.stack([(-d[:, 0]).clamp(min=0), h - d[:, 0].clamp(min=0),
+                            (-d[:, 1]).clamp(min=0), h - d[:, 1].clamp(min=0)], dim=1)
 
-        return img1, img2, mask1, mask2
+        return img1, img2, box1, box2
 
 
 class MaskedAutoencoderViT(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
     """
+    compile_targets = ('forward_encoder', 'forward_decoder', 'forward_loss', 'forward_DCR_loss')  # see util/compile.py
 
     def __init__(self, img_size=224, patch_size=16, in_chans=3,
                  embed_dim=1024, depth=24, num_heads=16,
                  decoder_embed_dim=512, decoder_depth=8, decoder_num_heads=16,
-                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False):
+                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
+                 decode_masked_only=False, decoder_type='self', decoder_query_self_attn=False,
+                 decode_ratio=1.):
         super().__init__()
 
         # --------------------------------------------------------------------------
@@ -122,10 +122,18 @@ class MaskedAutoencoderViT(nn.Module):
         self.decoder_pos_embed = nn.Parameter(torch.zeros(
             1, num_patches + 1, decoder_embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
-        self.decoder_blocks = nn.ModuleList([
-            Block(decoder_embed_dim, decoder_num_heads, mlp_ratio,
-                  qkv_bias=True, norm_layer=norm_layer)
-            for i in range(decoder_depth)])
+        assert decoder_type in ('self', 'cross'), 'decoder_type must be self or cross'
+        self.cross_decoder = None
+        if decoder_type == 'cross':
+            # masked-token queries cross-attend to the visible tokens (CAE regressor blocks)
+            self.decoder_blocks = nn.ModuleList()
+            self.cross_decoder = CrossAttentionDecoder(decoder_embed_dim, decoder_depth, decoder_num_heads, mlp_ratio,
+                                                       norm_layer=norm_layer, query_self_attn=decoder_query_self_attn)
+        else:
+            self.decoder_blocks = nn.ModuleList([
+                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio,
+                      qkv_bias=True, norm_layer=norm_layer)
+                for i in range(decoder_depth)])
 
         self.decoder_norm = norm_layer(decoder_embed_dim)
         self.decoder_pred = nn.Linear(
@@ -134,6 +142,10 @@ class MaskedAutoencoderViT(nn.Module):
         # self.simsima_loss = nn.CosineSimilarity(dim=1)
 
         self.norm_pix_loss = norm_pix_loss
+        # fraction of the masked patches reconstructed per sample (random subset, see forward)
+        self.decode_ratio = decode_ratio
+        # the cross-attention decoder / partial reconstruction only ever predict masked patches
+        self.decode_masked_only = decode_masked_only or decoder_type == 'cross' or decode_ratio < 1
 
         self.initialize_weights()
 
@@ -253,29 +265,44 @@ class MaskedAutoencoderViT(nn.Module):
     def forward_decoder(self, x, ids_restore):
         # embed tokens
         x = self.decoder_embed(x)
+        len_keep = x.shape[1] - 1
+
+        if self.cross_decoder is not None:
+            # masked tokens only, in masked_ids order
+            x = self.cross_decoder(x, self.mask_token, self.decoder_pos_embed, ids_restore, self.decode_ratio)
+            return self.decoder_pred(self.decoder_norm(x))
+
+        if self.decode_ratio < 1:
+            # partial reconstruction: the kept tokens and decode_ratio of the mask tokens,
+            # ids_restore now indexes the decoder tokens
+            x, ids_restore = partial_decoder_input(x, self.mask_token, self.decoder_pos_embed,
+                                                   ids_restore, self.decode_ratio)
+        else:
+            # append mask tokens to sequence
+            mask_tokens = self.mask_token.repeat(
+                x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
+            x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+            x_ = torch.gather(
+                x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
+            x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
 
-        # append mask tokens to sequence
-        mask_tokens = self.mask_token.repeat(
-            x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
-        x_ = torch.gather(
-            x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
-
-        # add pos embed
-        x = x + self.decoder_pos_embed
+            # add pos embed
+            x = x + self.decoder_pos_embed
 
         # apply Transformer blocks
         for blk in self.decoder_blocks:
             x = blk(x)
+        # remove cls token; with decode_masked_only keep the masked tokens only,
+        # the visible ones never reach decoder_norm / decoder_pred / the loss
+        x = x[:, 1:, :]
+        if self.decode_masked_only:
+            ids_masked = masked_ids(ids_restore >= len_keep, x.shape[1] - len_keep)
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
         x = self.decoder_norm(x)
 
         # predictor projection
         x = self.decoder_pred(x)
 
-        # remove cls token
-        x = x[:, 1:, :]
-
         return x
 
     def unpatchify_mask(self, x, ids_restore):
@@ -294,52 +321,77 @@ class MaskedAutoencoderViT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], p * p * 3, h, h))
         return imgs
 
-    def sim_loss(self, r, z, mask1, mask2):
-        r = r[:, :, mask1[0]:mask1[1], mask1[2]:mask1[3]]
-        z = z[:, :, mask2[0]:mask2[1], mask2[2]:mask2[3]]
-        rz = nn.CosineSimilarity(dim=1)(r, z)
-        return rz
-
-    def forward_DCR_loss(self, x1, x2, mask1, mask2, ids_restore1, ids_restore2):
-        img1 = self.unpatchify_mask(x1, ids_restore1)
-        img2 = self.unpatchify_mask(x2, ids_restore2)
-        r1 = self.dcr(img1)
-        r2 = self.dcr(img2)
-        z2 = img2.detach()
-        z1 = img1.detach()
+    def sim_loss(self, r, z, box_r, box_z):
+        """
+        Mean cosine similarity of r and z over their (per-sample) overlap.
+        r, z: [N, C, h, w]
+        box_r, box_z: [N, 4] overlap boxes (row_start, row_end, col_start, col_end) in r and z
+        """
+        N, C, h, w = r.shape
+        rows = torch.arange(h, device=r.device)
+        cols = torch.arange(w, device=r.device)
+        # align z with r: patch (i, j) of r is patch (i + dy, j + dx) of z
+        shift = box_z - box_r
+        idx_h = (rows + shift[:, :1]).clamp(0, h - 1)
+        idx_w = (cols + shift[:, 2:3]).clamp(0, w - 1)
+        z = torch.gather(z, 2, idx_h.view(N, 1, h, 1).expand(-1, C, -1, w))
+        z = torch.gather(z, 3, idx_w.view(N, 1, 1, w).expand(-1, C, h, -1))
+
+        mask = ((rows >= box_r[:, :1]) & (rows < box_r[:, 1:2])).unsqueeze(2) & \
+            ((cols >= box_r[:, 2:3]) & (cols < box_r[:, 3:4])).unsqueeze(1)  # [N, h, w]
+        rz = F.cosine_similarity(r, z, dim=1)
+        return (rz * mask).sum() / mask.sum().clamp(min=1)
+
+    def forward_DCR_loss(self, x, mask1, mask2, ids_restore):
+        """
+        x: [2N, 1 + len_keep, D], latents of view 1 followed by view 2
+        ids_restore: [2N, L]
+        """
+        img = self.unpatchify_mask(x, ids_restore)
+        r1, r2 = self.dcr(img).chunk(2)
+        z1, z2 = img.detach().chunk(2)
 
-        return -(self.sim_loss(r1, z2, mask1, mask2).mean() + self.sim_loss(r2, z1, mask1, mask2).mean()) * 0.5
+        return -(self.sim_loss(r1, z2, mask1, mask2) + self.sim_loss(r2, z1, mask2, mask1)) * 0.5
 
-    def forward_loss(self, imgs, pred, mask):
+    def forward_loss(self, imgs, pred, mask, target=None):
         """
         imgs: [N, 3, H, W]
-        pred: [N, L, p*p*3]
+        pred: [N, L, p*p*3], or [N, L_masked, p*p*3] with decode_masked_only
+              (with decode_ratio < 1, mask only marks the decoded subset)
         mask: [N, L], 0 is keep, 1 is remove, 
+        target: [N, L, p*p*3], optional targets precomputed in the data loader
         """
-        target = self.patchify(imgs)
-        if self.norm_pix_loss:
-            mean = target.mean(dim=-1, keepdim=True)
-            var = target.var(dim=-1, keepdim=True)
-            target = (target - mean) / (var + 1.e-6)**.5
+        # with decode_masked_only: targets of the masked patches only, in the order of masked_ids
+        ids = masked_ids(mask, pred.shape[1]) if self.decode_masked_only else None
+        target = patch_targets(imgs, self.patch_embed.patch_size[0], ids,
+                               norm_pix=self.norm_pix_loss, precomputed=target)
 
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+        if self.decode_masked_only:
+            return loss.mean()  # every predicted patch is a removed one
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
         return loss
 
-    def forward(self, imgs, mask_ratio=0.75):
+    def forward(self, imgs, mask_ratio=0.75, target=None):
         img1, img2, mask1, mask2 = self.crop_img(imgs)
-        latent1, mask_encoder1, ids_restore1 = self.forward_encoder(
-            img1, mask_ratio)
+        # both views go through a single encoder call, masks are drawn per sample
+        latent, mask_encoder, ids_restore = self.forward_encoder(
+            torch.cat([img1, img2], dim=0), mask_ratio)
+        latent1 = latent[:imgs.shape[0]]
+        mask_encoder1 = mask_encoder[:imgs.shape[0]]
+        ids_restore1 = ids_restore[:imgs.shape[0]]
+        loss_mask1 = mask_encoder1
+        if self.decode_ratio < 1:
+            # reconstruct a random fixed-size subset of the masked patches only
+            ids_restore1, loss_mask1 = decode_subset(ids_restore1, latent1.shape[1] - 1, self.decode_ratio)
+
+        # only view 1 is reconstructed, view 2 is never decoded
         pred = self.forward_decoder(latent1, ids_restore1)  # [N, L, p*p*3]
-        latent2, mask_encoder2, ids_restore2 = self.forward_encoder(
-            img2, mask_ratio)
-        # # print(img1[:,:,mask1[0]:mask1[1],mask1[2]:mask1[3]] == img2[:,:,mask2[0]:mask2[1],mask2[2]:mask2[3]])
-        loss_DCR = self.forward_DCR_loss(
-            latent1, latent2, mask1, mask2, ids_restore1, ids_restore2)
+        loss_DCR = self.forward_DCR_loss(latent, mask1, mask2, ids_restore)
 
-        loss = self.forward_loss(imgs, pred, mask_encoder1)
+        loss = self.forward_loss(imgs, pred, loss_mask1, target)
         return loss + loss_DCR
 
 
@@ -372,6 +424,11 @@ mae_vit_base_patch16 = mae_vit_base_patch16_dec512d8b  # decoder: 512 dim, 8 blo
 mae_vit_large_patch16 = mae_vit_large_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_huge_patch14 = mae_vit_huge_patch14_dec512d8b  # decoder: 512 dim, 8 blocks
 
+# lightweight decoder: only the masked-token queries attend, to the visible tokens
+mae_vit_base_patch16_cross = partial(mae_vit_base_patch16_dec512d8b, decoder_type='cross')
+mae_vit_large_patch16_cross = partial(mae_vit_large_patch16_dec512d8b, decoder_type='cross')
+mae_vit_huge_patch14_cross = partial(mae_vit_huge_patch14_dec512d8b, decoder_type='cross')
+
 
 if __name__ == '__main__':
     model = mae_vit_base_patch16().cuda(1)
@@ -19,10 +19,13 @@ import torch.nn.functional as F
 from timm.models.vision_transformer import PatchEmbed, Block, Mlp, VisionTransformer
 
 from util.pos_embed import get_2d_sincos_pos_embed
+from util.masking import masked_ids, decode_subset, partial_decoder_input
+from util.targets import patch_targets
+from models_common import CrossAttentionDecoder
 from operator import mul
 import math
 from functools import partial, reduce
-from util.diffaug import DiffAugment
+from util.frozen import FrozenModule
 
 class VisionTransformerMoCo(VisionTransformer):
     def __init__(self, stop_grad_conv1=False, **kwargs):
@@ -95,7 +98,9 @@ class MaskedAutoencoderViT(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3,
                  embed_dim=1024, depth=24, num_heads=16,
                  decoder_embed_dim=512, decoder_depth=8, decoder_num_heads=16,
-                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False):
+                 mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
+                 decode_masked_only=False, decoder_type='self', decoder_query_self_attn=False,
+                 decode_ratio=1.):
         super().__init__()
 
         # --------------------------------------------------------------------------
@@ -124,10 +129,18 @@ class MaskedAutoencoderViT(nn.Module):
         self.decoder_pos_embed = nn.Parameter(torch.zeros(
             1, num_patches + 1, decoder_embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
-        self.decoder_blocks = nn.ModuleList([
-            Block(decoder_embed_dim, decoder_num_heads, mlp_ratio,
-                  qkv_bias=True,  norm_layer=norm_layer)
-            for i in range(decoder_depth)])
+        assert decoder_type in ('self', 'cross'), 'decoder_type must be self or cross'
+        self.cross_decoder = None
+        if decoder_type == 'cross':
+            # masked-token queries cross-attend to the visible tokens (CAE regressor blocks)
+            self.decoder_blocks = nn.ModuleList()
+            self.cross_decoder = CrossAttentionDecoder(decoder_embed_dim, decoder_depth, decoder_num_heads, mlp_ratio,
+                                                       norm_layer=norm_layer, query_self_attn=decoder_query_self_attn)
+        else:
+            self.decoder_blocks = nn.ModuleList([
+                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio,
+                      qkv_bias=True,  norm_layer=norm_layer)
+                for i in range(decoder_depth)])
 
         self.decoder_norm = norm_layer(decoder_embed_dim)
         self.decoder_pred = nn.Linear(
@@ -135,6 +148,10 @@ class MaskedAutoencoderViT(nn.Module):
         # --------------------------------------------------------------------------
 
         self.norm_pix_loss = norm_pix_loss
+        # fraction of the masked patches reconstructed per sample (random subset, see forward)
+        self.decode_ratio = decode_ratio
+        # the cross-attention decoder / partial reconstruction only ever predict masked patches
+        self.decode_masked_only = decode_masked_only or decoder_type == 'cross' or decode_ratio < 1
 
         self.initialize_weights()
 
@@ -254,58 +271,80 @@ class MaskedAutoencoderViT(nn.Module):
     def forward_decoder(self, x, ids_restore):
         # embed tokens
         x = self.decoder_embed(x)
+        len_keep = x.shape[1] - 1
+
+        if self.cross_decoder is not None:
+            # masked tokens only, in masked_ids order
+            x = self.cross_decoder(x, self.mask_token, self.decoder_pos_embed, ids_restore, self.decode_ratio)
+            return self.decoder_pred(self.decoder_norm(x))
+
+        if self.decode_ratio < 1:
+            # partial reconstruction: the kept tokens and decode_ratio of the mask tokens,
+            # ids_restore now indexes the decoder tokens
+            x, ids_restore = partial_decoder_input(x, self.mask_token, self.decoder_pos_embed,
+                                                   ids_restore, self.decode_ratio)
+        else:
+            # append mask tokens to sequence
+            mask_tokens = self.mask_token.repeat(
+                x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
+            x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+            x_ = torch.gather(
+                x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
+            x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
 
-        # append mask tokens to sequence
-        mask_tokens = self.mask_token.repeat(
-            x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
-        x_ = torch.gather(
-            x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
-
-        # add pos embed
-        x = x + self.decoder_pos_embed
+            # add pos embed
+            x = x + self.decoder_pos_embed
 
         # apply Transformer blocks
         for blk in self.decoder_blocks:
             x = blk(x)
+        # remove cls token; with decode_masked_only keep the masked tokens only,
+        # the visible ones never reach decoder_norm / decoder_pred / the loss
+        x = x[:, 1:, :]
+        if self.decode_masked_only:
+            ids_masked = masked_ids(ids_restore >= len_keep, x.shape[1] - len_keep)
+            x = torch.gather(x, dim=1, index=ids_masked.unsqueeze(-1).expand(-1, -1, x.shape[2]))
         x = self.decoder_norm(x)
 
         # predictor projection
         x = self.decoder_pred(x)
 
-        # remove cls token
-        x = x[:, 1:, :]
-
         return x
 
-    def forward_loss(self, imgs, pred, mask):
+    def forward_loss(self, imgs, pred, mask, target=None):
         """
         imgs: [N, 3, H, W]
-        pred: [N, L, p*p*3]
+        pred: [N, L, p*p*3], or [N, L_masked, p*p*3] with decode_masked_only
+              (with decode_ratio < 1, mask only marks the decoded subset)
         mask: [N, L], 0 is keep, 1 is remove, 
+        target: [N, L, p*p*3], optional targets precomputed in the data loader
         """
-        target = self.patchify(imgs)
-        if self.norm_pix_loss:
-            mean = target.mean(dim=-1, keepdim=True)
-            var = target.var(dim=-1, keepdim=True)
-            target = (target - mean) / (var + 1.e-6)**.5
+        # with decode_masked_only: targets of the masked patches only, in the order of masked_ids
+        ids = masked_ids(mask, pred.shape[1]) if self.decode_masked_only else None
+        target = patch_targets(imgs, self.patch_embed.patch_size[0], ids,
+                               norm_pix=self.norm_pix_loss, precomputed=target)
 
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+        if self.decode_masked_only:
+            return loss.mean()  # every predicted patch is a removed one
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
         return loss
 
-    def forward(self, imgs, mask_ratio=0.75):
+    def forward(self, imgs, mask_ratio=0.75, target=None):
         latent, mask, ids_restore = self.forward_encoder(imgs, mask_ratio)
+        loss_mask = mask
+        if self.decode_ratio < 1:
+            # reconstruct a random fixed-size subset of the masked patches only
+            ids_restore, loss_mask = decode_subset(ids_restore, latent.shape[1] - 1, self.decode_ratio)
         pred = self.forward_decoder(latent, ids_restore)  # [N, L, p*p*3]
-        loss = self.forward_loss(imgs, pred, mask)
+        loss = self.forward_loss(imgs, pred, loss_mask, target)
         return loss, latent, mask, ids_restore
 
 
 class MaskedAutoencoderViT_MoCo(nn.Module):
-    def __init__(self, **kwargs):
+    def __init__(self, teacher_dtype='bf16', **kwargs):
         super().__init__()
         self.MAE = MaskedAutoencoderViT(**kwargs)
         self.pro = nn.Sequential(
@@ -316,6 +355,8 @@ class MaskedAutoencoderViT_MoCo(nn.Module):
                                           norm_layer=partial(nn.LayerNorm, eps=1e-6))
 
         self.apply(self._init_weights)
+        # frozen teacher: reduced-precision weights, inference mode, no grads
+        self.MoCo = FrozenModule(self.MoCo, dtype=teacher_dtype)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -333,13 +374,20 @@ class MaskedAutoencoderViT_MoCo(nn.Module):
         self.pro.train(mode)
         return self
 
-    def forward(self, imgs, mask_ratio=0.75):
-        imgs = DiffAugment(imgs, policy='color,translation,cutout') 
-        loss_MAE, latent, mask, ids_restore = self.MAE(imgs, mask_ratio)
+    def forward(self, imgs, mask_ratio=0.75, teacher_target=None, target=None):
+        """
+        teacher_target: [N, 1, D] CLS features computed out of process (see
+        util/teacher_server.py) from the same imgs.
+        target: [N, L, p*p*3] pixel targets precomputed in the data loader.
+        """
+        loss_MAE, latent, mask, ids_restore = self.MAE(imgs, mask_ratio, target)
 
         latent = self.pro(latent)
 
-        MoCo_x = self.MoCo(imgs)
+        if teacher_target is None:
+            MoCo_x = self.MoCo(imgs)
+        else:
+            MoCo_x = teacher_target
         
         target_torken = 'cls_token'
         if target_torken == 'img_token':
@@ -402,3 +450,8 @@ def mae_vit_huge_patch14_dec512d8b(**kwargs):
 mae_vit_base_patch16 = mae_vit_base_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_large_patch16 = mae_vit_large_patch16_dec512d8b  # decoder: 512 dim, 8 blocks
 mae_vit_huge_patch14 = mae_vit_huge_patch14_dec512d8b  # decoder: 512 dim, 8 blocks
+
+# lightweight decoder: only the masked-token queries attend, to the visible tokens
+mae_vit_base_patch16_cross = partial(mae_vit_base_patch16_dec512d8b, decoder_type='cross')
+mae_vit_large_patch16_cross = partial(mae_vit_large_patch16_dec512d8b, decoder_type='cross')
+mae_vit_huge_patch14_cross = partial(mae_vit_huge_patch14_dec512d8b, decoder_type='cross')
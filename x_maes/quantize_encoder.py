@@ -0,0 +1,112 @@
+# --------------------------------------------------------
+# Dynamic int8 quantization of a pretrained encoder (any variant) for CPU
+# inference (util/export.py), checked against fp32 by kNN on a labeled
+# subset: top-1 of both, agreement of their predictions and feature cosine.
+# Writes the quantized encoder as frozen TorchScript (encoder_int8.pt).
+#
+# python quantize_encoder.py --variant models_mae_NN --model mae_vit_base_patch16_dec512d8b \
+#     --resume checkpoint.pth --data_path <images> --output_dir <export>
+# --------------------------------------------------------
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from util.features import VARIANTS, load_encoder
+from util.export import ExportEncoder, export_torchscript, model_size_mb, quantize_dynamic_int8
+from util.knn import KNNMonitor, knn_classify
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE encoder int8 quantization', add_help=False)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--variant', default='models_mae_CodeBook', choices=VARIANTS,
+                        help='model module of the checkpoint')
+    parser.add_argument('--model', default='mae_vit_base_patch16_dec512d8b', type=str, metavar='MODEL',
+                        help='Name of model in --variant')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size (fixed in the exported graph)')
+    parser.add_argument('--pool', default='cls', choices=['cls', 'mean'],
+                        help='cls token or mean of the patch tokens')
+    parser.add_argument('--resume', default='',
+                        help='pretraining checkpoint')
+    parser.add_argument('--data_path', default='/datasets01/imagenet_full_size/061417/', type=str,
+                        help='dataset path (ImageFolder layout with train / val)')
+    parser.add_argument('--num_train', default=5000, type=int,
+                        help='labeled train images in the kNN bank (<= 0: all)')
+    parser.add_argument('--num_val', default=1000, type=int,
+                        help='val images classified by kNN (<= 0: all)')
+    parser.add_argument('--knn_k', default=20, type=int)
+    parser.add_argument('--knn_temperature', default=0.07, type=float)
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--iters', default=10, type=int,
+                        help='timed encoder calls at --batch_size for the throughput')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output_dir', default='./output_export',
+                        help='where to write encoder_int8.pt and quantize.json')
+    return parser
+
+
+@torch.no_grad()
+def throughput(module, imgs, iters):
+    module(imgs)  # warmup
+    start = time.time()
+    for _ in range(iters):
+        module(imgs)
+    return imgs.shape[0] * iters / (time.time() - start)
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+    model = load_encoder(args)
+    encoders = {'fp32': ExportEncoder(model, args.pool).eval()}
+    encoders['int8'] = quantize_dynamic_int8(encoders['fp32'])
+
+    torch.manual_seed(args.seed)
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    stats = {}
+    for name, module in encoders.items():
+        stats[name] = {'size_mb': model_size_mb(module), 'img_per_s': throughput(module, imgs, args.iters)}
+        print('%s: %.1f MB, %.1f img/s (%d threads)' % (
+            name, stats[name]['size_mb'], stats[name]['img_per_s'], torch.get_num_threads()))
+
+    monitor = KNNMonitor(args.data_path, args.input_size, 'cpu', num_train=args.num_train, num_val=args.num_val,
+                         k=args.knn_k, temperature=args.knn_temperature, batch_size=args.batch_size,
+                         num_workers=args.num_workers, seed=args.seed)
+    predictions, queries = {}, {}
+    for name, module in encoders.items():
+        bank, bank_labels = monitor.features(module, monitor.loaders[0])
+        queries[name], labels = monitor.features(module, monitor.loaders[1])
+        scores = knn_classify(bank, bank_labels, queries[name], monitor.num_classes, monitor.k, monitor.temperature)
+        predictions[name] = scores.argmax(dim=1)
+        stats[name]['knn_top1'] = (predictions[name] == labels).float().mean().item() * 100
+        print('%s: kNN top-1 %.2f%% (%d bank / %d queries)' % (
+            name, stats[name]['knn_top1'], bank.shape[0], labels.shape[0]))
+    agreement = (predictions['int8'] == predictions['fp32']).float().mean().item() * 100
+    cosine = F.cosine_similarity(queries['int8'], queries['fp32'], dim=1)
+    print('int8 vs fp32: kNN agreement %.2f%%, feature cosine mean %.4f / min %.4f, %.2fx smaller, %.2fx faster' % (
+        agreement, cosine.mean().item(), cosine.min().item(), stats['fp32']['size_mb'] / stats['int8']['size_mb'],
+        stats['int8']['img_per_s'] / stats['fp32']['img_per_s']))
+
+    path = os.path.join(args.output_dir, 'encoder_int8.pt')
+    export_torchscript(encoders['int8'], imgs[:2], path)
+    print('TorchScript: %s' % path)
+    with open(os.path.join(args.output_dir, 'quantize.json'), 'w') as f:
+        json.dump({'variant': args.variant, 'model': args.model, 'checkpoint': args.resume, 'pool': args.pool,
+                   'input_shape': ['batch', 3, args.input_size, args.input_size],
+                   'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225], 'file': os.path.basename(path),
+                   'fp32': stats['fp32'], 'int8': stats['int8'], 'knn_agreement': agreement,
+                   'cosine_mean': cosine.mean().item(), 'cosine_min': cosine.min().item()}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,59 @@
+# --------------------------------------------------------
+# Selective activation checkpointing of transformer blocks
+#
+# Recomputes the activations of the chosen blocks (or of their attention /
+# MLP part only) in the backward pass instead of keeping them, trading
+# compute for memory so that larger per-GPU batches fit.
+# --------------------------------------------------------
+
+from functools import partial
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+CHECKPOINT_STACKS = ('blocks', 'decoder_blocks', 'regressor_blocks', 'self_blocks')
+# sub-layers per block type: timm / CAE Block, AGAT Block_AGAT, CAE RegressorBlock
+_PARTS = {
+    'attn': ('attn', 'cross_attn'),
+    'mlp': ('mlp', 'mlp_cross'),
+}
+
+
+def _checkpointed_forward(forward, *args, **kwargs):
+    if torch.is_grad_enabled():
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return forward(*args, **kwargs)
+
+
+def _wrap(module):
+    # patch the instance so that parameter names / state_dict keys do not change
+    if 'forward' not in vars(module):
+        module.forward = partial(_checkpointed_forward, module.forward)
+
+
+def apply_activation_checkpointing(model, every=1, part='block', stacks=CHECKPOINT_STACKS):
+    """Checkpoint every `every`-th block (0, k, 2k, ...) of the ModuleLists named in `stacks`.
+
+    part: 'block' recomputes the whole block, 'attn' / 'mlp' only its attention
+    (self or cross) / MLP sub-layer. Returns the names of the wrapped modules.
+    """
+    assert part in ('block',) + tuple(_PARTS), 'part must be block, attn or mlp'
+    if every <= 0:
+        return []
+    wrapped = []
+    for name, module in model.named_modules():
+        if name.rsplit('.', 1)[-1] not in stacks or not isinstance(module, torch.nn.ModuleList):
+            continue
+        for i, block in enumerate(module):
+            # frozen towers (e.g. FrozenModule teachers) never keep activations for backward
+            if i % every or not any(p.requires_grad for p in block.parameters()):
+                continue
+            if part == 'block':
+                targets = [('', block)]
+            else:
+                targets = [(n, getattr(block, n)) for n in _PARTS[part] if hasattr(block, n)]
+            for sub, target in targets:
+                _wrap(target)
+                wrapped.append('%s.%d%s' % (name, i, '.' + sub if sub else ''))
+    return wrapped
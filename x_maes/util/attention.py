@@ -0,0 +1,42 @@
+# --------------------------------------------------------
+# Attention backend of the custom attention modules
+# (models_common.Attention / CrossAttention, models_mae_AGAT.Attention_AGAT)
+#
+# By default they call F.scaled_dot_product_attention, which picks the
+# flash / memory-efficient / math kernel for the device (CPU included) and
+# never materializes [B, H, N, N] probabilities. Set XMAES_EXPLICIT_ATTN=1,
+# or call set_fused_attn(model, False), to force q @ k.T -> softmax -> @ v.
+# The modules pass scale=, which scaled_dot_product_attention takes from
+# torch 2.1 on; older versions always use the explicit path.
+# --------------------------------------------------------
+
+import os
+
+import torch
+import torch.nn.functional as F
+
+
+def _sdpa_has_scale():
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        return False
+    major, minor = (int(v) for v in torch.__version__.split('.')[:2])
+    return (major, minor) >= (2, 1)
+
+
+_HAS_SDPA = _sdpa_has_scale()
+_FORCE_EXPLICIT = os.environ.get('XMAES_EXPLICIT_ATTN', '0') == '1'
+
+
+def use_fused_attn():
+    """Default backend for newly built attention modules."""
+    return _HAS_SDPA and not _FORCE_EXPLICIT
+
+
+def set_fused_attn(model, enabled=True):
+    """Switch every attention module of `model` to the fused (True) or explicit (False) path."""
+    n = 0
+    for m in model.modules():
+        if hasattr(m, 'fused_attn'):
+            m.fused_attn = enabled and _HAS_SDPA
+            n += 1
+    return n
@@ -0,0 +1,72 @@
+# --------------------------------------------------------
+# Memory-mapped store of discrete codebook indices
+#
+# <root>/codes.u16      uint16 [N, L] code indices, one row per image
+# <root>/index.json     shape, codebook size and (path, label) per row
+# <root>/codebook.pth   codebook embedding weight [codebook_size, emb_dim]
+# --------------------------------------------------------
+
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class CodeStoreWriter:
+    def __init__(self, root, num_samples, seq_len, codebook_size):
+        assert codebook_size <= np.iinfo(np.uint16).max + 1, 'codes do not fit in uint16'
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.codebook_size = codebook_size
+        self.codes = np.memmap(os.path.join(root, 'codes.u16'), mode='w+', dtype=np.uint16,
+                               shape=(num_samples, seq_len))
+        self.offset = 0
+
+    def write(self, codes):
+        n = codes.shape[0]
+        self.codes[self.offset:self.offset + n] = codes.cpu().numpy().astype(np.uint16)
+        self.offset += n
+
+    def close(self, samples, classes=None, embed_weight=None):
+        self.codes.flush()
+        index = {
+            'shape': list(self.codes.shape),
+            'dtype': 'uint16',
+            'codebook_size': self.codebook_size,
+            'classes': classes,
+            'samples': samples,
+        }
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        if embed_weight is not None:
+            torch.save(embed_weight.detach().cpu(), os.path.join(self.root, 'codebook.pth'))
+
+
+class CodeDataset(torch.utils.data.Dataset):
+    """ Dataset over an exported code store.
+
+    Returns (codes [L] int64, label), or (z_q [L, emb_dim], label) when
+    `return_embeddings` is set, using the stored codebook embedding.
+    """
+    def __init__(self, root, return_embeddings=False):
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.root = root
+        self.samples = self.index['samples']
+        self.classes = self.index['classes']
+        self.codes = None  # opened lazily, once per worker
+        self.embed_weight = torch.load(os.path.join(root, 'codebook.pth')) if return_embeddings else None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        if self.codes is None:
+            self.codes = np.memmap(os.path.join(self.root, 'codes.u16'), mode='r', dtype=np.uint16,
+                                   shape=tuple(self.index['shape']))
+        codes = torch.from_numpy(self.codes[index].astype(np.int64))
+        target = self.samples[index][1]
+        if self.embed_weight is not None:
+            return torch.nn.functional.embedding(codes, self.embed_weight), target
+        return codes, target
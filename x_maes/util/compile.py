@@ -0,0 +1,94 @@
+# --------------------------------------------------------
+# torch.compile of the MAE variants, stage by stage
+#
+# Compiles forward_encoder / forward_decoder / forward_loss of every
+# submodule that has them (or the methods listed in a module's
+# `compile_targets`, e.g. the CAE encoder and regressor), with static
+# shapes, and keeps the inductor / autograd caches in a directory that
+# survives restarts.
+# --------------------------------------------------------
+
+import os
+import time
+
+import torch
+
+
+COMPILE_TARGETS = ('forward_encoder', 'forward_decoder', 'forward_loss')
+CACHE_ARTIFACTS = 'cache_artifacts.bin'
+
+
+class CompiledMethod:
+    """ torch.compile'd bound method that reports how long its first call
+    (tracing + compilation of the forward graph) took.
+    """
+    def __init__(self, name, fn, **compile_kwargs):
+        self.name = name
+        self.compiled = torch.compile(fn, **compile_kwargs)
+        self.compile_time = None
+
+    def __call__(self, *args, **kwargs):
+        if self.compile_time is not None:
+            return self.compiled(*args, **kwargs)
+        start = time.time()
+        out = self.compiled(*args, **kwargs)
+        self.compile_time = time.time() - start
+        print('Compiled %s in %.1fs' % (self.name, self.compile_time))
+        return out
+
+
+def compile_model(model, mode=None):
+    """Replace the stage methods of `model` and its submodules by compiled versions.
+
+    Parameters and state_dict keys are untouched (no `_orig_mod.` prefix), so
+    checkpoints stay interchangeable with eager runs. Returns the compiled names.
+    """
+    compiled = []
+    for module_name, module in model.named_modules():
+        for attr in getattr(module, 'compile_targets', COMPILE_TARGETS):
+            if not callable(getattr(type(module), attr, None)):
+                continue
+            name = '%s.%s' % (module_name, attr) if module_name else attr
+            setattr(module, attr, CompiledMethod(name, getattr(module, attr), mode=mode, dynamic=False))
+            compiled.append(name)
+    return compiled
+
+
+def compile_times(model):
+    """Seconds spent in the first call of every compiled method so far."""
+    times = {}
+    for module in model.modules():
+        for value in vars(module).values():
+            if isinstance(value, CompiledMethod) and value.compile_time is not None:
+                times[value.name] = value.compile_time
+    return times
+
+
+def setup_compile_cache(cache_dir):
+    """Keep the compile caches in `cache_dir` and load the artifacts of a previous launch."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(cache_dir, 'inductor')
+    os.environ['TRITON_CACHE_DIR'] = os.path.join(cache_dir, 'triton')
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    if hasattr(torch._functorch.config, 'enable_autograd_cache'):
+        torch._functorch.config.enable_autograd_cache = True
+
+    path = os.path.join(cache_dir, CACHE_ARTIFACTS)
+    if os.path.exists(path) and hasattr(torch.compiler, 'load_cache_artifacts'):
+        with open(path, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+        print('Loaded compile cache artifacts from %s' % path)
+
+
+def save_compile_cache(cache_dir):
+    """Write the portable cache artifacts of this process (no-op on older PyTorch)."""
+    if not hasattr(torch.compiler, 'save_cache_artifacts'):
+        return
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return
+    path = os.path.join(cache_dir, CACHE_ARTIFACTS)
+    with open(path, 'wb') as f:
+        f.write(artifacts[0])
+    print('Saved compile cache artifacts to %s' % path)
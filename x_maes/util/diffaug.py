@@ -3,7 +3,6 @@
 # https://arxiv.org/pdf/2006.10738
 
 import torch
-import torch.nn.functional as F
 
 
 def DiffAugment(x, policy='', channels_first=True):
@@ -19,58 +18,66 @@ def DiffAugment(x, policy='', channels_first=True):
     return x
 
 
-def rand_brightness(x):
-    x = x + (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) - 0.5)
-    return x
+class DiffAugmentTransform:
+    """ DiffAugment `policy` applied to a single [C, H, W] image, to run in DataLoader workers. """
+    def __init__(self, policy):
+        self.policy = policy
 
+    def __call__(self, img):
+        return DiffAugment(img.unsqueeze(0), policy=self.policy)[0]
 
-def rand_saturation(x):
-    x_mean = x.mean(dim=1, keepdim=True)
-    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 2) + x_mean
-    return x
+    def __repr__(self):
+        return "{}(policy='{}')".format(self.__class__.__name__, self.policy)
 
 
-def rand_contrast(x):
-    x_mean = x.mean(dim=[1, 2, 3], keepdim=True)
-    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) + 0.5) + x_mean
-    return x
+def rand_color(x):
+    # brightness, saturation and contrast folded into one pass over x:
+    #   out = a * x + (k - a) * x_mean_c + (1 - k) * x_mean + b
+    # with b = brightness - 0.5, a = k * 2 * saturation, k = contrast + 0.5.
+    # Random factors are drawn in the same order as the sequential ops.
+    brightness = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) - 0.5
+    saturation = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 2
+    contrast = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) + 0.5
+    x_mean_c = x.mean(dim=1, keepdim=True)
+    x_mean = x_mean_c.mean(dim=[2, 3], keepdim=True)
+    scale = contrast * saturation
+    bias = (contrast - scale) * x_mean_c + ((1 - contrast) * x_mean + brightness)
+    return torch.addcmul(bias, x, scale)
 
 
 def rand_translation(x, ratio=0.125):
-    shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-    translation_x = torch.randint(-shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device)
-    translation_y = torch.randint(-shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(x.size(2), dtype=torch.long, device=x.device),
-        torch.arange(x.size(3), dtype=torch.long, device=x.device),
-    )
-    grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
-    grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
-    x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
-    x = x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
-    return x
+    # per-sample integer shift: one gather along H, one along W, zeros outside
+    B, C, H, W = x.shape
+    shift_x, shift_y = int(H * ratio + 0.5), int(W * ratio + 0.5)
+    translation_x = torch.randint(-shift_x, shift_x + 1, size=[B, 1], device=x.device)
+    translation_y = torch.randint(-shift_y, shift_y + 1, size=[B, 1], device=x.device)
+    rows = torch.arange(H, device=x.device) + translation_x
+    cols = torch.arange(W, device=x.device) + translation_y
+    valid_rows = ((rows >= 0) & (rows < H)).to(x.dtype)
+    valid_cols = ((cols >= 0) & (cols < W)).to(x.dtype)
+    rows = rows.clamp(0, H - 1)[:, None, :, None].expand(B, C, H, W)
+    cols = cols.clamp(0, W - 1)[:, None, None, :].expand(B, C, H, W)
+    x = x.gather(2, rows).gather(3, cols)
+    valid = valid_rows[:, :, None] * valid_cols[:, None, :]
+    return x * valid.unsqueeze(1)
 
 
 def rand_cutout(x, ratio=0.2):
-    cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-    offset_x = torch.randint(0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device)
-    offset_y = torch.randint(0, x.size(3) + (1 - cutout_size[1] % 2), size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
-    )
-    grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
-    grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
-    mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
-    mask[grid_batch, grid_x, grid_y] = 0
-    x = x * mask.unsqueeze(1)
-    return x
+    # zero a per-sample box given by its row / column ranges
+    B, C, H, W = x.shape
+    cutout_size = int(H * ratio + 0.5), int(W * ratio + 0.5)
+    offset_x = torch.randint(0, H + (1 - cutout_size[0] % 2), size=[B, 1], device=x.device)
+    offset_y = torch.randint(0, W + (1 - cutout_size[1] % 2), size=[B, 1], device=x.device)
+    rows = torch.arange(H, device=x.device) - (offset_x - cutout_size[0] // 2)
+    cols = torch.arange(W, device=x.device) - (offset_y - cutout_size[1] // 2)
+    in_rows = ((rows >= 0) & (rows < cutout_size[0])).to(x.dtype)
+    in_cols = ((cols >= 0) & (cols < cutout_size[1])).to(x.dtype)
+    keep = 1 - in_rows[:, :, None] * in_cols[:, None, :]
+    return x * keep.unsqueeze(1)
 
 
 AUGMENT_FNS = {
-    'color': [rand_brightness, rand_saturation, rand_contrast],
+    'color': [rand_color],
     'translation': [rand_translation],
     'cutout': [rand_cutout],
 }
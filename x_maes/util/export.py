@@ -0,0 +1,158 @@
+# --------------------------------------------------------
+# Inference-only encoders for TorchScript / ONNX export
+#
+# ExportEncoder rebuilds the encoder of any variant as one straight-line
+# forward: patch embedding, fixed position embedding, blocks, final norm and
+# pooling. Masking, decoders, teachers and augmentation are not part of it,
+# and it shares (does not copy) the parameters of the trained model. The
+# input size is fixed at export time; the batch axis stays dynamic.
+#
+# AGAT blocks drop tokens by attention. AGATFixedKeep runs them with the
+# number of tokens kept by every block frozen to a constant for the export
+# input size (the ranking itself stays input dependent), so the exported
+# graph has static token shapes.
+#
+# quantize_dynamic_int8 converts the nn.Linear layers of an ExportEncoder
+# (attention qkv / proj, MLP fc1 / fc2) to int8 weights with activations
+# quantized on the fly, for CPU inference. CAE attention adds its q / v
+# biases through F.linear on qkv.weight, so it is first rebuilt around a
+# plain nn.Linear with the folded bias.
+# --------------------------------------------------------
+
+import copy
+import io
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from util.features import encoder
+
+
+class AGATFixedKeep(nn.Module):
+    """ models_mae_AGAT.Block_AGAT at eval time, keeping `num_keep` patch tokens (plus cls)."""
+    def __init__(self, block, num_keep):
+        super().__init__()
+        self.norm1 = block.norm1
+        self.qkv = block.attn.qkv
+        self.proj = block.attn.proj
+        self.norm2 = block.norm2
+        self.mlp = block.mlp
+        self.num_heads = block.attn.num_heads
+        self.scale = block.attn.scale
+        self.num_keep = num_keep
+
+    def forward(self, x):
+        B, N, C = x.shape
+        qkv = self.qkv(self.norm1(x)).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = ((q @ k.transpose(-2, -1)) * self.scale).softmax(dim=-1)
+
+        # as Attention_AGAT: the patch tokens receiving the least attention (summed over heads and queries) survive
+        own_attn = attn.sum(dim=1).sum(dim=-2)  # [B, N]
+        keep = own_attn[:, 1:].topk(self.num_keep, dim=-1, largest=False)[1] + 1
+        keep = torch.cat([torch.zeros_like(keep[:, :1]), keep], dim=1)  # cls first
+
+        out = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        index = keep.unsqueeze(-1).expand(-1, -1, C)
+        x = torch.gather(x, 1, index) + self.proj(torch.gather(out, 1, index))
+        x = x + self.mlp(self.norm2(x))
+        return x
+
+
+class ExportEncoder(nn.Module):
+    """ Encoder of a (trained) variant: imgs [N, 3, H, W] -> features ([N, D] or [N, T, D] with 'all')."""
+    def __init__(self, model, pool='cls'):
+        super().__init__()
+        enc = encoder(model)
+        self.proj = enc.patch_embed.proj
+        self.patch_norm = getattr(enc.patch_embed, 'norm', nn.Identity())
+        pos_embed = enc.pos_embed.detach()
+        self.register_buffer('cls_pos', (enc.cls_token + pos_embed[:, :1, :]).detach())
+        self.register_buffer('patch_pos', pos_embed[:, 1:, :].clone())
+
+        blocks = list(enc.blocks)
+        if blocks and blocks[0].__class__.__name__ == 'Block_AGAT':
+            num_tokens = pos_embed.shape[1]
+            fixed = []
+            for blk in blocks:
+                num_keep = int(num_tokens * blk.attn.attn_drop) - 1  # as Attention_AGAT.forward
+                fixed.append(AGATFixedKeep(blk, num_keep))
+                num_tokens = num_keep + 1
+            blocks = fixed
+        self.blocks = nn.ModuleList(blocks)
+        # CodeBook: the quantizer reads the last block directly, its final norm is never trained
+        self.norm = nn.Identity() if hasattr(enc, 'code_book') else enc.norm
+        self.pool = pool
+
+    def forward(self, imgs):
+        x = self.patch_norm(self.proj(imgs).flatten(2).transpose(1, 2))
+        x = torch.cat((self.cls_pos.expand(x.shape[0], -1, -1), x + self.patch_pos), dim=1)
+        for blk in self.blocks:
+            x = blk(x)
+        x = self.norm(x)
+        if self.pool == 'cls':
+            return x[:, 0]
+        if self.pool == 'mean':
+            return x[:, 1:].mean(dim=1)
+        return x
+
+
+def export_torchscript(module, example, path=None):
+    """Traced, frozen TorchScript module (dynamic batch); saved to `path` if given."""
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(module.eval(), example))
+    if path is not None:
+        torch.jit.save(scripted, path)
+    return scripted
+
+
+def export_onnx(module, example, path, opset_version=17):
+    """ONNX graph with a dynamic batch axis: imgs [batch, 3, H, W] -> features [batch, ...]."""
+    with torch.no_grad():
+        torch.onnx.export(module.eval(), (example,), path, dynamo=False, opset_version=opset_version,
+                          input_names=['imgs'], output_names=['features'],
+                          dynamic_axes={'imgs': {0: 'batch'}, 'features': {0: 'batch'}})
+
+
+class FoldedQKVAttention(nn.Module):
+    """ models_common.Attention (CAE) at eval time, with (q_bias, 0, v_bias) folded into an nn.Linear qkv."""
+    def __init__(self, attn):
+        super().__init__()
+        out_features, in_features = attn.qkv.weight.shape
+        self.qkv = nn.Linear(in_features, out_features, bias=attn.q_bias is not None)
+        self.qkv.weight = attn.qkv.weight
+        if attn.q_bias is not None:
+            self.qkv.bias = nn.Parameter(
+                torch.cat((attn.q_bias, torch.zeros_like(attn.v_bias), attn.v_bias)).detach())
+        self.proj = attn.proj
+        self.num_heads = attn.num_heads
+        self.scale = attn.scale
+        self.fused_attn = attn.fused_attn
+
+    def forward(self, x, bool_masked_pos=None):
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        if self.fused_attn:
+            x = F.scaled_dot_product_attention(q, k, v, scale=self.scale)
+        else:
+            x = ((q * self.scale) @ k.transpose(-2, -1)).softmax(dim=-1) @ v
+        return self.proj(x.transpose(1, 2).reshape(B, N, -1))
+
+
+def quantize_dynamic_int8(module):
+    """int8 copy of an ExportEncoder (nn.Linear weights, dynamic activation scales); `module` is untouched."""
+    module = copy.deepcopy(module).eval()
+    for name, m in list(module.named_modules()):
+        if m.__class__.__name__ == 'Attention' and hasattr(m, 'q_bias'):  # CAE
+            parent, _, child = name.rpartition('.')
+            setattr(module.get_submodule(parent), child, FoldedQKVAttention(m))
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(module):
+    """Serialized size of the state dict (packed int8 weights included), in MB."""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
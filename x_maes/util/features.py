@@ -0,0 +1,222 @@
+# --------------------------------------------------------
+# Encoder features of the pretraining variants
+#
+# <root>/features.f16   float16 [N, D] (cls / mean pooling) or [N, T, D] (all tokens)
+# <root>/index.json     shape, pooling, model and (path, label) per row
+#
+# encoder_tokens runs the encoder of any variant on whole images: no
+# masking, no decoder. CodeBook features are the encoder output read by the
+# quantizer (that variant never trains its final norm); AGAT blocks still
+# drop tokens by attention, so its 'all' output holds the surviving tokens.
+# --------------------------------------------------------
+
+import contextlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from util.pos_embed import pos_embed_for
+
+
+VARIANTS = ('models_mae', 'models_mae_NN', 'models_mae_CodeBook', 'models_mae_DCR', 'models_mae_MoCo',
+            'models_mae_RDA', 'models_mae_AGAT', 'models_mae_CAE')
+POOLS = ('cls', 'mean', 'all')
+
+
+def cae_args(**kwargs):
+    """The pretext-task arguments the CAE model needs at construction (unused by its encoder)."""
+    import argparse
+    args = dict(decoder_depth=4, decoder_num_classes=8192, decoder_embed_dim=None, regressor_depth=4,
+                decoder_num_heads=None, decoder_layer_scale_init_value=0.1, fix_init_weight=False,
+                base_momentum=0.0, num_mask_patches=None, teacher_dtype=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def build_model(variant, model_name, **kwargs):
+    """models_<variant>.<model_name>(**kwargs); CAE decoder sizes follow the encoder (cae_<size>_...)."""
+    module = __import__(variant)
+    if variant == 'models_mae_CAE':
+        embed_dim, heads = {'small': (384, 12), 'base': (768, 12), 'large': (1024, 16)}[model_name.split('_')[1]]
+        kwargs['args'] = cae_args(decoder_embed_dim=embed_dim, decoder_num_heads=heads)
+        kwargs.setdefault('init_values', 0.1)  # layer scale, as pretrained
+    return module.__dict__[model_name](**kwargs)
+
+
+def encoder(model):
+    """The module holding the encoder (patch_embed, blocks, ...) of a variant."""
+    model = getattr(model, 'module', model)  # DDP
+    model = getattr(model, 'MAE', model)  # MoCo wrapper
+    return getattr(model, 'encoder', model)  # CAE
+
+
+ENCODER_KEYS = ('patch_embed.', 'cls_token', 'pos_embed', 'blocks.', 'norm.')
+
+
+def load_encoder(args):
+    """args.model of args.variant at args.input_size with the weights of the args.resume checkpoint (eval, cpu).
+
+    Fails if the checkpoint lacks any encoder weight (e.g. a wrong --variant / --model), instead of
+    running a randomly initialized encoder; decoder / teacher keys may be missing.
+    """
+    model = build_model(args.variant, args.model, img_size=args.input_size)
+    if args.resume:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        msg = model.load_state_dict(checkpoint['model'], strict=False)
+        print("Load checkpoint %s: %s" % (args.resume, msg))
+        prefix = next(name for name, m in model.named_modules() if m is encoder(model))
+        prefix = prefix + '.' if prefix else ''
+        missing = [k for k in msg.missing_keys if k.startswith(prefix) and k[len(prefix):].startswith(ENCODER_KEYS)]
+        if missing:
+            raise RuntimeError('checkpoint %s does not match %s.%s: missing encoder weights %s' % (
+                args.resume, args.variant, args.model, ', '.join(missing)))
+    return model.eval()
+
+
+@torch.no_grad()
+def encoder_tokens(model, imgs):
+    """
+    imgs: [N, 3, H, W]
+    returns: [N, 1 + L, D], cls token first (fewer tokens for AGAT)
+    """
+    enc = encoder(model)
+    if hasattr(enc, 'num_patches'):  # CAE VisionTransformerEncoder
+        bool_masked_pos = torch.zeros(imgs.shape[0], enc.num_patches, dtype=torch.bool, device=imgs.device)
+        return enc(imgs, bool_masked_pos, num_visible=enc.num_patches)
+
+    x = enc.embed_patches(imgs) if hasattr(enc, 'embed_patches') else enc.patch_embed(imgs)
+    x = x + pos_embed_for(enc.pos_embed, x.shape[1])[:, 1:, :]
+
+    cls_token = enc.cls_token + enc.pos_embed[:, :1, :]
+    x = torch.cat((cls_token.expand(x.shape[0], -1, -1), x), dim=1)
+
+    for blk in enc.blocks:
+        x = blk(x)
+        if isinstance(x, tuple):  # AGAT: (x, ids_restore, nums)
+            x = x[0]
+    if hasattr(enc, 'code_book'):
+        return x
+    return enc.norm(x)
+
+
+def pool_tokens(x, pool):
+    """[N, T, D] -> [N, D] ('cls', 'mean' of the patch tokens) or [N, T, D] ('all')."""
+    if pool == 'cls':
+        return x[:, 0]
+    if pool == 'mean':
+        return x[:, 1:].mean(dim=1)
+    return x
+
+
+class DevicePrefetcher:
+    """ Copies batch t+1 to `device` (on a side stream on cuda) while batch t is consumed.
+
+    Yields (samples, targets) with samples on `device`; samples may also be a
+    tuple / list of tensors (e.g. images and precomputed pixel targets).
+    """
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    @staticmethod
+    def _tensors(samples):
+        return list(samples) if isinstance(samples, (list, tuple)) else [samples]
+
+    def _prepare(self, batch):
+        samples, targets = batch
+        non_blocking = self.stream is not None
+        with torch.cuda.stream(self.stream) if non_blocking else contextlib.nullcontext():
+            if isinstance(samples, (list, tuple)):
+                samples = type(samples)(t.to(self.device, non_blocking=non_blocking) for t in samples)
+            else:
+                samples = samples.to(self.device, non_blocking=non_blocking)
+        return samples, targets
+
+    def _ready(self, batch):
+        # the consumer's stream waits for the copy and owns the memory from now on
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for t in self._tensors(batch[0]):
+                t.record_stream(torch.cuda.current_stream())
+        return batch
+
+    def __iter__(self):
+        it = iter(self.data_loader)
+        try:
+            prev = self._prepare(next(it))
+        except StopIteration:
+            return
+        for batch in it:
+            prev = self._ready(prev)
+            cur = self._prepare(batch)
+            yield prev
+            prev = cur
+        yield self._ready(prev)
+
+
+def store_meta(args):
+    """What a feature store was extracted from: images, pooling, model, input size and checkpoint (path + mtime)."""
+    return {'data_path': os.path.abspath(args.data_path), 'pool': args.pool, 'variant': args.variant,
+            'model': args.model, 'input_size': args.input_size,
+            'checkpoint': args.resume, 'checkpoint_mtime': os.path.getmtime(args.resume) if args.resume else None}
+
+
+class FeatureStoreWriter:
+    """ Streams features into <root>/features.f16; the shape of a row is taken from the first batch."""
+    def __init__(self, root, num_samples):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.num_samples = num_samples
+        self.features = None
+        self.offset = 0
+
+    def write(self, features):
+        if self.features is None:
+            self.features = np.memmap(os.path.join(self.root, 'features.f16'), mode='w+', dtype=np.float16,
+                                      shape=(self.num_samples,) + tuple(features.shape[1:]))
+        n = features.shape[0]
+        self.features[self.offset:self.offset + n] = features.to(torch.float16).cpu().numpy()
+        self.offset += n
+
+    def close(self, samples, classes=None, **meta):
+        assert self.offset == self.num_samples, 'wrote %d of %d rows' % (self.offset, self.num_samples)
+        self.features.flush()
+        index = {
+            'shape': list(self.features.shape),
+            'dtype': 'float16',
+            'classes': classes,
+            'samples': samples,
+        }
+        index.update(meta)
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """ Dataset over an extracted feature store: (features float32, label)."""
+    def __init__(self, root):
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.root = root
+        self.samples = self.index['samples']
+        self.classes = self.index['classes']
+        self.features = None  # opened lazily, once per worker
+
+    def open(self):
+        if self.features is None:
+            self.features = np.memmap(os.path.join(self.root, 'features.f16'), mode='r', dtype=np.float16,
+                                      shape=tuple(self.index['shape']))
+        return self.features
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        features = torch.from_numpy(self.open()[index].astype(np.float32))
+        return features, self.samples[index][1]
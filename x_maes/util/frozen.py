@@ -0,0 +1,111 @@
+# --------------------------------------------------------
+# Frozen / EMA teacher towers
+# --------------------------------------------------------
+
+import torch
+import torch.nn as nn
+
+
+DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def _strip_prefix_hook(module, state_dict, prefix, local_metadata):
+    # keep checkpoints keyed as if the tower was not wrapped
+    for k in list(state_dict.keys()):
+        if k.startswith(prefix + 'module.'):
+            state_dict[prefix + k[len(prefix + 'module.'):]] = state_dict.pop(k)
+
+
+def _add_prefix_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    for k in list(state_dict.keys()):
+        if k.startswith(prefix) and not k.startswith(prefix + 'module.'):
+            state_dict[prefix + 'module.' + k[len(prefix):]] = state_dict.pop(k)
+
+
+class FrozenModule(nn.Module):
+    """ Inference-only wrapper for a teacher tower.
+
+    Weights are stored in `dtype`, never require grad (so they are skipped by
+    optim_factory.add_weight_decay and by DDP gradient buckets) and the forward
+    runs under torch.inference_mode with autocast disabled. Outputs are returned
+    as regular fp32 tensors so they can be used as loss targets.
+    """
+    def __init__(self, module, dtype=torch.bfloat16):
+        super().__init__()
+        if isinstance(dtype, str):
+            dtype = DTYPES[dtype]
+        self.dtype = dtype
+        self.fp32_bytes = sum(t.numel() * 4 for t in self._floating_tensors(module))
+
+        self.module = module.to(dtype)
+        for p in self.module.parameters():
+            p.requires_grad = False
+        self.module.eval()
+
+        self._register_state_dict_hook(_strip_prefix_hook)
+        self._register_load_state_dict_pre_hook(_add_prefix_hook)
+
+    @staticmethod
+    def _floating_tensors(module):
+        for t in list(module.parameters()) + list(module.buffers()):
+            if t.is_floating_point():
+                yield t
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self._floating_tensors(self.module))
+
+    def memory_saved(self):
+        """Bytes saved w.r.t. keeping the tower as fp32 parameters."""
+        return self.fp32_bytes - self.memory_bytes()
+
+    def train(self, mode=True):
+        # the wrapped tower always stays in eval mode
+        return super().train(False)
+
+    def _cast(self, x):
+        if isinstance(x, torch.Tensor) and x.is_floating_point():
+            return x.to(self.dtype)
+        return x
+
+    def forward(self, *args, **kwargs):
+        args = [self._cast(a) for a in args]
+        kwargs = {k: self._cast(v) for k, v in kwargs.items()}
+        device_type = next(self.module.parameters()).device.type
+        with torch.inference_mode(), torch.autocast(device_type=device_type, enabled=False):
+            out = self.module(*args, **kwargs)
+        # converting outside of inference mode gives a normal tensor that autograd can save
+        if isinstance(out, (tuple, list)):
+            return type(out)(o.float() if o.dtype != torch.float32 else o.clone() for o in out)
+        return out.float() if out.dtype != torch.float32 else out.clone()
+
+
+def frozen_memory_report(model):
+    """Print the memory saved by every FrozenModule inside `model`."""
+    total = 0
+    for name, m in model.named_modules():
+        if isinstance(m, FrozenModule):
+            saved = m.memory_saved()
+            total += saved
+            print("Frozen tower %s: %s, %.1f MB (saved %.1f MB vs fp32)" % (
+                name, str(m.dtype).replace('torch.', ''), m.memory_bytes() / 2**20, saved / 2**20))
+    return total
+
+
+def ignore_frozen_in_ddp(model):
+    """Exclude FrozenModule parameters and buffers from DDP broadcast and bucketing.
+
+    Must be called before wrapping `model` with DistributedDataParallel.
+    """
+    names = []
+    for name, m in model.named_modules():
+        if isinstance(m, FrozenModule):
+            prefix = name + '.' if name else ''
+            names += [prefix + n for n, _ in m.named_parameters()]
+            names += [prefix + n for n, _ in m.named_buffers()]
+    if names:
+        torch.nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, names)
+    return names
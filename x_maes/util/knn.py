@@ -0,0 +1,108 @@
+# --------------------------------------------------------
+# Online kNN evaluation of the encoder during pretraining
+#
+# CLS features of a fixed labeled subset (bank) and of a held-out subset
+# (queries), L2-normalized and kept on device. Queries are classified by a
+# temperature-weighted vote of their k nearest bank features (cosine), as in
+# DINO / InstDisc. The similarity top-k runs in [query chunk, bank chunk]
+# tiles with a running top-k, so the full queries x bank matrix is never
+# materialized.
+# --------------------------------------------------------
+
+import time
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+
+import util.misc as misc
+from util.features import encoder_tokens
+
+
+def chunked_topk(queries, bank, k, query_chunk=1024, bank_chunk=16384):
+    """Top-k cosine similarities (and bank indices) [Q, k] of L2-normalized queries [Q, D] in bank [M, D]."""
+    k = min(k, bank.shape[0])
+    sims, ids = [], []
+    for q in queries.split(query_chunk):
+        best_sim = q.new_full((q.shape[0], 0), float('-inf'))
+        best_ids = torch.zeros(q.shape[0], 0, dtype=torch.long, device=q.device)
+        for start in range(0, bank.shape[0], bank_chunk):
+            s = q @ bank[start:start + bank_chunk].T
+            s, i = s.topk(min(k, s.shape[1]), dim=1)
+            best_sim, top = torch.cat([best_sim, s], dim=1).topk(min(k, best_sim.shape[1] + s.shape[1]), dim=1)
+            best_ids = torch.gather(torch.cat([best_ids, i + start], dim=1), 1, top)
+        sims.append(best_sim)
+        ids.append(best_ids)
+    return torch.cat(sims), torch.cat(ids)
+
+
+def knn_classify(bank, bank_labels, queries, num_classes, k=20, temperature=0.07, **chunks):
+    """Class scores [Q, num_classes] of queries from a weighted vote of their k nearest bank features."""
+    sims, ids = chunked_topk(queries, bank, k, **chunks)
+    weights = (sims / temperature).exp()
+    scores = torch.zeros(queries.shape[0], num_classes, device=queries.device)
+    return scores.scatter_add_(1, bank_labels[ids], weights)
+
+
+def _subset(dataset, num_samples, seed):
+    if num_samples <= 0 or num_samples >= len(dataset):
+        return dataset
+    g = torch.Generator().manual_seed(seed)
+    return torch.utils.data.Subset(dataset, torch.randperm(len(dataset), generator=g)[:num_samples].tolist())
+
+
+class KNNMonitor:
+    """ kNN top-1 / top-5 accuracy of the CLS features of `model`'s encoder.
+
+    bank: `num_train` images of <data_path>/train, queries: `num_val` images
+    of <data_path>/val (fixed random subsets), which bounds the time per call.
+    """
+    def __init__(self, data_path, input_size, device, num_train=10000, num_val=2000, k=20, temperature=0.07,
+                 batch_size=256, num_workers=10, precision='fp32', seed=0):
+        transform = transforms.Compose([
+            transforms.Resize(int(input_size * 256 / 224), interpolation=3),
+            transforms.CenterCrop(input_size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+        train = datasets.ImageFolder(data_path + '/train', transform=transform)
+        val = datasets.ImageFolder(data_path + '/val', transform=transform)
+        assert train.classes == val.classes
+        self.num_classes = len(train.classes)
+        self.loaders = [torch.utils.data.DataLoader(_subset(d, n, seed), batch_size=batch_size,
+                                                    num_workers=num_workers, pin_memory=True, drop_last=False)
+                        for d, n in ((train, num_train), (val, num_val))]
+        self.device = device
+        self.k = k
+        self.temperature = temperature
+        self.precision = precision
+
+    @torch.no_grad()
+    def features(self, encode, data_loader):
+        """L2-normalized encode(samples) [n, D] and labels [n] over data_loader."""
+        features, labels = [], []
+        for samples, targets in data_loader:
+            samples = samples.to(self.device, non_blocking=True)
+            with misc.autocast(self.device, self.precision):
+                x = encode(samples)
+            features.append(F.normalize(x.float(), dim=1))
+            labels.append(targets.to(self.device, non_blocking=True))
+        return torch.cat(features), torch.cat(labels)
+
+    def evaluate(self, model):
+        start = time.time()
+        was_training = model.training
+        model.eval()
+        encode = lambda samples: encoder_tokens(model, samples)[:, 0]
+        bank, bank_labels = self.features(encode, self.loaders[0])
+        queries, labels = self.features(encode, self.loaders[1])
+        model.train(was_training)
+
+        scores = knn_classify(bank, bank_labels, queries, self.num_classes, self.k, self.temperature)
+        top5 = scores.topk(min(5, self.num_classes), dim=1).indices
+        correct = top5 == labels.unsqueeze(1)
+        return {
+            'top1': correct[:, 0].float().mean().item() * 100,
+            'top5': correct.any(dim=1).float().mean().item() * 100,
+            'time': time.time() - start,
+        }
@@ -0,0 +1,68 @@
+# --------------------------------------------------------
+# Masked-position helpers of the MAE reconstruction loss
+#
+# With decode_masked_only the decoder predicts the masked patches only (or,
+# with decode_ratio < 1, a random fixed-size subset of them) and
+# forward_loss builds the pixel targets of those patches only. Both sides
+# order them by ascending patch index, so pred[:, i] and target[:, i] refer
+# to the same patch.
+# --------------------------------------------------------
+
+import torch
+
+
+def masked_ids(mask, num_masked):
+    """Patch indices [N, num_masked] of the masked (nonzero) positions of mask [N, L], ascending.
+
+    Every row must have exactly num_masked masked positions, which keeps the
+    shapes static (no nonzero / boolean indexing).
+    """
+    return torch.argsort(mask.float(), dim=1, descending=True, stable=True)[:, :num_masked]
+
+
+def num_decoded(num_masked, decode_ratio):
+    """Masked patches reconstructed per sample with partial reconstruction."""
+    return max(1, int(num_masked * decode_ratio))
+
+
+def decode_subset(ids_restore, len_keep, decode_ratio):
+    """Draw, per sample, the fixed-size random subset of masked patches to reconstruct.
+
+    The masked part of the shuffle order is re-drawn, so that the chosen
+    patches are the first num_decode masked ones, i.e. those with
+    len_keep <= ids_restore < len_keep + num_decode; the kept part (and so
+    the encoder output) is untouched.
+    Returns (ids_restore, decode_mask [N, L], 1 for the patches to predict).
+    """
+    N, L = ids_restore.shape
+    num_decode = num_decoded(L - len_keep, decode_ratio)
+    ids_shuffle = torch.argsort(ids_restore, dim=1)
+    noise = torch.rand(N, L - len_keep, device=ids_restore.device)
+    ids_masked = torch.gather(ids_shuffle[:, len_keep:], 1, torch.argsort(noise, dim=1))
+    ids_restore = torch.argsort(torch.cat([ids_shuffle[:, :len_keep], ids_masked], dim=1), dim=1)
+    decode_mask = ((ids_restore >= len_keep) & (ids_restore < len_keep + num_decode)).float()
+    return ids_restore, decode_mask
+
+
+def partial_decoder_input(x, mask_token, pos_embed, ids_restore, decode_ratio):
+    """Decoder input with only num_decode of the mask tokens (see decode_subset).
+
+    x: [N, 1 + len_keep, D], embedded encoder output (cls token first)
+    pos_embed: [1, 1 + L, D]
+    returns: x [N, 1 + len_keep + num_decode, D] (cls, then the kept and decoded
+        patches in patch order, pos embed added) and the shuffle index of
+        every non-cls token [N, len_keep + num_decode], i.e. ids_restore
+        restricted to the decoder tokens
+    """
+    N, L = ids_restore.shape
+    len_keep, D = x.shape[1] - 1, x.shape[2]
+    num_decode = num_decoded(L - len_keep, decode_ratio)
+    ids_decode = masked_ids(ids_restore < len_keep + num_decode, len_keep + num_decode)
+    ids_restore = torch.gather(ids_restore, 1, ids_decode)
+
+    mask_tokens = mask_token.repeat(N, num_decode, 1)
+    x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+    x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).expand(-1, -1, D))  # unshuffle
+    pos = torch.gather(pos_embed[:, 1:, :].expand(N, -1, -1), 1, ids_decode.unsqueeze(-1).expand(-1, -1, D))
+    x = torch.cat([x[:, :1, :] + pos_embed[:, :1, :], x_ + pos], dim=1)
+    return x, ids_restore
@@ -14,11 +14,18 @@ import datetime
 import os
 import time
 from collections import defaultdict, deque
+from math import inf
 from pathlib import Path
 
 import torch
 import torch.distributed as dist
-from torch._six import inf
+
+
+PRECISIONS = {
+    'fp32': None,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
 
 
 class SmoothedValue(object):
@@ -45,7 +52,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=dist_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -221,11 +228,44 @@ def init_distributed_mode(args):
     return
 
 
+def dist_device():
+    """Device for collectives: NCCL only reduces CUDA tensors, gloo reduces CPU tensors."""
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def resolve_precision(precision, device):
+    """Default precision: fp16 autocast on CUDA (as before), fp32 elsewhere."""
+    if precision is None:
+        precision = 'fp16' if torch.device(device).type == 'cuda' else 'fp32'
+    assert precision in PRECISIONS, 'precision must be one of %s' % ', '.join(PRECISIONS)
+    return precision
+
+
+def autocast(device, precision):
+    """Autocast context for `precision` ('fp32' disables it) on any device type."""
+    return torch.autocast(device_type=torch.device(device).type, dtype=PRECISIONS[precision],
+                          enabled=precision != 'fp32')
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
 class NativeScalerWithGradNormCount:
+    """ Loss scaling for fp16. With enabled=False (fp32 / bf16) scale / unscale /
+    update are no-ops and step() is a plain optimizer.step().
+    """
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True, device='cuda'):
+        device_type = torch.device(device).type
+        if hasattr(torch.amp, 'GradScaler'):
+            self._scaler = torch.amp.GradScaler(device_type, enabled=enabled)
+        else:
+            self._scaler = torch.cuda.amp.GradScaler(enabled=enabled and device_type == 'cuda')
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -247,7 +287,8 @@ class NativeScalerWithGradNormCount:
         return self._scaler.state_dict()
 
     def load_state_dict(self, state_dict):
-        self._scaler.load_state_dict(state_dict)
+        if state_dict:  # checkpoints of fp32 / bf16 runs carry an empty scaler state
+            self._scaler.load_state_dict(state_dict)
 
 
 def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
@@ -299,7 +340,7 @@ def load_model(args, model_without_ddp):
 def all_reduce_mean(x):
     world_size = get_world_size()
     if world_size > 1:
-        x_reduce = torch.tensor(x).cuda()
+        x_reduce = torch.tensor(x, device=dist_device())
         dist.all_reduce(x_reduce)
         x_reduce /= world_size
         return x_reduce.item()
@@ -53,7 +53,7 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     out: (M, D)
     """
     assert embed_dim % 2 == 0
-    omega = np.arange(embed_dim // 2, dtype=np.float)
+    omega = np.arange(embed_dim // 2, dtype=np.float64)
     omega /= embed_dim / 2.
     omega = 1. / 10000**omega  # (D/2,)
 
@@ -67,6 +67,51 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     return emb
 
 
+# --------------------------------------------------------
+# Sine-cosine position embedding of other grid sizes (progressive resolution)
+# The positions of a grid_size x grid_size grid are spread over the model's
+# base grid (0 .. base_grid_size - 1), so a low-resolution image sees the
+# same embedding range as a full-resolution one; at grid_size ==
+# base_grid_size this is exactly the fixed pos_embed buffer.
+# --------------------------------------------------------
+_SINCOS_CACHE = {}
+
+
+def get_2d_sincos_pos_embed_interp(embed_dim, grid_size, base_grid_size, cls_token=False):
+    """
+    return:
+    pos_embed: [grid_size*grid_size, embed_dim] or [1+grid_size*grid_size, embed_dim] (w/ or w/o cls_token)
+    """
+    grid_h = np.linspace(0, base_grid_size - 1, grid_size, dtype=np.float32)
+    grid_w = np.linspace(0, base_grid_size - 1, grid_size, dtype=np.float32)
+    grid = np.meshgrid(grid_w, grid_h)  # here w goes first
+    grid = np.stack(grid, axis=0)
+
+    grid = grid.reshape([2, 1, grid_size, grid_size])
+    pos_embed = get_2d_sincos_pos_embed_from_grid(embed_dim, grid)
+    if cls_token:
+        pos_embed = np.concatenate([np.zeros([1, embed_dim]), pos_embed], axis=0)
+    return pos_embed
+
+
+def pos_embed_for(pos_embed, num_patches):
+    """Fixed sin-cos pos_embed [1, 1 + L0, D] (cls token first) for a square grid of num_patches.
+
+    Returns the buffer itself when num_patches == L0, otherwise the
+    interpolated embedding of the smaller / larger grid, computed once per
+    (dim, grid, base grid, device, dtype) and cached.
+    """
+    if num_patches == pos_embed.shape[1] - 1:
+        return pos_embed
+    grid_size, base_grid_size = int(num_patches ** .5), int((pos_embed.shape[1] - 1) ** .5)
+    assert grid_size * grid_size == num_patches, 'only square grids are supported'
+    key = (pos_embed.shape[-1], grid_size, base_grid_size, pos_embed.device, pos_embed.dtype)
+    if key not in _SINCOS_CACHE:
+        emb = get_2d_sincos_pos_embed_interp(pos_embed.shape[-1], grid_size, base_grid_size, cls_token=True)
+        _SINCOS_CACHE[key] = torch.from_numpy(emb).to(pos_embed.device, pos_embed.dtype).unsqueeze(0)
+    return _SINCOS_CACHE[key]
+
+
 # --------------------------------------------------------
 # Interpolate position embeddings for high-resolution
 # References:
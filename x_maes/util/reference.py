@@ -0,0 +1,89 @@
+# --------------------------------------------------------
+# Reference implementations for the parity checks of benchmark.py and
+# tests/: the straightforward versions the optimized code paths replaced.
+# --------------------------------------------------------
+
+import torch
+import torch.nn.functional as F
+
+from util.pos_embed import pos_embed_for
+
+
+def color_sequential(x):
+    # reference: brightness, saturation and contrast as three passes
+    x = x + (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) - 0.5)
+    x_mean = x.mean(dim=1, keepdim=True)
+    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) * 2) + x_mean
+    x_mean = x.mean(dim=[1, 2, 3], keepdim=True)
+    x = (x - x_mean) * (torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device) + 0.5) + x_mean
+    return x
+
+
+def translation_meshgrid(x, ratio=0.125):
+    # reference: full [B, H, W] index grids on a padded channels-last copy
+    shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+    translation_x = torch.randint(-shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device)
+    translation_y = torch.randint(-shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device)
+    grid_batch, grid_x, grid_y = torch.meshgrid(
+        torch.arange(x.size(0), dtype=torch.long, device=x.device),
+        torch.arange(x.size(2), dtype=torch.long, device=x.device),
+        torch.arange(x.size(3), dtype=torch.long, device=x.device),
+        indexing='ij',
+    )
+    grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
+    grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
+    x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
+    return x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
+
+
+def cutout_meshgrid(x, ratio=0.2):
+    # reference: scatter zeros through [B, h, w] index grids
+    cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+    offset_x = torch.randint(0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device)
+    offset_y = torch.randint(0, x.size(3) + (1 - cutout_size[1] % 2), size=[x.size(0), 1, 1], device=x.device)
+    grid_batch, grid_x, grid_y = torch.meshgrid(
+        torch.arange(x.size(0), dtype=torch.long, device=x.device),
+        torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
+        torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
+        indexing='ij',
+    )
+    grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
+    grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
+    mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
+    mask[grid_batch, grid_x, grid_y] = 0
+    return x * mask.unsqueeze(1)
+
+
+def attention_modules(dim, heads):
+    """The custom attention modules switched by util.attention.set_fused_attn, by name."""
+    from models_common import Attention, CrossAttention
+    from models_mae_AGAT import Attention_AGAT
+    return {
+        'CAE Attention': Attention(dim, heads, qkv_bias=True),
+        'CAE CrossAttention': CrossAttention(dim, heads, qkv_bias=True),
+        'Attention_AGAT': Attention_AGAT(dim, heads, qkv_bias=True, attn_drop=0.9),
+    }
+
+
+def attention_call(name, module, x):
+    """Output [B, N', D] of a module of attention_modules on tokens x [B, N, D]."""
+    if name == 'CAE CrossAttention':
+        # regressor: masked queries attend to all tokens
+        return module(x[:, :x.shape[1] // 2], k=x, v=x)
+    out = module(x)
+    return out[0] if isinstance(out, tuple) else out
+
+
+def varlen_reference(model, imgs, ids_restore, offsets):
+    """Per-sample padded-path encoder on the tokens kept by forward_encoder_varlen."""
+    x = model.embed_patches(imgs)
+    x = x + pos_embed_for(model.pos_embed, x.shape[1])[:, 1:, :]
+    ids_shuffle = torch.argsort(ids_restore, dim=1)
+    cls_token = model.cls_token + model.pos_embed[:, :1, :]
+    latent = []
+    for i, n in enumerate((offsets.diff() - 1).tolist()):
+        xi = torch.cat([cls_token, x[i:i + 1, ids_shuffle[i, :n]]], dim=1)
+        for blk in model.blocks:
+            xi = blk(xi)
+        latent.append(model.norm(xi)[0])
+    return torch.cat(latent)
@@ -0,0 +1,42 @@
+# --------------------------------------------------------
+# Progressive-resolution schedule of pretraining
+#
+# "0:128,20:160,40:224": 128px crops from epoch 0, 160px from epoch 20 and
+# 224px from epoch 40 on. The model is built at the final size; smaller
+# inputs use interpolated sin-cos position embeddings (util/pos_embed.py).
+# --------------------------------------------------------
+
+import torchvision.transforms as transforms
+
+
+def parse_res_schedule(spec, patch_size):
+    """[(start_epoch, input_size), ...] sorted by start epoch, the first stage starting at epoch 0."""
+    schedule = []
+    for stage in spec.split(','):
+        epoch, size = stage.split(':')
+        schedule.append((int(epoch), int(size)))
+    schedule.sort()
+    assert schedule[0][0] == 0, 'the first resolution stage must start at epoch 0'
+    for _, size in schedule:
+        assert size % patch_size == 0, 'input size %d is not a multiple of the patch size %d' % (size, patch_size)
+    return schedule
+
+
+def input_size_at(schedule, epoch):
+    size = schedule[0][1]
+    for start, stage_size in schedule:
+        if epoch >= start:
+            size = stage_size
+    return size
+
+
+def set_input_size(transform, size):
+    """Point the RandomResizedCrop of a training Compose at `size`.
+
+    DataLoader workers get a fresh copy of the dataset (and so of the
+    transform) every epoch unless persistent_workers is set.
+    """
+    crops = [t for t in transform.transforms if isinstance(t, transforms.RandomResizedCrop)]
+    assert crops, 'no RandomResizedCrop to resize'
+    for t in crops:
+        t.size = (size, size)
@@ -0,0 +1,102 @@
+# --------------------------------------------------------
+# Pixel targets of the MAE reconstruction loss
+#
+# Patches are read through a zero-copy unfold view of the images, so only
+# the requested patches (e.g. the masked ones) are materialized, and
+# norm_pix targets take their per-patch mean / variance in a single
+# var_mean pass. PatchTargetTransform builds the same targets in the data
+# loader workers instead of the training step.
+#
+# With pre-patchified input (PatchifyTransform) the loader delivers uint8
+# patches [L, p*p*3] instead of images; they are normalized on device
+# (normalize_uint8_patches) and serve both as the model input and as the
+# reconstruction targets.
+# --------------------------------------------------------
+
+import torch
+import torchvision.transforms.functional as TF
+
+
+def patch_view(imgs, patch_size):
+    """Zero-copy view [N, h, w, p, p, C] of imgs [N, C, H, W] (patchify layout before flattening)."""
+    p = patch_size
+    assert imgs.shape[2] % p == 0 and imgs.shape[3] % p == 0
+    return imgs.unfold(2, p, p).unfold(3, p, p).permute(0, 2, 3, 4, 5, 1)
+
+
+def normalize_patches(x, eps=1.e-6):
+    """Per-patch (last dim) standardization, unbiased variance as in the original norm_pix_loss."""
+    var, mean = torch.var_mean(x, dim=-1, keepdim=True)
+    return (x - mean).mul_(torch.rsqrt(var + eps))
+
+
+def patch_targets(imgs, patch_size, ids=None, norm_pix=False, precomputed=None):
+    """Reconstruction targets in patchify layout.
+
+    imgs: [N, 3, H, W], or pre-patchified input [N, L, p*p*3]
+    ids: [N, M] patch indices to build, or None for all L patches
+    precomputed: [N, L, p*p*3] targets from PatchTargetTransform (already
+        normalized if norm_pix), used instead of imgs
+    returns: [N, M or L, p*p*3]
+    """
+    if precomputed is not None:
+        if ids is None:
+            return precomputed
+        return torch.gather(precomputed, 1, ids.unsqueeze(-1).expand(-1, -1, precomputed.shape[-1]))
+
+    if imgs.dim() == 3:
+        precomputed = imgs if ids is None else torch.gather(imgs, 1, ids.unsqueeze(-1).expand(-1, -1, imgs.shape[-1]))
+        return normalize_patches(precomputed) if norm_pix else precomputed
+
+    x = patch_view(imgs, patch_size)
+    N, h, w = x.shape[:3]
+    if ids is None:
+        x = x.reshape(N, h * w, -1)
+    else:
+        batch = torch.arange(N, device=imgs.device).unsqueeze(1)
+        x = x[batch, ids // w, ids % w].reshape(N, ids.shape[1], -1)
+    if norm_pix:
+        x = normalize_patches(x)
+    return x
+
+
+class PatchTargetTransform:
+    """ Last transform of the training pipeline: returns (img, targets [L, p*p*3]).
+
+    The engine passes the targets on to the model (`target=`), whose
+    forward_loss then only gathers the rows it needs.
+    """
+    def __init__(self, patch_size, norm_pix=False):
+        self.patch_size = patch_size
+        self.norm_pix = norm_pix
+
+    def __call__(self, img):
+        return img, patch_targets(img.unsqueeze(0), self.patch_size, norm_pix=self.norm_pix)[0]
+
+    def __repr__(self):
+        return '%s(patch_size=%d, norm_pix=%s)' % (self.__class__.__name__, self.patch_size, self.norm_pix)
+
+
+def normalize_uint8_patches(patches, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    """ToTensor + Normalize of uint8 patches [..., p*p*3] (channel last in patchify layout)."""
+    mean = torch.tensor(mean, device=patches.device)
+    std = torch.tensor(std, device=patches.device)
+    x = patches.float().div(255).unflatten(-1, (-1, 3))
+    return x.sub(mean).div(std).flatten(-2)
+
+
+class PatchifyTransform:
+    """ Replaces ToTensor + Normalize: PIL image -> uint8 patches [L, p*p*3] in patchify layout.
+
+    A quarter of the bytes of float images through the loader and the host to
+    device copy; normalize_uint8_patches finishes the job on device.
+    """
+    def __init__(self, patch_size):
+        self.patch_size = patch_size
+
+    def __call__(self, img):
+        x = patch_view(TF.pil_to_tensor(img).unsqueeze(0), self.patch_size)
+        return x.reshape(x.shape[1] * x.shape[2], -1)
+
+    def __repr__(self):
+        return '%s(patch_size=%d)' % (self.__class__.__name__, self.patch_size)
@@ -0,0 +1,122 @@
+# --------------------------------------------------------
+# Out-of-process teacher: runs a frozen tower in a worker process
+# (spare CPU cores or another device) one step ahead of the student.
+# --------------------------------------------------------
+
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+from util.features import DevicePrefetcher
+
+
+def _serve(teacher, inputs, outputs, requests, replies, device, num_threads):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    teacher = teacher.to(device)
+    teacher.eval()
+    with torch.inference_mode():
+        while True:
+            req = requests.get()
+            if req is None:
+                break
+            slot, n = req
+            feats = teacher(inputs[slot, :n].to(device, non_blocking=True))
+            outputs[slot, :n].copy_(feats[:, 0])  # CLS token
+            replies.put(slot)
+
+
+class TeacherServer:
+    """ Serves CLS features of a frozen teacher from a separate process.
+
+    Batches are exchanged through pre-allocated shared-memory slots, so only
+    slot ids go through the queues. Up to `slots` batches can be in flight;
+    results come back in submission order.
+    """
+    def __init__(self, teacher, batch_size, img_shape=(3, 224, 224), feat_dim=768,
+                 device='cpu', num_threads=0, slots=2):
+        self.slots = slots
+        self.inputs = torch.empty((slots, batch_size) + tuple(img_shape)).share_memory_()
+        self.outputs = torch.empty(slots, batch_size, feat_dim).share_memory_()
+        self.sizes = [0] * slots
+
+        ctx = mp.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.replies = ctx.Queue()
+        self.proc = ctx.Process(
+            target=_serve, daemon=True,
+            args=(teacher, self.inputs, self.outputs, self.requests, self.replies, device, num_threads))
+        self.proc.start()
+        self._next = 0
+        self._in_flight = 0
+
+    def submit(self, imgs):
+        assert self._in_flight < self.slots, 'all teacher slots are in flight'
+        slot = self._next % self.slots
+        n = imgs.shape[0]
+        self.inputs[slot, :n].copy_(imgs.detach())
+        self.sizes[slot] = n
+        self.requests.put((slot, n))
+        self._next += 1
+        self._in_flight += 1
+
+    def get(self):
+        """Features [n, 1, feat_dim] of the oldest submitted batch."""
+        while True:
+            try:
+                slot = self.replies.get(timeout=1.)
+                break
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    raise RuntimeError('teacher server exited with code %s' % self.proc.exitcode)
+        self._in_flight -= 1
+        return self.outputs[slot, :self.sizes[slot]].clone().unsqueeze(1)
+
+    def close(self):
+        if self.proc.is_alive():
+            self.requests.put(None)
+            self.proc.join(timeout=10)
+
+
+class TeacherPrefetcher:
+    """ Wraps a data loader so that batch t+1 is sent to the teacher server
+    before the student step on batch t starts.
+
+    Yields (samples, targets, teacher_target) with samples already on `device`
+    (util.features.DevicePrefetcher) and passed through `augment`, so that
+    student and teacher see the same views.
+    """
+    def __init__(self, data_loader, server, device, augment=None):
+        self.data_loader = data_loader
+        self.server = server
+        self.device = device
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _submit(self, batch):
+        samples, targets = batch
+        if isinstance(samples, (list, tuple)):
+            # (images, precomputed pixel targets): only the images go to the teacher
+            assert self.augment is None, 'precomputed targets need the augmentation in the loader workers'
+            self.server.submit(samples[0])
+            return samples, targets
+        if self.augment is not None:
+            samples = self.augment(samples)
+        self.server.submit(samples)
+        return samples, targets
+
+    def __iter__(self):
+        it = iter(DevicePrefetcher(self.data_loader, self.device))
+        try:
+            prev = self._submit(next(it))
+        except StopIteration:
+            return
+        for batch in it:
+            cur = self._submit(batch)  # teacher works on t+1 while the student runs t
+            yield prev + (self.server.get(),)
+            prev = cur
+        yield prev + (self.server.get(),)
@@ -0,0 +1,44 @@
+# --------------------------------------------------------
+# Packed variable-length sequences through timm ViT blocks
+#
+# The sequences of a batch are concatenated into one [T, D] tensor with
+# cumulative-length offsets [B + 1] (cu_seqlens). Norms and MLPs are
+# per-token and run on the packed tensor directly; attention runs on a
+# jagged nested tensor, so every sample only attends to its own tokens
+# and no padding is ever computed.
+# --------------------------------------------------------
+
+import torch
+import torch.nn.functional as F
+
+
+def cu_seqlens(lengths):
+    """Offsets [B + 1] of sequences with the given lengths [B] in the packed tensor."""
+    return F.pad(torch.cumsum(lengths, dim=0), (1, 0))
+
+
+def varlen_attention(attn, x, offsets):
+    """timm Attention on packed x [T, C]; sample b is x[offsets[b]:offsets[b + 1]]."""
+    T, C = x.shape
+    qkv = attn.qkv(x).reshape(T, 3, attn.num_heads, C // attn.num_heads).permute(1, 0, 2, 3).contiguous()
+    q, k, v = [torch.nested.nested_tensor_from_jagged(t, offsets=offsets).transpose(1, 2)
+               for t in qkv]  # [B, heads, (len), head_dim]
+    x = F.scaled_dot_product_attention(
+        q, k, v, dropout_p=attn.attn_drop.p if attn.training else 0., scale=attn.scale)
+    x = x.transpose(1, 2).values().reshape(T, C)
+    x = attn.proj(x)
+    x = attn.proj_drop(x)
+    return x
+
+
+def varlen_block(blk, x, offsets):
+    """timm Block.forward on packed x [T, C]."""
+    x = x + blk.drop_path(varlen_attention(blk.attn, blk.norm1(x), offsets))
+    x = x + blk.drop_path(blk.mlp(blk.norm2(x)))
+    return x
+
+
+def token_index(lengths, max_len):
+    """(sample, position) of every token of sequences with the given lengths [B], in packed order."""
+    keep = torch.arange(max_len, device=lengths.device) < lengths.unsqueeze(1)
+    return keep.nonzero(as_tuple=True)